@@ -0,0 +1,358 @@
+"""
+Benchmarks for the ingest and devig stages of k456.py on synthetic slates.
+
+A slate is N events x M players x K bookmakers x markets of Over/Under player props, shaped like the event odds
+payloads the poller queues. Each stage (decereal, calculate, power_devig, update_market_data, validate_data) is timed
+on its own, then the whole slate is pushed through MarketManager end to end. Every stage reports throughput, p50/p99
+latency per call and peak traced memory.
+
+Results can be saved as a JSON baseline and later runs compared against it; a stage regresses when its p50 or
+throughput is worse than the baseline by more than --threshold, and the comparison then exits with status 1.
+
+--startup instead measures a cold `import k456` and a cold one-shot main() against stub_server.py, each in a fresh
+interpreter, and exits with status 1 if the median is over budget. The startup targets are STARTUP_IMPORT_BUDGET
+(0.6 s to import k456; scipy is only imported if the fsolve reference is used) and STARTUP_MAIN_TARGET (1.0 s from
+interpreter start to main() returning for one game on the stub).
+
+Usage:
+    python bench.py --events 20 --players 12 --books 6 --save bench_baseline.json
+    python bench.py --events 20 --players 12 --books 6 --compare bench_baseline.json
+    python bench.py --startup
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('ODDS_LOG_LEVEL', 'WARNING')  # Measure the code, not the debug logging
+import k456
+
+BENCH_MARKETS = ["player_threes", "player_assists"]
+BENCH_BOOKS = ["espnbet", "fliff", "draftkings", "fanduel", "betmgm", "williamhill_us", "betrivers", "pointsbetus"]
+REGRESSION_THRESHOLD = 0.2  # Fractional slowdown of p50 or throughput that counts as a regression
+STARTUP_IMPORT_BUDGET = 0.6  # Seconds allowed for a cold `import k456`
+STARTUP_MAIN_TARGET = 1.0  # Seconds allowed from interpreter start to a cold main() returning for one game on the stub
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_LOG_FILE = os.path.join(tempfile.gettempdir(), 'k456_bench.log')  # Never k456.LOG_FILE, the app.log capture replay.py reads
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import k456; print(time.perf_counter() - start)"
+MAIN_SCRIPT = """import time; start = time.perf_counter()
+import asyncio, k456
+k456.init_logging('bench.log')  # Relative to run_cold's scratch directory
+asyncio.run(k456.main('basketball_nba', ['fanduel', 'espnbet', 'fliff'], ['player_threes'], 'bench-key'))
+print(time.perf_counter() - start)"""
+
+def generate_slate(events=10, players=10, books=4, markets=None, seed=0):
+    """
+    Build a synthetic slate of event odds payloads.
+
+    Args:
+        events (int, optional): The number of events. Defaults to 10.
+        players (int, optional): The number of players with props per event. Defaults to 10.
+        books (int, optional): The number of bookmakers per event, taken from BENCH_BOOKS so the sharp books come first. Defaults to 4.
+        markets (list, optional): The market keys. Defaults to BENCH_MARKETS.
+        seed (int, optional): Seed for the prices. Defaults to 0.
+
+    Returns:
+        list: One dictionary per event with keys 'id', 'sport_key', 'commence_time' and 'bookmakers', as queued by the poller.
+    """
+    rng = random.Random(seed)
+    markets = markets or BENCH_MARKETS
+    bookmakers = [BENCH_BOOKS[i % len(BENCH_BOOKS)] if i < len(BENCH_BOOKS) else f"book{i}" for i in range(books)]
+    slate = []
+    for event in range(events):
+        eventid = f"{seed:04x}{event:028x}"
+        lines = {(market, player): rng.choice([0.5, 1.5, 2.5, 3.5, 4.5]) for market in markets for player in range(players)}
+        slate.append({
+            'id': eventid,
+            'sport_key': 'basketball_nba',
+            'commence_time': '2024-03-01T00:10:00Z',
+            'bookmakers': [
+                {'key': bookmaker, 'title': bookmaker.title(), 'markets': [
+                    {'key': market, 'last_update': f"2024-03-01T00:00:{event % 60:02d}Z", 'outcomes': [
+                        outcome
+                        for player in range(players)
+                        for outcome in synthetic_outcomes(rng, f"Player {player} Event {event}", lines[(market, player)])]}
+                    for market in markets]}
+                for bookmaker in bookmakers]
+        })
+    return slate
+
+def synthetic_outcomes(rng, description, point):
+    """
+    Returns:
+        list: The Over and Under outcomes of one player prop with a 3-8% overround.
+    """
+    probability = rng.uniform(0.3, 0.7)
+    vig = rng.uniform(1.03, 1.08)
+    return [{'name': 'Over', 'description': description, 'price': round(1 / (probability * vig), 2), 'point': point},
+            {'name': 'Under', 'description': description, 'price': round(1 / ((1 - probability) * vig), 2), 'point': point}]
+
+def percentile(samples, fraction):
+    """
+    Returns:
+        float: The nearest-rank percentile of samples, 0.0 if there are none.
+    """
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def measure(name, setup, run, repeat=3):
+    """
+    Time a stage and trace its peak memory.
+
+    Args:
+        name (str): The stage name.
+        setup (callable): Returns a fresh list of zero-argument calls for one round, so state does not leak between rounds.
+        run (callable): Takes one call from setup and performs it; this is what gets timed.
+        repeat (int, optional): Timed rounds. Defaults to 3.
+
+    Returns:
+        dict: The stage name, calls, seconds, throughput (calls per second), p50/p99 latency in microseconds and peak memory in KiB.
+    """
+    latencies = []
+    total = 0.0
+    for _ in range(repeat):
+        k456.devig_cache.clear()
+        calls = setup()
+        for call in calls:
+            start = time.perf_counter()
+            run(call)
+            elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            total += elapsed
+
+    # Memory is traced on a separate round so tracemalloc does not distort the timings
+    k456.devig_cache.clear()
+    calls = setup()
+    tracemalloc.start()
+    for call in calls:
+        run(call)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'stage': name,
+        'calls': len(latencies),
+        'seconds': total,
+        'throughput': len(latencies) / total if total else 0.0,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'peak_kib': peak / 1024,
+    }
+
+def market_payloads(slate):
+    """
+    Returns:
+        list: (market_data, eventid, bookmaker) for every market of every bookmaker in slate, sharp books first within each event.
+    """
+    return [(market_data, game['id'], bookmaker['key']) for game in slate for bookmaker in game['bookmakers'] for market_data in bookmaker['markets']]
+
+def sharp_price_pairs(slate):
+    """
+    Returns:
+        list: (price1, price2) of every Over/Under pair in slate.
+    """
+    pairs = []
+    for market_data, _, _ in market_payloads(slate):
+        outcomes = market_data['outcomes']
+        pairs.extend((outcomes[i]['price'], outcomes[i + 1]['price']) for i in range(0, len(outcomes), 2))
+    return pairs
+
+def bench_stages(slate, repeat=3, columnar=False):
+    """
+    Time every stage on slate.
+
+    Args:
+        slate (list): As returned by generate_slate.
+        repeat (int, optional): Timed rounds per stage. Defaults to 3.
+        columnar (bool, optional): Use columnar Market storage. Defaults to False.
+
+    Returns:
+        list: One result dictionary per stage, as returned by measure.
+    """
+    payloads = market_payloads(slate)
+    pairs = sharp_price_pairs(slate)
+    event_ids = {game['id'] for game in slate}
+    results = []
+
+    def fresh_market(market_key):
+        return k456.Market(market_key, market_key, 0, columnar=columnar)
+
+    def payload_calls():
+        markets = {}
+        return [(markets.setdefault(market_data['key'], fresh_market(market_data['key'])), market_data, eventid, bookmaker)
+                for market_data, eventid, bookmaker in payloads]
+
+    results.append(measure('decereal', payload_calls, lambda call: call[0].decereal(call[1], call[2], call[3]), repeat))
+
+    devig_market = fresh_market(BENCH_MARKETS[0])
+    results.append(measure('calculate', lambda: pairs, lambda pair: devig_market.calculate(*pair), repeat))
+    results.append(measure('calculate_batch', lambda: [pairs], devig_market.calculate_batch, repeat))
+    fsolve_pairs = pairs[:500]  # The fsolve reference is slow, a sample is enough to track it
+    results.append(measure('power_devig', lambda: fsolve_pairs, lambda pair: devig_market.power_devig(*pair), repeat))
+
+    results.append(measure('update_market_data', payload_calls, lambda call: call[0].update_market_data(call[1], call[2], call[3]), repeat))
+
+    def loaded_markets():
+        markets = {}
+        for market, market_data, eventid, bookmaker in payload_calls():
+            market.update_market_data(market_data, eventid, bookmaker)
+            markets[market.name] = market
+        return markets
+
+    def validate_calls(eventid_mode):
+        markets = loaded_markets()
+        return [(markets[market_key], game, game['id'] if eventid_mode else None) for game in slate for market_key in markets]
+
+    results.append(measure('validate_data', lambda: validate_calls(False), lambda call: call[0].validate_data(call[1], event_ids, call[2]), repeat))
+    results.append(measure('validate_data_event', lambda: validate_calls(True), lambda call: call[0].validate_data(call[1], event_ids, call[2]), repeat))
+
+    def end_to_end(manager_options):
+        async def run():
+            market_manager = k456.MarketManager(0, columnar=columnar, **manager_options)
+            update_task = asyncio.create_task(market_manager.update_market_data())
+            for game in slate:
+                await market_manager.put(game)
+            await market_manager.put(None)
+            await update_task
+            market_manager.close()
+        asyncio.run(run())
+
+    results.append(measure('end_to_end', lambda: [{'validate_mode': 'full'}], end_to_end, repeat))
+    results.append(measure('end_to_end_event', lambda: [{'validate_mode': 'event'}], end_to_end, repeat))
+    return results
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compare results against a saved baseline.
+
+    Args:
+        results (list): Stage results from bench_stages.
+        baseline (dict): A saved report with a 'stages' list.
+        threshold (float, optional): Allowed fractional slowdown. Defaults to REGRESSION_THRESHOLD.
+
+    Returns:
+        list: Human readable descriptions of the regressions, empty if there are none.
+    """
+    previous = {stage['stage']: stage for stage in baseline.get('stages', [])}
+    regressions = []
+    for stage in results:
+        before = previous.get(stage['stage'])
+        if before is None:
+            continue
+        if before['p50_us'] and stage['p50_us'] > before['p50_us'] * (1 + threshold):
+            regressions.append(f"{stage['stage']}: p50 {before['p50_us']:.1f}us -> {stage['p50_us']:.1f}us")
+        if before['throughput'] and stage['throughput'] < before['throughput'] / (1 + threshold):
+            regressions.append(f"{stage['stage']}: throughput {before['throughput']:.1f}/s -> {stage['throughput']:.1f}/s")
+    return regressions
+
+def run_cold(script, env=None, runs=5):
+    """
+    Run script in fresh interpreters with k456 importable and a scratch working directory, so app.log is not touched.
+
+    Returns:
+        list: The seconds each run printed.
+    """
+    env = {**os.environ, 'PYTHONPATH': PACKAGE_DIR, 'ODDS_LOG_LEVEL': 'WARNING', **(env or {})}
+    timings = []
+    with tempfile.TemporaryDirectory() as scratch:
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', script], cwd=scratch, env=env, capture_output=True, text=True, check=True)
+            timings.append(float(output.stdout.strip().splitlines()[-1]))
+    return timings
+
+def bench_startup(runs=5):
+    """
+    Time a cold import of k456 and a cold main() against a stub_server.py started for the purpose.
+
+    Returns:
+        list: One result dictionary per check with the median, every run and the budget.
+    """
+    import_times = run_cold(IMPORT_SCRIPT, runs=runs)
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    stub = subprocess.Popen([sys.executable, os.path.join(PACKAGE_DIR, 'stub_server.py'), '--port', str(port), '--events', '1', '--quota', '100000'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        main_times = run_cold(MAIN_SCRIPT, {'ODDS_API_BASE_URL': f"http://127.0.0.1:{port}/v4"}, runs)
+    finally:
+        stub.terminate()
+        stub.wait()
+    return [
+        {'check': 'import', 'median': statistics.median(import_times), 'runs': import_times, 'budget': STARTUP_IMPORT_BUDGET},
+        {'check': 'cold_main', 'median': statistics.median(main_times), 'runs': main_times, 'budget': STARTUP_MAIN_TARGET},
+    ]
+
+def print_report(results):
+    print(f"{'stage':<22}{'calls':>8}{'calls/s':>14}{'p50 us':>12}{'p99 us':>12}{'peak KiB':>12}")
+    for stage in results:
+        print(f"{stage['stage']:<22}{stage['calls']:>8}{stage['throughput']:>14.1f}{stage['p50_us']:>12.1f}{stage['p99_us']:>12.1f}{stage['peak_kib']:>12.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the ingest and devig stages on a synthetic slate.")
+    parser.add_argument('--events', type=int, default=10)
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--books', type=int, default=4)
+    parser.add_argument('--markets', default=",".join(BENCH_MARKETS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--columnar', action='store_true')
+    parser.add_argument('--save', help="Write the results to this JSON baseline")
+    parser.add_argument('--compare', help="Compare the results against this JSON baseline")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--startup', action='store_true', help="Check cold import and main() times against their budgets instead")
+    args = parser.parse_args()
+
+    if args.startup:
+        checks = bench_startup(args.repeat)
+        for check in checks:
+            print(f"{check['check']:<12}median {check['median']:.3f}s  budget {check['budget']:.3f}s  runs {', '.join(f'{run:.3f}' for run in check['runs'])}")
+        if any(check['median'] > check['budget'] for check in checks):
+            print("OVER BUDGET")
+            sys.exit(1)
+        sys.exit(0)
+
+    k456.init_logging(BENCH_LOG_FILE)
+
+    slate = generate_slate(args.events, args.players, args.books, args.markets.split(','), args.seed)
+    results = bench_stages(slate, args.repeat, args.columnar)
+    print_report(results)
+    report = {
+        'slate': {'events': args.events, 'players': args.players, 'books': args.books, 'markets': args.markets.split(','), 'seed': args.seed, 'columnar': args.columnar},
+        'python': platform.python_version(),
+        'stages': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Saved baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('slate') != report['slate']:
+            print(f"Warning: baseline slate {baseline.get('slate')} differs from this run's {report['slate']}")
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
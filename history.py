@@ -0,0 +1,299 @@
+"""
+Append-only columnar store of every odds change k456.py ingests, for line-movement queries.
+
+A store is a directory holding one raw array file per column (timestamp, event, market, bookmaker, player, side,
+point, price), a string table and two indexes:
+    - timestamps are written in non-decreasing order, so a time range is a binary search over the timestamp column;
+    - every flushed block of rows adds one (event, first row, end row) entry per event in it to events.idx, so an
+      event's rows are found without scanning blocks it never appeared in.
+Readers memory-map the files, so a query only pages in the blocks it touches and never waits on the writer. A write
+that was cut short is trimmed back to the last complete row the next time the store is opened.
+
+A row older than the last one written is stored at the last timestamp written instead of its own, so the timestamp
+column stays sorted: a late row's time is clamped forward, never kept out of order.
+
+Usage:
+    python history.py odds_history --event <event id> --market player_threes --player "jayson tatum"
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+HISTORY_COLUMNS = (('timestamp', 'f8'), ('event', 'u4'), ('market', 'u4'), ('bookmaker', 'u4'), ('player', 'u4'),
+                   ('side', 'u4'), ('point', 'f8'), ('price', 'f8'))
+STRING_COLUMNS = ('event', 'market', 'bookmaker', 'player', 'side')
+INDEX_DTYPE = np.dtype([('event', 'u4'), ('start', 'u8'), ('end', 'u8')])
+SEED_ROWS = 1000000  # Rows at the end of the store read to seed changes_only when it is opened for writing
+history_logger = logging.getLogger('odds.history')
+
+class OddsHistory:
+    """
+    Writer and reader of one history directory. append is safe to call from a worker thread while queries run, and
+    any number of read-only instances can query a store one writer appends to.
+    """
+    def __init__(self, path, changes_only=True, writable=True):
+        """
+        Args:
+            path (str): The store directory, created if it does not exist and writable is True.
+            changes_only (bool, optional): Only write a price when it differs from the last one written for its
+                                           outcome. The last prices are seeded from the final SEED_ROWS rows already
+                                           in the store, so a restart does not write them again. Defaults to True.
+            writable (bool, optional): Open the store for appending, trimming any write that was cut short. Readers
+                                       of a store another process appends to pass False. Defaults to True.
+        """
+        self.path = path
+        self.changes_only = changes_only
+        self.writable = writable
+        self.lock = threading.Lock()
+        self.last_prices = {}  # (event, market, bookmaker, player, side, point) ids: last price written
+        self.strings = []
+        self.string_ids = {}
+        self.strings_offset = 0  # Bytes of strings.jsonl read so far
+        if writable:
+            os.makedirs(path, exist_ok=True)
+        self.refresh()
+        if writable:
+            strings_path = os.path.join(path, 'strings.jsonl')
+            if os.path.exists(strings_path):
+                os.truncate(strings_path, self.strings_offset)
+            for column, dtype in HISTORY_COLUMNS:
+                column_path = self.column_path(column)
+                if os.path.exists(column_path):
+                    os.truncate(column_path, self.rows * np.dtype(dtype).itemsize)
+            index = self.event_index()
+            if len(index):
+                os.truncate(os.path.join(path, 'events.idx'), int(np.searchsorted(index['end'], self.rows, side='right')) * INDEX_DTYPE.itemsize)
+        self.last_timestamp = float(self.column('timestamp')[-1]) if self.rows else 0.0
+        if writable and changes_only:
+            self.seed_last_prices()
+
+    def seed_last_prices(self, rows=SEED_ROWS):
+        """
+        Fill last_prices with the latest price of every outcome in the last rows of the store.
+        """
+        first = max(0, self.rows - rows)
+        if first == self.rows:
+            return
+        keys = np.empty(self.rows - first, dtype=[(column, 'u4') for column in STRING_COLUMNS] + [('point', 'u8')])
+        for column in STRING_COLUMNS:
+            keys[column] = self.column(column)[first:]
+        keys['point'] = self.column('point')[first:].view('u8')  # Bits, so every missing point (NaN) is the same key
+        _, latest = np.unique(np.ascontiguousarray(keys[::-1]).view(f'V{keys.dtype.itemsize}'), return_index=True)  # Raw bytes sort far faster than fields
+        latest = len(keys) - 1 - latest
+        points = self.column('point')[first:][latest].tolist()
+        prices = self.column('price')[first:][latest].tolist()
+        ids = zip(*(self.column(column)[first:][latest].tolist() for column in STRING_COLUMNS))
+        for key_ids, point, price in zip(ids, points, prices):
+            self.last_prices[(*key_ids, None if point != point else point)] = price
+        history_logger.debug("Seeded the last price of %s outcomes from %s rows of %s.", len(self.last_prices), len(keys), self.path)
+
+    def refresh(self):
+        """
+        Pick up the rows and strings appended since the store was opened or last refreshed.
+        """
+        self.rows = self.row_count()  # Counted before the strings, which are always written ahead of their rows
+        strings_path = os.path.join(self.path, 'strings.jsonl')
+        if not os.path.exists(strings_path):
+            return
+        with open(strings_path, 'rb') as strings_file:
+            strings_file.seek(self.strings_offset)
+            for line in strings_file:
+                if not line.endswith(b'\n'):  # A string cut short by a crash, or still being written
+                    break
+                value = json.loads(line)
+                self.string_ids[value] = len(self.strings)
+                self.strings.append(value)
+                self.strings_offset += len(line)
+
+    def column_path(self, column):
+        return os.path.join(self.path, f"{column}.col")
+
+    def event_index(self):
+        """
+        Returns:
+            numpy.ndarray: A read-only memory map of every complete events.idx entry.
+        """
+        index_path = os.path.join(self.path, 'events.idx')
+        entries = os.path.getsize(index_path) // INDEX_DTYPE.itemsize if os.path.exists(index_path) else 0
+        if not entries:
+            return np.empty(0, dtype=INDEX_DTYPE)
+        return np.memmap(index_path, dtype=INDEX_DTYPE, mode='r', shape=(entries,))
+
+    def row_count(self):
+        """
+        Returns:
+            int: The number of complete rows: every column holds them and the index covers them.
+        """
+        index = self.event_index()
+        counts = [int(index['end'][-1]) if len(index) else 0]
+        for column, dtype in HISTORY_COLUMNS:
+            column_path = self.column_path(column)
+            counts.append(os.path.getsize(column_path) // np.dtype(dtype).itemsize if os.path.exists(column_path) else 0)
+        return min(counts)
+
+    def column(self, column, rows=None):
+        """
+        Returns:
+            numpy.ndarray: A read-only memory map of the first rows of column, by default every complete row.
+        """
+        rows = self.rows if rows is None else rows
+        dtype = dict(HISTORY_COLUMNS)[column]
+        if not rows:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.column_path(column), dtype=dtype, mode='r', shape=(rows,))
+
+    def intern(self, value, new_strings):
+        value_id = self.string_ids.get(value)
+        if value_id is None:
+            value_id = self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+            new_strings.append(value)
+        return value_id
+
+    def append(self, rows):
+        """
+        Append rows and index them as one block.
+
+        Args:
+            rows (iterable): (timestamp, event, market, bookmaker, player, side, point, price) tuples in time order.
+                             point may be None. A row without a price is skipped, and a row older than the
+                             last one written is stored at that timestamp instead.
+
+        Returns:
+            int: The number of rows written, after skipping unchanged and missing prices.
+        """
+        with self.lock:
+            new_strings = []
+            columns = {column: [] for column, _ in HISTORY_COLUMNS}
+            for timestamp, *strings, point, price in rows:
+                if price is None:
+                    continue
+                # Skipped rows are decided on the ids already known, so only the strings of written rows are interned
+                ids = [self.string_ids.get(value) for value in strings]
+                if None in ids:  # An unseen string, so the outcome has no last price yet
+                    ids = [self.intern(value, new_strings) for value in strings]
+                elif self.changes_only and self.last_prices.get((*ids, point)) == price:
+                    continue
+                if self.changes_only:
+                    self.last_prices[(*ids, point)] = price
+                self.last_timestamp = max(self.last_timestamp, timestamp)  # Keeps the timestamp column sorted
+                columns['timestamp'].append(self.last_timestamp)
+                for column, value_id in zip(STRING_COLUMNS, ids):
+                    columns[column].append(value_id)
+                columns['point'].append(float('nan') if point is None else point)
+                columns['price'].append(price)
+            written = len(columns['timestamp'])
+            if not written:
+                return 0
+
+            # Strings first and the index last, so every complete row only refers to strings and rows already on disk
+            if new_strings:
+                with open(os.path.join(self.path, 'strings.jsonl'), 'a', encoding='utf-8') as strings_file:
+                    strings_file.write(''.join(json.dumps(value) + '\n' for value in new_strings))
+            for column, dtype in HISTORY_COLUMNS:
+                with open(self.column_path(column), 'ab') as column_file:
+                    np.asarray(columns[column], dtype=dtype).tofile(column_file)
+            events = np.asarray(columns['event'], dtype='u4')
+            event_ids, first = np.unique(events, return_index=True)
+            last = len(events) - np.unique(events[::-1], return_index=True)[1]
+            index = np.empty(len(event_ids), dtype=INDEX_DTYPE)
+            index['event'] = event_ids
+            index['start'] = self.rows + first
+            index['end'] = self.rows + last
+            index.sort(order='end')  # The last entry ends the block, which is how readers know the block is complete
+            with open(os.path.join(self.path, 'events.idx'), 'ab') as index_file:
+                index_file.write(index.tobytes())
+            self.rows += written
+            history_logger.debug("Appended %s rows to %s, %s in total.", written, self.path, self.rows)
+            return written
+
+    def query(self, event=None, market=None, bookmaker=None, player=None, side=None, start=None, end=None):
+        """
+        Find the rows matching every given filter.
+
+        Args:
+            event (str, optional): The event id.
+            market (str, optional): The market key.
+            bookmaker (str, optional): The bookmaker key.
+            player (str, optional): The outcome description, i.e. the player.
+            side (str, optional): The outcome name, e.g. 'over'.
+            start (float, optional): The earliest unix timestamp.
+            end (float, optional): The unix timestamp the rows must be before.
+
+        Returns:
+            list: (timestamp, event, market, bookmaker, player, side, point, price) tuples in time order. point is None
+                  when the outcome has none.
+        """
+        if not self.writable:
+            self.refresh()
+        rows = self.rows
+        filters = {'event': event, 'market': market, 'bookmaker': bookmaker, 'player': player, 'side': side}
+        ids = {}
+        for column, value in filters.items():
+            if value is not None:
+                if value not in self.string_ids:
+                    return []
+                ids[column] = self.string_ids[value]
+        timestamps = self.column('timestamp', rows)
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        stop = rows if end is None else int(np.searchsorted(timestamps, end, side='left'))
+        if first >= stop:
+            return []
+
+        if 'event' in ids:
+            index = self.event_index()
+            blocks = index[(index['event'] == ids['event']) & (index['start'] < stop) & (index['end'] > first)]
+            selected = [np.arange(max(block_start, first), min(block_end, stop)) for block_start, block_end in zip(blocks['start'].tolist(), blocks['end'].tolist())]
+            selected = np.concatenate(selected) if selected else np.empty(0, dtype=np.int64)
+        else:
+            selected = np.arange(first, stop)
+        for column, value_id in ids.items():
+            selected = selected[self.column(column, rows)[selected] == value_id]
+
+        strings = self.strings
+        columns = [self.column(column, rows)[selected].tolist() for column, _ in HISTORY_COLUMNS]
+        return [(timestamp, strings[event_id], strings[market_id], strings[bookmaker_id], strings[player_id], strings[side_id], None if point != point else point, price)
+                for timestamp, event_id, market_id, bookmaker_id, player_id, side_id, point, price in zip(*columns)]
+
+    def line_movement(self, event, market, player, side, bookmaker=None, start=None, end=None):
+        """
+        Returns:
+            dict: (bookmaker, point): list of (timestamp, price) for one side of a player's market, in time order.
+        """
+        movement = {}
+        for timestamp, _, _, row_bookmaker, _, _, point, price in self.query(event, market, bookmaker, player, side, start, end):
+            movement.setdefault((row_bookmaker, point), []).append((timestamp, price))
+        return movement
+
+    def stats(self):
+        """
+        Returns:
+            dict: The rows, strings and bytes held by the store.
+        """
+        size = sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path))
+        return {'rows': self.rows, 'strings': len(self.strings), 'bytes': size}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query an odds history store.")
+    parser.add_argument('path', help="The history directory, e.g. the one ODDS_HISTORY_PATH points at")
+    parser.add_argument('--event')
+    parser.add_argument('--market')
+    parser.add_argument('--bookmaker')
+    parser.add_argument('--player')
+    parser.add_argument('--side')
+    parser.add_argument('--start', type=float, help="Unix timestamp")
+    parser.add_argument('--end', type=float, help="Unix timestamp")
+    args = parser.parse_args()
+
+    history = OddsHistory(args.path, writable=False)
+    started = time.perf_counter()
+    found = history.query(args.event, args.market, args.bookmaker, args.player, args.side, args.start, args.end)
+    elapsed = time.perf_counter() - started
+    for row in found:
+        print(*row, sep='\t')
+    print(f"{len(found)} rows in {elapsed * 1000:.2f} ms. Store: {history.stats()}")
@@ -1,17 +1,464 @@
 import aiohttp
 import asyncio
 import logging
+import hashlib
+import os
+import signal
+import sys
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
 from cachetools import TTLCache
+from history import OddsHistory
 total_delay_time = 0
-total_delay_time_lock = asyncio.Lock()
-# Configure logging
-logging.basicConfig(filename='app.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
-from scipy.optimize import fsolve
+total_delay_time_lock = None  # Created by get_total_delay_time_lock on first use, not at import
+# Logging is configured by init_logging. ODDS_LOG_LEVEL=INFO or higher makes every hot-path debug call a cheap level check.
+LOG_LEVEL = os.environ.get('ODDS_LOG_LEVEL', 'DEBUG').upper()
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get('ODDS_LOG_PAYLOAD_SAMPLE', '0.01'))  # Fraction of full payload dumps written at DEBUG
+LOG_FILE = 'app.log'
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logger = logging.getLogger('odds')
+fetch_logger = logging.getLogger('odds.fetch')  # HTTP requests, API keys and quota
+ingest_logger = logging.getLogger('odds.ingest')  # Queue consumer, decereal and validation
+devig_logger = logging.getLogger('odds.devig')  # Pairing, devig calculations and results
+payload_log_counts = {}  # Payload dump message: number of times it was requested. Racing shard threads can only skew the sampling
+
+def init_logging(filename=LOG_FILE, filemode='w', level=LOG_LEVEL):
+    """
+    Configure the root logger to write to filename. Importing k456 does not touch logging; entry points call this.
+    Does nothing if the root logger already has handlers.
+
+    Args:
+        filename (str, optional): The log file. Defaults to LOG_FILE.
+        filemode (str, optional): 'w' to start a fresh log, 'a' to append, e.g. from worker processes. Defaults to 'w'.
+        level (str, optional): The level name. Defaults to LOG_LEVEL.
+    """
+    logging.basicConfig(filename=filename, filemode=filemode, format=LOG_FORMAT, level=getattr(logging, level, logging.DEBUG))
+
+def get_total_delay_time_lock():
+    """
+    Returns:
+        asyncio.Lock: The lock guarding total_delay_time, created on first use.
+    """
+    global total_delay_time_lock
+    if total_delay_time_lock is None:
+        total_delay_time_lock = asyncio.Lock()
+    return total_delay_time_lock
+
+def log_payload(subsystem_logger, msg, *args):
+    """
+    Log a full payload dump at DEBUG for a sample of calls only.
+
+    Nothing is formatted unless DEBUG is enabled for subsystem_logger, and then only every
+    round(1 / PAYLOAD_LOG_SAMPLE_RATE)-th dump of each message is written.
+
+    Args:
+        subsystem_logger (logging.Logger): The logger to write to.
+        msg (str): The %-style message.
+        *args: The message arguments, typically the payload itself.
+    """
+    if PAYLOAD_LOG_SAMPLE_RATE <= 0 or not subsystem_logger.isEnabledFor(logging.DEBUG):
+        return
+    count = payload_log_counts.get(msg, 0)
+    payload_log_counts[msg] = count + 1
+    if count % max(1, round(1 / PAYLOAD_LOG_SAMPLE_RATE)) == 0:
+        subsystem_logger.debug(msg, *args)
+import numpy as np
+from array import array
 
 sharpbookkeys = {"player_assists": ["draftkings"], "player_threes": ["espnbet","fliff"]}
+POWER_DEVIG_TOLERANCE = 1e-12  # Convergence tolerance on the power exponent for the batched solver
+POWER_DEVIG_MAX_ITER = 50
+DRAIN_BATCH_SIZE = 64  # Most queue items MarketManager.update_market_data processes per wakeup
+MARKET_WORKERS = int(os.environ.get('ODDS_MARKET_WORKERS', '0'))  # Shard markets over this many workers, 0 processes them inline
+MARKET_WORKER_MODE = os.environ.get('ODDS_MARKET_WORKER_MODE', 'thread')  # 'thread' or 'process'
+DEVIG_OFFLOAD = os.environ.get('ODDS_DEVIG_OFFLOAD', 'off')  # 'item' or 'window' sends devig batches to a process pool, 'off' devigs inline
+DEVIG_WORKERS = int(os.environ.get('ODDS_DEVIG_WORKERS', '0')) or None  # Devig pool size, None for one process per core
+QUEUE_MAXSIZE = int(os.environ.get('ODDS_QUEUE_MAXSIZE', '0'))  # Queue items MarketManager holds before producers wait or drop, 0 for no limit
+QUEUE_POLICY = os.environ.get('ODDS_QUEUE_POLICY', 'block')  # What a full queue does to a producer: 'block' it or 'drop_oldest' item
+DEVIG_WINDOW = 0.05  # Seconds the 'window' offload mode waits for more queue items before sending one devig batch
+DEVIG_CACHE_MAXSIZE = 20000  # Distinct (method, price1, price2, tolerance) entries kept by the process-wide devig memo
+DEVIG_CACHE_TTL = 3600
+
+class DevigCache:
+    """
+    Process-wide memo of devig results keyed on (method, price1, price2, tolerance).
+
+    Sharp-book lines such as 1.87/1.95 repeat across players, events and polls, so a hit skips the
+    solver completely. Devig results are pure functions of the prices and the solver tolerance; the TTL
+    only bounds memory. Thread workers share the memo, and TTLCache is not thread-safe, so every access holds a lock.
+    """
+    def __init__(self, maxsize=DEVIG_CACHE_MAXSIZE, ttl=DEVIG_CACHE_TTL, bypass=False):
+        """
+        Args:
+            maxsize (int, optional): The maximum number of cached results. Defaults to DEVIG_CACHE_MAXSIZE.
+            ttl (float, optional): Seconds a cached result is kept. Defaults to DEVIG_CACHE_TTL.
+            bypass (bool, optional): If True, every lookup misses and nothing is stored. Defaults to False.
+        """
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, maxsize=None, ttl=None, bypass=None):
+        """
+        Change the size, TTL or bypass flag. Changing size or TTL drops the cached results.
+        """
+        if maxsize is not None or ttl is not None:
+            with self.lock:
+                self.cache = TTLCache(maxsize=maxsize if maxsize is not None else self.cache.maxsize,
+                                      ttl=ttl if ttl is not None else self.cache.ttl)
+        if bypass is not None:
+            self.bypass = bypass
+
+    def get(self, method, price1, price2, tolerance=None):
+        """
+        Returns:
+            tuple: The cached result for (method, price1, price2, tolerance), or None on a miss. tolerance is the solver
+                   tolerance the result was computed with, None for closed-form methods.
+        """
+        with self.lock:
+            if self.bypass:
+                self.misses += 1
+                return None
+            result = self.cache.get((method, price1, price2, tolerance))
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def set(self, method, price1, price2, result, tolerance=None):
+        if not self.bypass:
+            with self.lock:
+                self.cache[(method, price1, price2, tolerance)] = result
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: The hit and miss counters, hit rate and current size of the memo.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self.cache),
+                'bypass': self.bypass
+            }
+
+devig_cache = DevigCache()
+
+OPPOSITE_NAMES = {"over": "under", "under": "over", "yes": "no", "no": "yes"}
+SANITIZE_CACHE_MAXSIZE = 100000
+sanitized_strings = {}  # Raw string: sanitized, interned string. Single dict operations are atomic, so shard threads share it unlocked
+
+def sanitize_string(string):
+    """
+    Sanitize a string to be uniform. Results are memoized and interned, so the same player or outcome name
+    is lowercased once and every outcome shares a single string object.
+
+    Args:
+        string (str): The string to sanitize.
+
+    Returns:
+        str: The sanitized string.
+    """
+    sanitized_string = sanitized_strings.get(string)
+    if sanitized_string is None:
+        if len(sanitized_strings) >= SANITIZE_CACHE_MAXSIZE:
+            sanitized_strings.clear()
+        # Implement your sanitization logic here
+        sanitized_string = sanitized_strings[string] = sys.intern(string.lower().strip())
+    return sanitized_string
+
+class OutcomePair:
+    """
+    Both sides of a two-way outcome (over/under or yes/no) from one bookmaker,
+    keyed in Market.pairs by (eventid, description, point).
+    """
+    __slots__ = ('prices',)
+
+    def __init__(self):
+        self.prices = {}  # outcome name: price
+
+    def opposite_price(self, name):
+        """
+        Returns:
+            float: The price of the side opposite to name, or None if that side has not been seen.
+        """
+        return self.prices.get(OPPOSITE_NAMES.get(name))
+
+    def is_complete(self):
+        return len(self.prices) == 2
+
+    def __repr__(self):
+        return f"OutcomePair({self.prices})"
+
+class InternTable:
+    """
+    Maps strings to small integer ids and back.
+    """
+    __slots__ = ('ids', 'values')
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def intern(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def __len__(self):
+        return len(self.values)
+
+class ColumnarOutcomeStore:
+    """
+    Array-backed replacement for the Market.bookmakers dict of dicts of dicts.
+
+    Events, outcome names, players and bookmakers are interned to integer ids, prices and points live in
+    array('d') columns and a hash index maps each packed outcome key to its row. Reads mirror the dict layout:
+    store[bookmaker][(eventid, outcome_name, outcome_description, outcome_point)][bookmaker] -> price.
+    """
+    def __init__(self):
+        self.events = InternTable()
+        self.names = InternTable()
+        self.players = InternTable()
+        self.book_names = InternTable()
+        self.book_ids = array('I')
+        self.event_ids = array('I')
+        self.name_ids = array('I')
+        self.player_ids = array('I')
+        self.points = array('d')  # nan when the outcome has no point
+        self.prices = array('d')
+        self.index = {}  # packed outcome key: row
+        self.book_rows = []  # book id: array('I') of rows
+
+    @staticmethod
+    def pack_key(book_id, event_id, name_id, player_id, point):
+        point_code = 0 if point is None else round(point * 1000) + (1 << 31)
+        return (((book_id << 32 | event_id) << 32 | name_id) << 32 | player_id) << 32 | point_code
+
+    def row_for(self, bookmaker, outcome_key):
+        """
+        Returns:
+            int: The row holding outcome_key for bookmaker, or None if it has never been stored.
+        """
+        book_id = self.book_names.ids.get(bookmaker)
+        event_id = self.events.ids.get(outcome_key[0])
+        name_id = self.names.ids.get(outcome_key[1])
+        player_id = self.players.ids.get(outcome_key[2])
+        if book_id is None or event_id is None or name_id is None or player_id is None:
+            return None
+        return self.index.get(self.pack_key(book_id, event_id, name_id, player_id, outcome_key[3]))
+
+    def set_price(self, bookmaker, outcome_key, price):
+        """
+        Store price for outcome_key from bookmaker, overwriting any previous price.
+        """
+        eventid, name, description, point = outcome_key
+        book_id = self.book_names.intern(bookmaker)
+        event_id = self.events.intern(eventid)
+        name_id = self.names.intern(name)
+        player_id = self.players.intern(description)
+        packed = self.pack_key(book_id, event_id, name_id, player_id, point)
+        row = self.index.get(packed)
+        if row is not None:
+            self.prices[row] = price
+            return
+        row = self.index[packed] = len(self.prices)
+        self.book_ids.append(book_id)
+        self.event_ids.append(event_id)
+        self.name_ids.append(name_id)
+        self.player_ids.append(player_id)
+        self.points.append(float('nan') if point is None else point)
+        self.prices.append(price)
+        if book_id == len(self.book_rows):
+            self.book_rows.append(array('I'))
+        self.book_rows[book_id].append(row)
+
+    def get_price(self, bookmaker, outcome_key, default=None):
+        row = self.row_for(bookmaker, outcome_key)
+        return default if row is None else self.prices[row]
+
+    def outcome_key(self, row):
+        """
+        Returns:
+            tuple: The (eventid, outcome_name, outcome_description, outcome_point) key stored in row.
+        """
+        point = self.points[row]
+        return (self.events.values[self.event_ids[row]], self.names.values[self.name_ids[row]],
+                self.players.values[self.player_ids[row]], None if point != point else point)
+
+    def __contains__(self, bookmaker):
+        return bookmaker in self.book_names.ids
+
+    def __getitem__(self, bookmaker):
+        book_id = self.book_names.ids.get(bookmaker)
+        if book_id is None:
+            raise KeyError(bookmaker)
+        return ColumnarBookView(self, book_id)
+
+    def get(self, bookmaker, default=None):
+        return self[bookmaker] if bookmaker in self else default
+
+    def __iter__(self):
+        return iter(self.book_names.values)
+
+    def __len__(self):
+        return len(self.book_names)
+
+    def keys(self):
+        return list(self.book_names.values)
+
+    def items(self):
+        return [(bookmaker, ColumnarBookView(self, book_id)) for book_id, bookmaker in enumerate(self.book_names.values)]
+
+    def without_events(self, eventids):
+        """
+        Returns:
+            ColumnarOutcomeStore: A compacted copy holding every row except those of eventids.
+        """
+        store = ColumnarOutcomeStore()
+        for book_id, bookmaker in enumerate(self.book_names.values):
+            for row in self.book_rows[book_id]:
+                outcome_key = self.outcome_key(row)
+                if outcome_key[0] not in eventids:
+                    store.set_price(bookmaker, outcome_key, self.prices[row])
+        return store
+
+    def nbytes(self):
+        """
+        Returns:
+            int: The bytes held by the column arrays, excluding the intern tables and row index.
+        """
+        columns = (self.book_ids, self.event_ids, self.name_ids, self.player_ids, self.points, self.prices)
+        return sum(column.itemsize * len(column) for column in columns) + sum(rows.itemsize * len(rows) for rows in self.book_rows)
+
+    def __repr__(self):
+        return repr({bookmaker: dict(view.items()) for bookmaker, view in self.items()})
+
+class ColumnarBookView:
+    """
+    Read-only view of one bookmaker's rows in a ColumnarOutcomeStore, shaped like {outcome_key: {bookmaker: price}}.
+    """
+    __slots__ = ('store', 'book_id')
+
+    def __init__(self, store, book_id):
+        self.store = store
+        self.book_id = book_id
+
+    def _row(self, outcome_key):
+        return self.store.row_for(self.store.book_names.values[self.book_id], outcome_key)
+
+    def __contains__(self, outcome_key):
+        return self._row(outcome_key) is not None
+
+    def __getitem__(self, outcome_key):
+        row = self._row(outcome_key)
+        if row is None:
+            raise KeyError(outcome_key)
+        return {self.store.book_names.values[self.book_id]: self.store.prices[row]}
+
+    def get(self, outcome_key, default=None):
+        row = self._row(outcome_key)
+        return default if row is None else {self.store.book_names.values[self.book_id]: self.store.prices[row]}
+
+    def __iter__(self):
+        return (self.store.outcome_key(row) for row in self.store.book_rows[self.book_id])
+
+    def __len__(self):
+        return len(self.store.book_rows[self.book_id])
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        bookmaker = self.store.book_names.values[self.book_id]
+        return [(self.store.outcome_key(row), {bookmaker: self.store.prices[row]}) for row in self.store.book_rows[self.book_id]]
+
+def power_devig_batch(prices1, prices2, tol=POWER_DEVIG_TOLERANCE, max_iter=POWER_DEVIG_MAX_ITER):
+    """
+    Power devig a whole batch of two-way prices at once.
+
+    Solves ri1**(1/k) + ri2**(1/k) = 1 for every pair in one vectorized Newton pass on x = 1/k.
+    g(x) = ri1**x + ri2**x - 1 is decreasing in x, so each pair keeps a [lo, hi] bracket and falls
+    back to bisection whenever a Newton step leaves it. Matches the fsolve solution in
+    Market.power_devig to well within 1e-9.
+
+    Args:
+        prices1 (array-like): The decimal prices of the first outcome of each pair.
+        prices2 (array-like): The decimal prices of the second outcome of each pair.
+        tol (float, optional): Convergence tolerance on x. Defaults to POWER_DEVIG_TOLERANCE.
+        max_iter (int, optional): The maximum number of iterations. Defaults to POWER_DEVIG_MAX_ITER.
+
+    Returns:
+        tuple: Two numpy arrays with the devigged decimal odds of the first and second outcomes.
+               Pairs containing a price <= 1 come back as nan.
+    """
+    price1 = np.asarray(prices1, dtype=float)
+    price2 = np.asarray(prices2, dtype=float)
+    valid = (price1 > 1) & (price2 > 1)
+    log1 = np.log(np.where(valid, 1 / np.where(valid, price1, 2.0), 0.5))
+    log2 = np.log(np.where(valid, 1 / np.where(valid, price2, 2.0), 0.5))
+
+    # g(0) = 1 > 0 and g(x) <= 0 as soon as the larger ri**x drops to 0.5
+    lo = np.zeros_like(log1)
+    hi = np.log(0.5) / np.maximum(log1, log2)
+    x = np.ones_like(log1)
+    for _ in range(max_iter):
+        p1 = np.exp(x * log1)
+        p2 = np.exp(x * log2)
+        g = p1 + p2 - 1
+        lo = np.where(g > 0, x, lo)
+        hi = np.where(g < 0, x, hi)
+        x_new = x - g / (p1 * log1 + p2 * log2)
+        x_new = np.where((x_new < lo) | (x_new > hi), (lo + hi) / 2, x_new)
+        converged = np.abs(x_new - x) <= tol * np.maximum(1.0, np.abs(x))
+        x = x_new
+        if converged.all():
+            break
+
+    actualoverdecimal = np.where(valid, 1 / np.exp(x * log1), np.nan)
+    actualunderdecimal = np.where(valid, 1 / np.exp(x * log2), np.nan)
+    return actualoverdecimal, actualunderdecimal
+
+def devig_batch_job(prices1, prices2, tol=POWER_DEVIG_TOLERANCE):
+    """
+    Power and mult devig a batch of two-way prices. Runs in a devig worker process, so it only takes and returns plain lists.
+
+    Args:
+        prices1 (list): The decimal prices of the first outcome of each pair.
+        prices2 (list): The decimal prices of the second outcome of each pair.
+        tol (float, optional): Convergence tolerance for power_devig_batch. Defaults to POWER_DEVIG_TOLERANCE.
+
+    Returns:
+        tuple: Lists of power devig and mult devig (over, under) results, one per pair.
+    """
+    poweroverdecimal, powerunderdecimal = power_devig_batch(prices1, prices2, tol=tol)
+    compoverimplied = 1 / np.asarray(prices1, dtype=float)
+    compunderimplied = 1 / np.asarray(prices2, dtype=float)
+    multoverdecimal = compoverimplied / (compoverimplied + compunderimplied)
+    multunderdecimal = compunderimplied / (compunderimplied + compoverimplied)
+    return (list(zip(poweroverdecimal.tolist(), powerunderdecimal.tolist())),
+            list(zip(multoverdecimal.tolist(), multunderdecimal.tolist())))
 
 class Market:
-    def __init__(self, id: str, name: str, min_bookmakers: int):
+    def __init__(self, id: str, name: str, min_bookmakers: int, columnar: bool = False):
         """
         Initialize a new 'Market' object.
         
@@ -19,69 +466,107 @@ class Market:
             id (str): The unique identifier of the market.
             name (str): The descriptive name of the market.
             min_bookmakers (int): The minimum number of bookmakers required for the market.
+            columnar (bool, optional): Store prices in a ColumnarOutcomeStore instead of nested dicts. Defaults to False.
         """
         global sharpbookkeys
         self.id = id
         self.name = name
-        self.bookmakers = {}  # This will now store bookmaker: {outcome: data} //redo all as sets()? no dicts
+        self.columnar = columnar
+        # This will now store bookmaker: {outcome: data} //redo all as sets()? no dicts
+        self.bookmakers = ColumnarOutcomeStore() if columnar else {}
         self.sharpbookkey = sharpbookkeys.get(name, ['draftkings'])  # update with flag marked from main()
-        logging.debug(f"SHARPBOOKKEY FOR {self.name}: {self.sharpbookkey}")
+        ingest_logger.debug("SHARPBOOKKEY FOR %s: %s", self.name, self.sharpbookkey)
         self.MIN_BOOKMAKERS=2
         self.compared_games_count = 0
-        self.power_devig_cache = TTLCache(maxsize=1000, ttl=300)  # Cache for power_devig calculation//autoaverage
+        self.power_devig_cache = devig_cache  # Process-wide devig memo shared by every Market
         self.synthetic_market_info = {} 
         self.results = {} 
+        self.pairs = {}  # bookmaker: {(eventid, outcome_description, outcome_point): OutcomePair}, filled by decereal. Empty when columnar.
+        self.bookmaker_set = set()  # Bookmakers with stored outcomes, kept up to date on ingest for validate_data
+        self.event_bookmakers = {}  # eventid: set of bookmakers with stored outcomes for that event
+        self.devig_tolerance = POWER_DEVIG_TOLERANCE
+
+    def __getstate__(self):
+        # The process-wide devig memo stays behind when a Market is pickled, e.g. out of a worker process
+        state = self.__dict__.copy()
+        del state['power_devig_cache']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.power_devig_cache = devig_cache
 
     def calculate_and_emit_outcomes(self):
         
         # Placeholder for a method to calculate and emit outcomes
-        logging.debug("calculate_and_emit_outcomes method called.")
+        ingest_logger.debug("calculate_and_emit_outcomes method called.")
         
-    def validate_data(self, game_data):
+    def validate_data(self, game_data, game_events=None, eventid=None):
         """
         Validates the game data against the Market object's bookmakers data.
         
         This method checks if the bookmakers and events in the game data match the bookmakers and events in the Market object.
         If there is a mismatch, it logs a warning and returns False. If the data matches, it returns True.
+        The Market side is read from self.bookmaker_set and self.event_bookmakers, which update_market_data keeps up to date,
+        so the cost depends on the number of events and bookmakers rather than the number of stored outcomes.
         
         Args:
-            game_data (dict): The game data to validate. It's a dictionary with keys 'bookmakers' and 'events'.
+            game_data (GameUpdate or dict): The game data to validate. A dictionary has keys 'bookmakers' and 'events'.
                                 'bookmakers' is a list of dictionaries with key 'key'.
                                 'events' is a list of dictionaries with key 'id'.
+            game_events (set, optional): The event ids the caller has ingested. Defaults to the ids under game_data['events'].
+            eventid (str, optional): If given, only validate this event: every bookmaker in game_data that offers this market
+                                     must have been recorded for it. The cost is then independent of the size of the market.
         
         Returns:
             bool: True if the game data matches the Market object's data, False otherwise.
         """
-        logging.debug("Starting data validation.")
+        ingest_logger.debug("Starting data validation.")
         
         # Extract the bookmakers and events from the game data
-        game_bookmakers = [bookmaker['key'] for bookmaker in game_data.get('bookmakers', [])]
-        game_events = [event['id'] for event in game_data.get('events', [])]
-        
+        message = isinstance(game_data, GameUpdate)
+        if game_events is None:
+            game_events = set() if message else {event['id'] for event in game_data.get('events', [])}
+
+        if eventid is not None:
+            if message:
+                game_bookmakers = {bookmaker for bookmaker, market_keys in game_data.bookmaker_markets.items() if self.name in market_keys}
+            else:
+                game_bookmakers = {bookmaker['key'] for bookmaker in game_data.get('bookmakers', [])
+                                   if any(market.get('key') == self.name for market in bookmaker.get('markets', []))}
+            market_bookmakers = self.event_bookmakers.get(eventid, set())
+            if eventid not in game_events:
+                ingest_logger.warning("Event %s is not in the ingested game data for market %s.", eventid, self.name)
+                return False
+            if not game_bookmakers <= market_bookmakers:
+                ingest_logger.warning("Bookmakers %s for event %s are missing from Market object %s.", game_bookmakers - market_bookmakers, eventid, self.name)
+                return False
+            ingest_logger.debug("Data validation for event %s completed successfully.", eventid)
+            return True
+
+        game_bookmakers = set(game_data.bookmaker_markets) if message else {bookmaker['key'] for bookmaker in game_data.get('bookmakers', [])}
         # Extract the bookmakers from the Market object
-        market_bookmakers = list(self.bookmakers.keys())
+        market_bookmakers = self.bookmaker_set
 
-        logging.debug(f"Game bookmakers: {game_bookmakers}")
-        logging.debug(f"Market bookmakers: {market_bookmakers}")
-        logging.debug(f"Game data: {game_data}")
-        logging.debug(f"Market object bookmakers data: {self.bookmakers}")
+        ingest_logger.debug("Game bookmakers: %s", game_bookmakers)
+        ingest_logger.debug("Market bookmakers: %s", market_bookmakers)
+        log_payload(ingest_logger, "Game data: %s", game_data)
+        log_payload(ingest_logger, "Market object bookmakers data: %s", self.bookmakers)
 
         # Check if the bookmakers in the game data match the bookmakers in the Market object
-        if set(game_bookmakers) != set(market_bookmakers):
-            logging.warning(f"Bookmakers in Market object do not match game data for market {self.name}.")
-            logging.warning(f"Difference: {set(game_bookmakers).symmetric_difference(set(market_bookmakers))}")
-            logging.warning(f"Similarity: {set(game_bookmakers).intersection(set(market_bookmakers))}")
+        if game_bookmakers != market_bookmakers:
+            ingest_logger.warning("Bookmakers in Market object do not match game data for market %s.", self.name)
+            ingest_logger.warning("Difference: %s", game_bookmakers.symmetric_difference(market_bookmakers))
+            ingest_logger.warning("Similarity: %s", game_bookmakers.intersection(market_bookmakers))
             return False
 
         # Check if the events in the game data match the events in the Market object
-        for bookmaker, outcomes in self.bookmakers.items():
-            for outcome_key in outcomes:
-                eventid = outcome_key[0]
-                if eventid not in game_events:
-                    logging.warning(f"Event {eventid} in Market object do not match game data for market {self.name}.")
-                    return False
-
-        logging.debug("Data validation completed successfully.")
+        unknown_events = self.event_bookmakers.keys() - game_events
+        if unknown_events:
+            ingest_logger.warning("Events %s in Market object do not match game data for market %s.", unknown_events, self.name)
+            return False
+
+        ingest_logger.debug("Data validation completed successfully.")
         return True
         
     def get_opposite_name(self,outcomename):
@@ -95,100 +580,199 @@ class Market:
         Returns:
             str: The opposite of the given outcomename, or None if the outcomename is not recognized.
         """
-        if outcomename == "over":
-            return "under"
-        elif outcomename == "under":
-            return "over"
-        elif outcomename == "yes":
-            return "no"
-        elif outcomename == "no":
-            return "yes"
-        else:
-            return None
+        return OPPOSITE_NAMES.get(outcomename)
 
-    def update_market_data(self, market_data, eventid, bookmaker): 
+    def update_market_data(self, market_data, eventid, bookmaker, trace=None, devig_jobs=None):
         """
         Update the market data for each bookmaker. The market data is stored in the self.bookmakers dictionary.
         The structure of self.bookmakers is as follows:
         self.bookmakers = {bookmaker: {(eventid, outcome_name, outcome_description, outcome_point): {bookmaker: outcome_price}}}
+        Both sides of every outcome are also indexed in self.pairs by decereal, so pairing is a single lookup.
+        In columnar mode the opposite side is looked up in the store instead, so prices are only held once.
         
         Args:
-            market_data (dict): The market data to update. It's a dictionary with keys 'key', 'last_update', and 'outcomes'.
-                                'outcomes' is a list of dictionaries with keys 'name', 'description', 'price', 'point'.
+            market_data (MarketUpdate or dict): The market data to update, as accepted by decereal.
             eventid (str): The id of the event.
             bookmaker (str): The name of the bookmaker.
+            trace (dict, optional): Gets the time.monotonic() timestamps 'decereal_done' and 'devig_done'.
+            devig_jobs (list, optional): If given, a sharp bookmaker's pairs are appended to it as (market, bookmaker, sharp_pairs, trace)
+                                         instead of being devigged here; the caller devigs them and calls store_devig_results.
         """
-        logging.info(f"Starting to update market data for bookmaker {bookmaker} and event {eventid} with market data: {market_data}")
+        debug = ingest_logger.isEnabledFor(logging.DEBUG)
+        ingest_logger.info("Starting to update market data for bookmaker %s and event %s.", bookmaker, eventid)
+        log_payload(ingest_logger, "Market data for bookmaker %s and event %s: %s", bookmaker, eventid, market_data)
         decereal_data = self.decereal(market_data, eventid, bookmaker)
-        logging.info(f'Decereal data: {decereal_data}')
-        if decereal_data is not None and decereal_data['outcomes'] is not None:
-            for outcome in decereal_data['outcomes']:
-                # Define the unique key for the outcome
-                outcome_key = (eventid, outcome['name'], outcome['description'], outcome['point'])
-                # Add the outcome to the dictionary, using the unique key
-                if bookmaker not in self.bookmakers:
-                    self.bookmakers[bookmaker] = {}
-                if outcome_key not in self.bookmakers[bookmaker]:
-                    self.bookmakers[bookmaker][outcome_key] = {}
-                self.bookmakers[bookmaker][outcome_key][bookmaker] = outcome['price']
-                logging.debug(f"Updated bookmaker {bookmaker} data with outcome {outcome_key} and price {outcome['price']}")
-                # If the bookmaker is in sharpbookkey, check if the opposite outcome exists and perform the calculations
-                if bookmaker in self.sharpbookkey:
-                    logging.info(f"SHARPBOOKS FOR THIS MARKET:{self.sharpbookkey}")
-                    logging.info(f"Bookmaker {bookmaker} is in sharpbookkey. Proceeding with calculations.")
-                    logging.info(f"Outcome {outcome['description']} {outcome['point']} has data from sharpbook {bookmaker}.")  # Log which outcomes have data from which sharpbooks
-                    opposite_name = self.get_opposite_name(outcome['name'])
-                    logging.debug(f"Opposite name for outcome {outcome['name']} is {opposite_name}")
-                    opposite_key = (eventid, opposite_name, outcome['description'], outcome['point'])
-                    logging.debug(f"Opposite key for outcome {outcome_key} is {opposite_key}")
-                    if opposite_key in self.bookmakers[bookmaker]:
-                        logging.info(f"Opposite outcome {opposite_key} exists. Proceeding with calculations.")
-                        # If the opposite outcome exists, perform the calculations
-                        price1 = self.bookmakers[bookmaker][outcome_key][bookmaker]
-                        price2 = self.bookmakers[bookmaker][opposite_key][bookmaker]
-                        logging.debug(f"Prices for outcome {outcome_key} and opposite outcome {opposite_key} are {price1} and {price2} respectively.")
-                        results = self.calculate(price1, price2)  # Replace with your actual calculation method
-                        logging.debug(f"Calculated results for outcome {outcome_key} and opposite outcome {opposite_key} are {results}")
-                        # Store the result for averaging later
-                        # logging.debug(f"RESULTS:{self.results}")
-                        logging.debug(f"Outcome key: {outcome_key}, Bookmaker: {bookmaker}")
-                        logging.debug(f"Current keys in self.results: {self.results.keys()}")
-                        if outcome_key not in self.results:
-                            self.results[outcome_key] = {calculation: {'newover': result['newover'], 'newunder': result['newunder'], 'count': 1, 'bookmakers': {bookmaker: outcome['price']}} for calculation, result in results.items()}
-                            logging.info(f"Stored initial results for outcome {outcome_key}.")
-                        else:
-                            logging.info(f"Outcome key {outcome_key} already exists in results. Updating existing data.")
-                            for calculation, result in results.items():
-                                self.results[outcome_key][calculation]['newover'] += result['newover']
-                                self.results[outcome_key][calculation]['newunder'] += result['newunder']
-                                self.results[outcome_key][calculation]['count'] += 1
-                                self.results[outcome_key][calculation]['bookmakers'][bookmaker] = outcome['price']
-                                logging.debug(f"Updated results for outcome {outcome_key} with new data.COunt:{self.results[outcome_key][calculation]['count']} Books:{ self.results[outcome_key][calculation]['bookmakers']}")
-                                # Calculate the average right after updating total1 and total2
-                                self.strategy(outcome_key, calculation, result, outcome['price'])
-                                # self.results[outcome_key][calculation]['total1'] /= self.results[outcome_key][calculation]['count']
-                                # self.results[outcome_key][calculation]['total2'] /= self.results[outcome_key][calculation]['count']
-                                logging.debug(f"newover: {self.results[outcome_key][calculation]['newover']}, newunder: {self.results[outcome_key][calculation]['newunder']}")
-
-                        # Add the opposite_key to the results dictionary
-                        if opposite_key not in self.results:
-                            self.results[opposite_key] = {calculation: {'newover': result['newover'], 'newunder': result['newunder'], 'count': 1, 'bookmakers': {bookmaker: outcome['price']}} for calculation, result in results.items()}
-                            logging.info(f"Stored initial results for opposite outcome {opposite_key}.")
+        log_payload(ingest_logger, "Decereal data: %s", decereal_data)
+        if trace is not None:
+            trace['decereal_done'] = time.monotonic()
+        if decereal_data is None or decereal_data['outcomes'] is None:
+            return
 
+        self.bookmaker_set.add(bookmaker)
+        self.event_bookmakers.setdefault(eventid, set()).add(bookmaker)
+        book_outcomes = None if self.columnar else self.bookmakers.setdefault(bookmaker, {})
+        for name, description, price, point in decereal_data['outcomes']:
+            # Define the unique key for the outcome and add the outcome to the dictionary, using the unique key
+            outcome_key = (eventid, name, description, point)
+            if book_outcomes is None:
+                self.bookmakers.set_price(bookmaker, outcome_key, price)
+            else:
+                book_outcomes.setdefault(outcome_key, {})[bookmaker] = price
+            if debug:
+                ingest_logger.debug("Updated bookmaker %s data with outcome %s and price %s", bookmaker, outcome_key, price)
+
+        if bookmaker in self.sharpbookkey:
+            # If the bookmaker is in sharpbookkey, devig every pair this payload touched that has both sides
+            devig_logger.info("SHARPBOOKS FOR THIS MARKET:%s", self.sharpbookkey)
+            devig_logger.info("Bookmaker %s is in sharpbookkey. Proceeding with calculations.", bookmaker)
+            debug = devig_logger.isEnabledFor(logging.DEBUG)
+            book_pairs = None if self.columnar else self.pairs[bookmaker]
+            sharp_pairs = []  # (outcome_key, opposite_key, price1, price2) sent through the devig engine in one batch
+            for pair_key, name in decereal_data['pairs'].items():
+                opposite_name = self.get_opposite_name(name)
+                outcome_key = (eventid, name, pair_key[1], pair_key[2])
+                opposite_key = (eventid, opposite_name, pair_key[1], pair_key[2])
+                if book_pairs is None:  # The columnar store's row index finds both sides
+                    price1 = self.bookmakers.get_price(bookmaker, outcome_key)
+                    price2 = self.bookmakers.get_price(bookmaker, opposite_key)
                 else:
-                    logging.info(f"Bookmaker {bookmaker} is not in sharpbookkey. Proceeding with comparison.")
-                    relevant_outcome_key = (eventid, outcome['name'], outcome['description'], outcome['point'])
-                    logging.debug(f"Relevant outcome key for comparison is {relevant_outcome_key}")
-                    if relevant_outcome_key in self.results: #TODO shouldnt it be for each devig method's averages.
-                        logging.info(f"Relevant outcome {relevant_outcome_key} exists in results. Proceeding with comparison.")
-                        relevant_results = {calculation: {'newover': result['newover'], 'newunder': result['newunder']} for calculation, result in self.results[relevant_outcome_key].items()}
-                        # Perform the comparison
-                        logging.debug(f'Comparing {outcome["name"], outcome["description"], outcome["point"]} with {relevant_outcome_key}')
-                        #self.compare(outcome['price'], relevant_result)  # Replace with your actual comparison method
-
-
-        print(self.results)
-        
+                    pair = book_pairs[pair_key]
+                    price1 = pair.prices[name]
+                    price2 = pair.prices.get(opposite_name)
+                if price2 is None:
+                    if debug:
+                        devig_logger.debug("Opposite outcome %s for %s not available from %s yet.", opposite_name, pair_key, bookmaker)
+                    continue
+                sharp_pairs.append((outcome_key, opposite_key, price1, price2))
+                if debug:
+                    devig_logger.debug("Prices for outcome %s and opposite outcome %s are %s and %s respectively.", outcome_key, opposite_key, price1, price2)
+
+            if devig_jobs is not None:
+                devig_jobs.append((self, bookmaker, sharp_pairs, trace))
+                trace = None  # devig_done is stamped by whoever runs the job
+            else:
+                self.store_devig_results(bookmaker, sharp_pairs, self.calculate_batch([(price1, price2) for _, _, price1, price2 in sharp_pairs]))
+        else:
+            ingest_logger.info("Bookmaker %s is not in sharpbookkey. Proceeding with comparison.", bookmaker)
+            for name, description, price, point in decereal_data['outcomes']:
+                relevant_outcome_key = (eventid, name, description, point)
+                relevant_outcome = self.results.get(relevant_outcome_key)
+                if relevant_outcome is not None: #TODO shouldnt it be for each devig method's averages.
+                    if debug:
+                        ingest_logger.debug("Relevant outcome %s exists in results. Proceeding with comparison.", relevant_outcome_key)
+                    relevant_results = {calculation: {'newover': result['newover'], 'newunder': result['newunder']} for calculation, result in relevant_outcome.items()}
+                    # Perform the comparison
+                    if debug:
+                        ingest_logger.debug("Comparing %s with %s", (name, description, point), relevant_outcome_key)
+                    #self.compare(price, relevant_result)  # Replace with your actual comparison method
+
+        if trace is not None:
+            trace['devig_done'] = time.monotonic()
+        log_payload(devig_logger, "Results for market %s: %s", self.name, self.results)
+
+    def restore_price(self, bookmaker, outcome_key, price):
+        """
+        Store a price from a snapshot, indexing it the way decereal and update_market_data would have.
+
+        Args:
+            bookmaker (str): The name of the bookmaker.
+            outcome_key (tuple): The (eventid, outcome_name, outcome_description, outcome_point) key.
+            price (float): The price.
+        """
+        eventid, name, description, point = outcome_key
+        if self.columnar:
+            self.bookmakers.set_price(bookmaker, outcome_key, price)
+        else:
+            self.bookmakers.setdefault(bookmaker, {}).setdefault(outcome_key, {})[bookmaker] = price
+            pair_key = (eventid, description, point)
+            book_pairs = self.pairs.setdefault(bookmaker, {})
+            pair = book_pairs.get(pair_key)
+            if pair is None:
+                pair = book_pairs[pair_key] = OutcomePair()
+            pair.prices[name] = price
+        self.bookmaker_set.add(bookmaker)
+        self.event_bookmakers.setdefault(eventid, set()).add(bookmaker)
+
+    def evict_events(self, eventids):
+        """
+        Drop every price, pair and result of eventids, e.g. once the events have started or left the games list.
+
+        Args:
+            eventids (set): The ids of the events to drop.
+
+        Returns:
+            int: The number of results dropped.
+        """
+        if eventids.isdisjoint(self.event_bookmakers):
+            return 0
+        result_count = len(self.results)
+        self.results = {outcome_key: calculations for outcome_key, calculations in self.results.items() if outcome_key[0] not in eventids}
+        if self.columnar:
+            self.bookmakers = self.bookmakers.without_events(eventids)
+        else:
+            for bookmaker in list(self.bookmakers):
+                book_outcomes = {outcome_key: prices for outcome_key, prices in self.bookmakers[bookmaker].items() if outcome_key[0] not in eventids}
+                book_pairs = {pair_key: pair for pair_key, pair in self.pairs.get(bookmaker, {}).items() if pair_key[0] not in eventids}
+                if book_outcomes:
+                    self.bookmakers[bookmaker] = book_outcomes
+                    self.pairs[bookmaker] = book_pairs
+                else:
+                    del self.bookmakers[bookmaker]
+                    self.pairs.pop(bookmaker, None)
+        for eventid in eventids:
+            self.event_bookmakers.pop(eventid, None)
+        self.bookmaker_set = set().union(*self.event_bookmakers.values())
+        return result_count - len(self.results)
+
+    def store_devig_results(self, bookmaker, sharp_pairs, batch_results):
+        """
+        Store the results of a batch of sharp pairs in order.
+
+        Args:
+            bookmaker (str): The name of the sharp bookmaker.
+            sharp_pairs (list): (outcome_key, opposite_key, price1, price2) tuples, as collected by update_market_data.
+            batch_results (list): The calculated results of each pair, as returned by calculate_batch.
+        """
+        debug = devig_logger.isEnabledFor(logging.DEBUG)
+        for (outcome_key, opposite_key, price1, price2), results in zip(sharp_pairs, batch_results):
+            if debug:
+                devig_logger.debug("Calculated results for outcome %s and opposite outcome %s are %s", outcome_key, opposite_key, results)
+            self.store_results(bookmaker, outcome_key, opposite_key, price1, price2, results)
+
+    def store_results(self, bookmaker, outcome_key, opposite_key, price, opposite_price, results):
+        """
+        Store the calculated results of a sharp outcome pair for averaging later.
+        Both sides are stored on every devig, each from its own point of view: newover is the side's own devigged
+        price and newunder its opposite's.
+
+        Args:
+            bookmaker (str): The name of the sharp bookmaker.
+            outcome_key (tuple): The key of the outcome the calculations were made for.
+            opposite_key (tuple): The key of the opposite outcome.
+            price (float): The sharp bookmaker's price for outcome_key.
+            opposite_price (float): The sharp bookmaker's price for opposite_key.
+            results (dict): The calculated results, as returned by calculate.
+        """
+        debug = devig_logger.isEnabledFor(logging.DEBUG)
+        swapped = {calculation: {'newover': result['newunder'], 'newunder': result['newover']} for calculation, result in results.items()}
+        for key, key_price, key_results in ((outcome_key, price, results), (opposite_key, opposite_price, swapped)):
+            stored = self.results.get(key)
+            if stored is None:
+                self.results[key] = {calculation: {'newover': result['newover'], 'newunder': result['newunder'], 'count': 1, 'bookmakers': {bookmaker: key_price}} for calculation, result in key_results.items()}
+                if debug:
+                    devig_logger.debug("Stored initial results for outcome %s from %s.", key, bookmaker)
+                continue
+            if debug:
+                devig_logger.debug("Outcome key %s already exists in results. Updating existing data from %s.", key, bookmaker)
+            for calculation, result in key_results.items():
+                stored_result = stored[calculation]
+                stored_result['newover'] += result['newover']
+                stored_result['newunder'] += result['newunder']
+                stored_result['count'] += 1
+                stored_result['bookmakers'][bookmaker] = key_price
+                if debug:
+                    devig_logger.debug("Updated results for outcome %s with new data.COunt:%s Books:%s", key, stored_result['count'], stored_result['bookmakers'])
+                    devig_logger.debug("newover: %s, newunder: %s", stored_result['newover'], stored_result['newunder'])
     
     def calculate(self, price1, price2):
         """
@@ -201,20 +785,60 @@ class Market:
         Returns:
             dict: A dictionary where each key is the name of the independent calculation and the value is a tuple of the new price1 and price2.
         """
-        # Perform your independent calculations here
-        powerdevigresult=self.power_devig(price1,price2)
-        power_devig = {'newover':1,'newunder':1}
-        multdevigresult=self.mult_devig(price1,price2)
-        
-        mult_devig = {'newover': multdevigresult[0], 'newunder': multdevigresult[1]}
-        print(mult_devig)
-        add_devig = {'newover':1,'newunder':1}
+        results = self.calculate_batch([(price1, price2)])[0]
+        devig_logger.debug("Mult devig for %s/%s: %s", price1, price2, results['mult_devig'])
+        return results
 
-        return {
-            'power_devig': power_devig,
-            'mult_devig': mult_devig,
-            'add_devig': add_devig
-        }
+    def calculate_batch(self, pairs, solved=None):
+        """
+        Perform the independent calculations for a whole market's price pairs at once.
+        Power devig goes through the vectorized power_devig_batch engine instead of one fsolve per pair.
+
+        Args:
+            pairs (list): A list of (price1, price2) tuples.
+            solved (tuple, optional): Lists of power devig and mult devig (over, under) results for every pair,
+                                      already computed elsewhere, e.g. by devig_batch_job in a worker process.
+
+        Returns:
+            list: One dictionary per pair, in the same order and shape as the return value of calculate.
+        """
+        if not pairs:
+            return []
+        # Perform your independent calculations here, only sending cache misses to the solvers
+        if solved is not None:
+            powerdevigresult, multdevigresult = solved
+        else:
+            powerdevigresult = [self.power_devig_cache.get('power_devig', price1, price2, self.devig_tolerance) for price1, price2 in pairs]
+            multdevigresult = [self.power_devig_cache.get('mult_devig', price1, price2) for price1, price2 in pairs]
+
+        misses = [i for i, result in enumerate(powerdevigresult) if result is None]
+        if misses:
+            prices1 = np.array([pairs[i][0] for i in misses], dtype=float)
+            prices2 = np.array([pairs[i][1] for i in misses], dtype=float)
+            actualoverdecimal, actualunderdecimal = power_devig_batch(prices1, prices2, tol=self.devig_tolerance)
+            for n, i in enumerate(misses):
+                powerdevigresult[i] = (float(actualoverdecimal[n]), float(actualunderdecimal[n]))
+                self.power_devig_cache.set('power_devig', pairs[i][0], pairs[i][1], powerdevigresult[i], self.devig_tolerance)
+            devig_logger.debug("Calculated power devig odds for %s of %s pairs.", len(misses), len(pairs))
+
+        misses = [i for i, result in enumerate(multdevigresult) if result is None]
+        if misses:
+            compoverimplied = 1 / np.array([pairs[i][0] for i in misses], dtype=float)
+            compunderimplied = 1 / np.array([pairs[i][1] for i in misses], dtype=float)
+            actualoverdecimal = compoverimplied / (compoverimplied + compunderimplied)
+            actualunderdecimal = compunderimplied / (compunderimplied + compoverimplied)
+            for n, i in enumerate(misses):
+                multdevigresult[i] = (float(actualoverdecimal[n]), float(actualunderdecimal[n]))
+                self.power_devig_cache.set('mult_devig', pairs[i][0], pairs[i][1], multdevigresult[i])
+
+        return [
+            {
+                'power_devig': {'newover': powerdevigresult[i][0], 'newunder': powerdevigresult[i][1]},
+                'mult_devig': {'newover': multdevigresult[i][0], 'newunder': multdevigresult[i][1]},
+                'add_devig': {'newover': 1, 'newunder': 1}
+            }
+            for i in range(len(pairs))
+        ]
 
     def compare_and_emit_outcomes(self, relevant_outcomes, nonsharp_outcomes):
         """
@@ -247,6 +871,10 @@ class Market:
         Returns:
             tuple: A tuple containing the calculated probabilities.
         """
+        cached = self.power_devig_cache.get('mult_devig', price1, price2)
+        if cached is not None:
+            return cached
+
         # Calculate implied probabilities
         compoverimplied = 1 / price1
         compunderimplied = 1 / price2
@@ -255,6 +883,7 @@ class Market:
         actualoverdecimal = compoverimplied / (compoverimplied + compunderimplied)
         actualunderdecimal = compunderimplied / (compunderimplied + compoverimplied)
 
+        self.power_devig_cache.set('mult_devig', price1, price2, (actualoverdecimal, actualunderdecimal))
         return actualoverdecimal, actualunderdecimal
     
     
@@ -269,6 +898,10 @@ class Market:
         Returns:
             tuple: A tuple containing the calculated probabilities and American odds.
         """
+        cached = self.power_devig_cache.get('power_devig', price1, price2)  # fsolve ignores devig_tolerance, so its results are kept apart from power_devig_batch's
+        if cached is not None:
+            return cached
+
         # Calculate implied probabilities
         compoverimplied = 1 / price1
         compunderimplied = 1 / price2
@@ -281,15 +914,17 @@ class Market:
 
         # Solve for k
         k_initial_guess = 1
+        from scipy.optimize import fsolve  # Only this reference path needs scipy, so it is not imported at startup
         k_solution = fsolve(f, k_initial_guess)
 
         pi1 = compoverimplied**(1/k_solution[0])
         pi2 = compunderimplied**(1/k_solution[0])
-        logging.debug(f"Calculated probabilities: {pi1}, {pi2}")
+        devig_logger.debug("Calculated probabilities: %s, %s", pi1, pi2)
         # Convert probabilities to Decimal odds
         actualoverdecimal = 1 / pi1
         actualunderdecimal = 1 / pi2
 
+        self.power_devig_cache.set('power_devig', price1, price2, (actualoverdecimal, actualunderdecimal))
         return actualoverdecimal,actualunderdecimal
     
 
@@ -303,219 +938,1894 @@ class Market:
         Returns:
             str: The sanitized string.
         """
-        # Implement your sanitization logic here
-        sanitized_string = string.lower().strip()
-        return sanitized_string
+        return sanitize_string(string)
             
     def decereal(self, market_data, eventid, bookmaker):
         """
         Process the market data and return a dictionary with key, last_update, and outcomes.
         
         Args:
-            market_data (dict): The market data to process. It's a dictionary with keys 'key', 'last_update', and 'outcomes'.
-                                'outcomes' is a list of dictionaries with keys 'name', 'description', 'price', 'point'.
+            market_data (MarketUpdate or dict): The market data to process. A raw dictionary has keys 'key', 'last_update', and 'outcomes',
+                                'outcomes' being a list of dictionaries with keys 'name', 'description', 'price', 'point'.
+                                A MarketUpdate already carries sanitized outcome tuples.
             eventid (str): The id of the event.
             bookmaker (str): The name of the bookmaker.
             
+        Both sides of every outcome are indexed in self.pairs[bookmaker] as they are processed, except in columnar
+        mode, where the store's row index already finds them.
+            
         Returns:
-            dict: The processed market data. It's a dictionary with keys 'key', 'last_update', and 'outcomes'.
-                  'outcomes' is a list of dictionaries with keys 'name', 'description', 'price', 'point', 'eventid', 'bookmaker'.
+            dict: The processed market data. It's a dictionary with keys 'key', 'last_update', 'outcomes' and 'pairs'.
+                  'outcomes' is a sequence of (name, description, price, point) tuples with sanitized names and descriptions.
+                  'pairs' maps each (eventid, description, point) key touched by this data to the last outcome name seen for it.
         """
-        logging.debug(f"Decereal method called with eventid: {eventid}, bookmaker: {bookmaker}.")  
+        ingest_logger.debug("Decereal method called with eventid: %s, bookmaker: %s.", eventid, bookmaker)  
         try:
-            key = market_data.get('key')
-            last_update = market_data.get('last_update')
-            outcomes_data = market_data.get('outcomes', [])
+            if isinstance(market_data, MarketUpdate):
+                key = market_data.market_key
+                last_update = market_data.last_update
+                outcomes = market_data.outcomes
+            else:
+                key = market_data.get('key')
+                last_update = market_data.get('last_update')
+                outcomes = [(self.sanitize_string(outcome.get('name')), self.sanitize_string(outcome.get('description', '')), outcome.get('price'), outcome.get('point', None))
+                            for outcome in market_data.get('outcomes', [])]
 
-            if not outcomes_data:  # Check if outcomes_data is empty
-                logging.warning(f"No outcomes data for eventid: {eventid}, bookmaker: {bookmaker}. Returning None.")
+            if not outcomes:  # Check if outcomes is empty
+                ingest_logger.warning("No outcomes data for eventid: %s, bookmaker: %s. Returning None.", eventid, bookmaker)
                 return None
 
-            outcomes = []
-            for outcome in outcomes_data:
-                name = self.sanitize_string(outcome.get('name'))
-                description = self.sanitize_string(outcome.get('description', ''))
-            
-                outcomes.append({
-                    'name': name,
-                    'description': description,
-                    'price': outcome.get('price'),
-                    'point': outcome.get('point', None),
-                    'eventid': eventid,  # Add the eventid to each outcome
-                    'bookmaker': bookmaker  # Add the bookmaker to each outcome
-                })
-                logging.debug(f"Processed outcome for eventid: {eventid}, bookmaker: {bookmaker}. Outcome: {outcomes[-1]}")
-
-            logging.debug(f"Finished processing outcomes for eventid: {eventid}, bookmaker: {bookmaker}. Total outcomes: {len(outcomes)}")
+            touched_pairs = {}
+            book_pairs = None if self.columnar else self.pairs.setdefault(bookmaker, {})
+            debug = ingest_logger.isEnabledFor(logging.DEBUG)
+            for outcome in outcomes:
+                name, description, price, point = outcome
+                pair_key = (eventid, description, point)
+                if book_pairs is not None:
+                    pair = book_pairs.get(pair_key)
+                    if pair is None:
+                        pair = book_pairs[pair_key] = OutcomePair()
+                    pair.prices[name] = price
+                touched_pairs.pop(pair_key, None)  # Re-insert so pairs are ordered by the side that completed them
+                touched_pairs[pair_key] = name
+                if debug:
+                    ingest_logger.debug("Processed outcome for eventid: %s, bookmaker: %s. Outcome: %s", eventid, bookmaker, outcome)
+
+            ingest_logger.debug("Finished processing outcomes for eventid: %s, bookmaker: %s. Total outcomes: %s", eventid, bookmaker, len(outcomes))
 
             return {
                 'key': key,
                 'last_update': last_update,
-                'outcomes': outcomes
+                'outcomes': outcomes,
+                'pairs': touched_pairs
             }
         except Exception as e:
-            logging.error(f"Error in decereal for eventid: {eventid}, bookmaker: {bookmaker}, error: {e}")
+            ingest_logger.error("Error in decereal for eventid: %s, bookmaker: %s, error: %s", eventid, bookmaker, e)
             return None
-        
-class MarketManager:
-    def __init__(self, min_bookmakers):
-        self.market_objects = {}  # Stores market name: market object
-        self.queue = asyncio.Queue()  # Queue for data
-        self.done_event = asyncio.Event()  # Event
-        self.min_bookmakers=min_bookmakers
-        self.received_bookmakers = {}  # Stores (game id, market key): set of bookmaker keys
-        logging.debug(f"MarketManager object initialized with {self.min_bookmakers} bookmakers required")
-
-    def get_market(self, name):
-        """
-        Retrieves the market object for a given name, creates it if it doesn't exist.
-
-        Args:
-            name (str): The name of the market.
-
-        Returns:
-            Market: The Market object for the given name.
-        """
-        # Get the market object for a given name, create it if it doesn't exist
-        if name not in self.market_objects:
-            self.market_objects[name] = Market(name,name,self.min_bookmakers)
-            logging.debug(f"Created market object for {name}. Total market objects: {len(self.market_objects)}")
-        else:
-            logging.debug(f"Market object for {name} already exists. Total market objects: {len(self.market_objects)}")
-        return self.market_objects[name]
-    
-    async def update_market_data(self):
-        """
-        Updates market data from the queue continuously.
-        """
-        logging.debug("Starting to update market data from the queue.")
-        while True:
-            logging.debug("Retrieving game market data from the queue.")
-            game_market_data = await self.queue.get()
-            if game_market_data is None:  # Break the loop if the sentinel value is retrieved
-                logging.debug("Sentinel value retrieved from the queue. Breaking the loop.")
-                break
 
-            logging.debug("Checking if game market data is valid.")
-            if game_market_data is None or 'bookmakers' not in game_market_data:
-                logging.warning("Invalid game market data. Skipping this data.")
-                continue
+class MarketUpdate:
+    """
+    One bookmaker's outcomes for one market of a game, as carried on the MarketManager queue.
+    Strings are sanitized and interned by build_game_update, so the consumer never re-walks the raw payload.
+    """
+    __slots__ = ('market_key', 'bookmaker', 'last_update', 'outcomes')
 
-            logging.debug("Retrieving bookmakers data from game market data.")
-            bookmakers_data = game_market_data.get('bookmakers', [])
-            if not bookmakers_data:  # Check if bookmakers_data is empty
-                logging.warning("No bookmakers data in game market data. Skipping this data.")
-                continue
+    def __init__(self, market_key, bookmaker, last_update, outcomes):
+        self.market_key = market_key
+        self.bookmaker = bookmaker
+        self.last_update = last_update
+        self.outcomes = outcomes  # Tuple of (name, description, price, point)
 
-            logging.debug("Processing bookmakers data.")
-            for bookmaker_data in bookmakers_data:
-                logging.debug(f"Processing bookmaker data: {bookmaker_data}")
-                if not isinstance(bookmaker_data, dict):  # Check if bookmaker_data is a dictionary
-                    logging.error(f"Unexpected data type for bookmaker_data: {type(bookmaker_data)}. Skipping this data.")
-                    continue
+    def __repr__(self):
+        return f"MarketUpdate({self.market_key!r}, {self.bookmaker!r}, {self.last_update!r}, {len(self.outcomes)} outcomes)"
 
-                logging.debug("Retrieving markets data from bookmaker data.")
-                markets_data = bookmaker_data.get('markets', [])
-                if not markets_data:  # Check if markets_data is empty
-                    logging.warning("No markets data in bookmaker data. Skipping this data.")
-                    continue
+class GameUpdate:
+    """
+    Every MarketUpdate fetched for one game, plus the bookmaker and market keys Market.validate_data checks against.
+    """
+    __slots__ = ('game_id', 'updates', 'bookmaker_markets')
 
-                logging.debug("Processing markets data.")
-                for market_data in markets_data:
-                    logging.debug(f"Processing market data: {market_data}")
-                    if not isinstance(market_data, dict):  # Check if market_data is a dictionary
-                        logging.error(f"Unexpected data type for market_data: {type(market_data)}. Skipping this data.")
-                        continue
+    def __init__(self, game_id, updates, bookmaker_markets):
+        self.game_id = game_id
+        self.updates = updates  # Tuple of MarketUpdate, in payload order
+        self.bookmaker_markets = bookmaker_markets  # bookmaker key: frozenset of the market keys it returned
 
-                    logging.debug("Updating market data.")
-                    market = self.get_market(market_data['key'])
-                    market.update_market_data(market_data, game_market_data['id'], bookmaker_data['key'])
+    def validation_view(self):
+        """
+        Returns:
+            GameUpdate: This game without its outcomes, all that Market.validate_data needs.
+        """
+        return GameUpdate(self.game_id, (), self.bookmaker_markets)
 
-                    logging.debug("Validating market data.")
-                    if not market.validate_data(game_market_data):
-                        logging.error(f"Data in Market object does not match original game data for market {market.name}.")
-                    else:
-                        logging.info(f"Valid data for market {market.name}. Data matches original game data.")
+    def __repr__(self):
+        return f"GameUpdate({self.game_id!r}, {len(self.updates)} updates)"
 
-                        # market.compare_and_emit_outcomes()
+def game_id_of(game_market_data):
+    """
+    Returns:
+        str: The game id of a queued GameUpdate or raw payload, for log messages.
+    """
+    if isinstance(game_market_data, GameUpdate):
+        return game_market_data.game_id
+    return game_market_data.get('id') if isinstance(game_market_data, dict) else game_market_data
 
-                    game_id = game_market_data['id']
-                    market_key = market_data['key']
-                    if (game_id, market_key) not in self.received_bookmakers:
-                        self.received_bookmakers[(game_id, market_key)] = set()
-                    self.received_bookmakers[(game_id, market_key)].add(bookmaker_data['key'])
+def build_game_update(game_market_data):
+    """
+    Turn a fetched event odds payload into a GameUpdate, skipping malformed bookmakers, markets and outcomes.
 
-            logging.debug("Checking if done event is set.")
-            if self.done_event.is_set():  # Check if done_event is set
-                logging.info("Done event is set. Breaking the loop.")
-            await asyncio.sleep(0.1)  # sleep for a bit before checking the queue again
-        # After all queue items have been processed
-        for (game_id, market_key), received_bookmakers in self.received_bookmakers.items():
-            missing_bookmakers = set(bookmakers) - received_bookmakers
-            if missing_bookmakers:
-                logging.warning(f"For game {game_id}, market {market_key}, the following requested bookmakers were not received: {', '.join(missing_bookmakers)}")
-            else:
-                logging.info(f"All requested bookmakers received for game {game_id}, market {market_key}.")
+    Args:
+        game_market_data (dict): The fetched data for one game. It's a dictionary with keys 'id' and 'bookmakers'.
 
-            logging.debug("Sleeping for a bit before checking the queue again.")
-            
-api_call_count = 0  # Global variable to count API calls
-import json
+    Returns:
+        GameUpdate: The compact message, or None if the payload has no bookmakers data.
+    """
+    ingest_logger.debug("Checking if game market data is valid.")
+    if game_market_data is None or 'bookmakers' not in game_market_data:
+        ingest_logger.warning("Invalid game market data. Skipping this data.")
+        return None
 
-async def fetch_data(session, url, api_keys, current_key_index=0, retry_count=0):
+    ingest_logger.debug("Retrieving bookmakers data from game market data.")
+    bookmakers_data = game_market_data.get('bookmakers', [])
+    if not bookmakers_data:  # Check if bookmakers_data is empty
+        ingest_logger.warning("No bookmakers data in game market data. Skipping this data.")
+        return None
 
+    game_id = sys.intern(game_market_data['id'])
+    updates = []
+    bookmaker_markets = {}
+    for bookmaker_data in bookmakers_data:
+        built = build_market_updates(bookmaker_data)
+        if built is None:
+            continue
+        bookmaker, market_keys, bookmaker_updates = built
+        bookmaker_markets[bookmaker] = market_keys
+        updates.extend(bookmaker_updates)
+    return GameUpdate(game_id, tuple(updates), bookmaker_markets)
+
+def build_market_updates(bookmaker_data):
     """
-    Fetch data from a given URL. If the response status is 429 or the message in the data dictionary contains 'quota', 
-    retry the request with exponential backoff and swapping API keys.
+    Turn one bookmaker of an event odds payload into MarketUpdates, skipping malformed markets and outcomes.
 
     Args:
-        session (aiohttp.ClientSession): The aiohttp session to use for the request.
-        url (str): The URL to fetch data from.
-        api_keys (list): The list of API keys to use for the request.
-        current_key_index (int, optional): The index of the current API key in the list. Defaults to 0.
-        retry_count (int, optional): The number of times the request has been retried. Defaults to 0.
+        bookmaker_data (dict): One item of the payload's 'bookmakers', with keys 'key' and 'markets'.
 
     Returns:
-        dict: The fetched data. It's a dictionary with keys depending on the fetched data.
+        tuple: The interned bookmaker key, the frozenset of market keys it returned and its list of MarketUpdates,
+               or None if bookmaker_data is not a dictionary with a key.
     """
+    log_payload(ingest_logger, "Processing bookmaker data: %s", bookmaker_data)
+    if not isinstance(bookmaker_data, dict):  # Check if bookmaker_data is a dictionary
+        ingest_logger.error("Unexpected data type for bookmaker_data: %s. Skipping this data.", type(bookmaker_data))
+        return None
 
-    global total_delay_time
-    # Fetch data from a given URL
-    try:
+    if not isinstance(bookmaker_data.get('key'), str):
+        ingest_logger.error("Bookmaker data without a key: %s. Skipping this data.", bookmaker_data.get('key'))
+        return None
+    bookmaker = sys.intern(bookmaker_data['key'])
+    markets_data = bookmaker_data.get('markets', [])
+    market_keys = frozenset(market_data.get('key') for market_data in markets_data if isinstance(market_data, dict))
+    if not markets_data:  # Check if markets_data is empty
+        ingest_logger.warning("No markets data in bookmaker data. Skipping this data.")
+        return bookmaker, market_keys, []
+
+    updates = []
+    for market_data in markets_data:
+        log_payload(ingest_logger, "Processing market data: %s", market_data)
+        if not isinstance(market_data, dict):  # Check if market_data is a dictionary
+            ingest_logger.error("Unexpected data type for market_data: %s. Skipping this data.", type(market_data))
+            continue
+        market_key = market_data.get('key')
+        if not isinstance(market_key, str):
+            ingest_logger.error("Market data without a key for bookmaker %s: %s. Skipping this data.", bookmaker, market_key)
+            continue
+        outcomes = []
+        for outcome in market_data.get('outcomes', []):
+            try:
+                outcomes.append((sanitize_string(outcome['name']), sanitize_string(outcome.get('description', '')), outcome.get('price'), outcome.get('point')))
+            except (KeyError, TypeError, AttributeError) as e:  # A missing or non-string name or description
+                ingest_logger.error("Malformed outcome in market %s for bookmaker %s: %s (%r). Skipping this outcome.", market_key, bookmaker, outcome, e)
+        updates.append(MarketUpdate(sys.intern(market_key), bookmaker, market_data.get('last_update'), tuple(outcomes)))
+    return bookmaker, market_keys, updates
+
+class ChangeDetector:
+    """
+    Remembers the last seen last_update and content hash of every (event, market, bookmaker) payload,
+    so unchanged payloads can skip Market.update_market_data on repeat polls. A payload is only remembered once it
+    has been processed, so one that failed is processed again on the next poll instead of being skipped.
+    """
+    def __init__(self):
+        self.seen = {}  # (eventid, market key, bookmaker): (last_update, content hash)
+        self.changed = 0
+        self.unchanged = 0
 
-        async with session.get(url) as response:
-            global api_call_count
-            api_call_count += 1
-            logging.debug(f"API call #{api_call_count} to {url}")
-            data = await response.text()  # Get the response data as a string
-            data_dict = json.loads(data)  # Convert the JSON string to a dictionary
-            if response.status == 429 or ('message' in data_dict and 'quota' in data_dict['message']):
-                if retry_count >= len(api_keys):  # Retry limit
-                    logging.error(f"Too many requests to {url}. Giving up after {retry_count} retries.")
-                    return None
-                delay = 2 ** retry_count if retry_count > 0 else 0
-                await asyncio.sleep(delay)  # exponential backoff
-                async with total_delay_time_lock:
-                    global total_delay_time
-                    total_delay_time += delay
-                logging.debug(f"Exponential backoff delay: {delay} seconds. Total delay time: {total_delay_time} seconds.")
-                # Swap API keys
+    @staticmethod
+    def content_hash(market_update):
+        """
+        Returns:
+            int: A hash of the outcomes in market_update that is stable across processes.
+        """
+        return int.from_bytes(hashlib.blake2b(repr(market_update.outcomes).encode(), digest_size=8).digest(), 'little')
+
+    def has_changed(self, eventid, market_key, bookmaker, market_update, pending=None):
+        """
+        Check a payload against the last one seen for the same event, market and bookmaker.
+        The outcomes are only hashed when last_update has moved.
+
+        Args:
+            eventid (str): The id of the event.
+            market_key (str): The market key.
+            bookmaker (str): The bookmaker key.
+            market_update (MarketUpdate): The market data.
+            pending (dict, optional): Collects the payload's (last_update, content hash) for record() instead of
+                                      remembering it now, and is checked first, so a repeat within one queue item
+                                      is still skipped. Defaults to None, which remembers it straight away.
+
+        Returns:
+            bool: True if the payload is new or differs from the last one seen.
+        """
+        key = (eventid, market_key, bookmaker)
+        last_update = market_update.last_update
+        previous = pending[key] if pending is not None and key in pending else self.seen.get(key)
+        if previous is not None and last_update is not None and previous[0] == last_update:
+            self.unchanged += 1
+            return False
+        content_hash = self.content_hash(market_update)
+        (self.seen if pending is None else pending)[key] = (last_update, content_hash)
+        if previous is not None and previous[1] == content_hash:
+            self.unchanged += 1
+            return False
+        self.changed += 1
+        return True
+
+    def record(self, pending):
+        """
+        Remember the payloads has_changed collected in pending, once their queue item has been processed.
+        """
+        self.seen.update(pending)
+
+    def evict(self, eventids):
+        """
+        Forget every payload seen for eventids.
+        """
+        self.seen = {key: seen for key, seen in self.seen.items() if key[0] not in eventids}
+
+    def stats(self):
+        return {'tracked': len(self.seen), 'changed': self.changed, 'unchanged': self.unchanged}
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Histogram upper bounds in seconds
+LATENCY_SEGMENTS = (  # (segment, start timestamp, end timestamp) recorded by LatencyRecorder
+    ('request', 'request_start', 'response_received'),  # Key scheduling, retries, network and JSON decode
+    ('handoff', 'response_received', 'enqueued'),
+    ('queue_wait', 'enqueued', 'dequeued'),
+    ('decereal', 'started', 'decereal_done'),  # Per market update
+    ('devig', 'decereal_done', 'devig_done'),  # Per market update: storing prices, pairing and the devig batch
+    ('process', 'dequeued', 'processed'),
+    ('end_to_end', 'request_start', 'processed'),
+)
+LATENCY_EXPORT_PATH = os.environ.get('ODDS_LATENCY_EXPORT')  # Write the latency histograms here as JSON when a run ends
+
+class LatencyHistogram:
+    """
+    Fixed-bucket histogram of durations in seconds.
+    """
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # The last bucket holds everything above LATENCY_BUCKETS[-1]
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        Returns:
+            float: The upper bound of the bucket holding the given fraction of samples (max for the overflow bucket), 0.0 if empty.
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def export(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.counts)}
+        }
+
+class LatencyRecorder:
+    """
+    Per-segment latency histograms built from the timestamps a queue item collects on its way
+    from fetch_data to Market.results. See LATENCY_SEGMENTS for the segments.
+    """
+    def __init__(self):
+        self.histograms = {segment: LatencyHistogram() for segment, _, _ in LATENCY_SEGMENTS}
+
+    def record(self, trace):
+        """
+        Record every segment whose start and end timestamps are both in trace.
+
+        Args:
+            trace (dict): Timestamp name: time.monotonic() value.
+        """
+        for segment, start, end in LATENCY_SEGMENTS:
+            if start in trace and end in trace:
+                self.histograms[segment].record(trace[end] - trace[start])
+
+    def summary(self):
+        """
+        Returns:
+            dict: segment: (count, p50, p99) for every segment with samples.
+        """
+        return {segment: (histogram.count, histogram.percentile(0.5), histogram.percentile(0.99))
+                for segment, histogram in self.histograms.items() if histogram.count}
+
+    def export(self):
+        return {segment: histogram.export() for segment, histogram in self.histograms.items()}
+
+    def to_prometheus(self, name='odds_stage_latency_seconds'):
+        """
+        Returns:
+            str: The histograms in the Prometheus text exposition format, one series per segment.
+        """
+        lines = [f"# TYPE {name} histogram"]
+        for segment, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{segment="{segment}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{segment="{segment}"}} {histogram.total}')
+            lines.append(f'{name}_count{{segment="{segment}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write the histograms to path, as Prometheus text if it ends in .prom and as JSON otherwise.
+        """
+        with open(path, 'w') as export_file:
+            if path.endswith('.prom'):
+                export_file.write(self.to_prometheus())
+            else:
+                json.dump(self.export(), export_file, indent=2)
+
+def shard_for(name, shards):
+    """
+    Returns:
+        int: The shard that owns the market called name. Stable across processes and runs.
+    """
+    return zlib.crc32(name.encode()) % shards
+
+class MarketShard:
+    """
+    A subset of the Market objects, updated by one worker so every market sees its updates in queue order.
+    """
+    def __init__(self, min_bookmakers, columnar=False, validate_mode='full', market_objects=None, event_ids=None):
+        """
+        Args:
+            min_bookmakers (int): Passed to every Market.
+            columnar (bool, optional): Create Market objects with a ColumnarOutcomeStore. Defaults to False.
+            validate_mode (str, optional): As for MarketManager. Defaults to 'full'.
+            market_objects (dict, optional): Market name: Market object to add markets to, shared with the
+                                             MarketManager when the shard runs in the same process.
+            event_ids (set, optional): Ids of every event ingested so far, shared like market_objects.
+        """
+        self.min_bookmakers = min_bookmakers
+        self.columnar = columnar
+        self.validate_mode = validate_mode
+        self.market_objects = {} if market_objects is None else market_objects
+        self.event_ids = set() if event_ids is None else event_ids
+
+    def get_market(self, name):
+        """
+        Retrieves the market object for a given name, creates it if it doesn't exist.
+
+        Args:
+            name (str): The name of the market.
+
+        Returns:
+            Market: The Market object for the given name.
+        """
+        # Get the market object for a given name, create it if it doesn't exist
+        if name not in self.market_objects:
+            self.market_objects[name] = Market(name,name,self.min_bookmakers,columnar=self.columnar)
+            ingest_logger.debug("Created market object for %s. Total market objects: %s", name, len(self.market_objects))
+        else:
+            ingest_logger.debug("Market object for %s already exists. Total market objects: %s", name, len(self.market_objects))
+        return self.market_objects[name]
+
+    def process(self, game_update, updates, devig_jobs=None):
+        """
+        Apply one queue item's updates to this shard's markets, then validate each market the item touched once,
+        after all of its bookmakers have been ingested.
+
+        Args:
+            game_update (GameUpdate): The game the updates came from, used for validation. Its own updates are not read.
+            updates (list): This shard's MarketUpdates, in queue order.
+            devig_jobs (list, optional): Collects the sharp pairs to devig instead of devigging them, see Market.update_market_data.
+
+        Returns:
+            list: The latency stage timestamps of every update, for MarketManager.latency.
+        """
+        game_id = game_update.game_id
+        self.event_ids.add(game_id)
+        stage_traces = []
+        touched = {}  # Market name: Market, in the order the item first updates them
+        for update in updates:
+            ingest_logger.debug("Updating market data.")
+            market = self.get_market(update.market_key)
+            stages = {'started': time.monotonic()}
+            market.update_market_data(update, game_id, update.bookmaker, stages, devig_jobs)
+            stage_traces.append(stages)
+            touched[market.name] = market
+
+        if self.validate_mode != 'off':
+            eventid = game_id if self.validate_mode == 'event' else None
+            for market in touched.values():
+                ingest_logger.debug("Validating market data.")
+                if not market.validate_data(game_update, self.event_ids, eventid):
+                    ingest_logger.error("Data in Market object does not match original game data for market %s.", market.name)
+                else:
+                    ingest_logger.info("Valid data for market %s. Data matches original game data.", market.name)
+
+                # market.compare_and_emit_outcomes()
+        return stage_traces
+
+    def evict_events(self, eventids):
+        """
+        Drop eventids from this shard's markets and event ids.
+
+        Returns:
+            int: The number of results dropped.
+        """
+        self.event_ids -= eventids
+        return sum(market.evict_events(eventids) for market in self.market_objects.values())
+
+shard_state = None  # The MarketShard of a worker process, created by init_shard_process
+
+def init_shard_process(min_bookmakers, columnar, validate_mode):
+    global shard_state
+    init_logging(filemode='a')  # Spawned workers have no handlers yet; forked ones keep the parent's
+    shard_state = MarketShard(min_bookmakers, columnar, validate_mode)
+
+def process_in_shard(game_update, updates):
+    return shard_state.process(game_update, updates)
+
+def markets_in_shard():
+    return shard_state.market_objects
+
+def evict_in_shard(eventids):
+    return shard_state.evict_events(eventids)
+
+SNAPSHOT_PATH = os.environ.get('ODDS_SNAPSHOT_PATH')  # Warm-start MarketManager from this snapshot and write it back after every run or poll cycle
+SNAPSHOT_MAGIC = b'ODDSNAP1'
+SNAPSHOT_COLUMNS = {  # table: ((column, array typecode), ...). String columns hold ids into the snapshot's string table.
+    'markets': (('name', 'I'),),
+    'prices': (('market', 'I'), ('bookmaker', 'I'), ('event', 'I'), ('name', 'I'), ('description', 'I'), ('point', 'd'), ('price', 'd')),
+    'results': (('market', 'I'), ('event', 'I'), ('name', 'I'), ('description', 'I'), ('point', 'd'),
+                ('calculation', 'I'), ('newover', 'd'), ('newunder', 'd'), ('count', 'I')),
+    'result_books': (('result', 'I'), ('bookmaker', 'I'), ('price', 'd')),
+    'received': (('event', 'I'), ('market', 'I'), ('bookmaker', 'I')),
+    'seen': (('event', 'I'), ('market', 'I'), ('bookmaker', 'I'), ('last_update', 'i'), ('hash', 'Q')),
+    'events': (('event', 'I'),),
+}
+
+HISTORY_PATH = os.environ.get('ODDS_HISTORY_PATH')  # Append every price change to the OddsHistory store in this directory
+
+def history_rows(pending):
+    """
+    Flatten queued games into OddsHistory rows.
+
+    Args:
+        pending (list): (unix timestamp, GameUpdate or raw payload) tuples, as collected by MarketManager.put.
+
+    Yields:
+        tuple: (timestamp, event, market, bookmaker, player, side, point, price) for every outcome.
+    """
+    for timestamp, game_market_data in pending:
+        game_update = game_market_data if isinstance(game_market_data, GameUpdate) else build_game_update(game_market_data)
+        if game_update is None:
+            continue
+        for market_update in game_update.updates:
+            for name, description, price, point in market_update.outcomes:
+                yield timestamp, game_update.game_id, market_update.market_key, market_update.bookmaker, description, name, point, price
+
+def snapshot_float(value):
+    return float('nan') if value is None else value
+
+def snapshot_value(value):
+    return None if value != value else value
+
+def load_into_shard(markets):
+    """
+    Add snapshot-restored markets to a worker process's shard.
+    """
+    for market in markets.values():
+        shard_state.event_ids.update(market.event_bookmakers)
+    shard_state.market_objects.update(markets)
+
+class MarketManager:
+    def __init__(self, min_bookmakers, columnar=False, validate_mode='full', batch_size=DRAIN_BATCH_SIZE, change_detection=True, workers=MARKET_WORKERS, worker_mode=MARKET_WORKER_MODE,
+                 devig_offload=DEVIG_OFFLOAD, devig_workers=DEVIG_WORKERS, devig_window=DEVIG_WINDOW, queue_size=QUEUE_MAXSIZE, queue_policy=QUEUE_POLICY, history_path=HISTORY_PATH):
+        self.market_objects = {}  # Stores market name: market object
+        self.columnar = columnar  # Create Market objects with a ColumnarOutcomeStore
+        self.validate_mode = validate_mode  # 'full' checks the whole market, 'event' only the event just ingested, 'off' skips validation
+        self.event_ids = set()  # Ids of every event ingested so far, passed to Market.validate_data
+        self.change_detector = ChangeDetector() if change_detection else None  # Skips payloads that have not changed since the last poll
+        self.queue = asyncio.Queue(maxsize=queue_size)  # Queue for data, bounded when queue_size > 0
+        self.queue_policy = queue_policy  # 'block' makes producers wait for room, 'drop_oldest' discards the oldest item
+        self.done_event = asyncio.Event()  # Event
+        self.min_bookmakers=min_bookmakers
+        self.received_bookmakers = {}  # Stores (game id, market key): set of bookmaker keys
+        self.batch_size = batch_size  # Most queue items drained and processed per wakeup of the consumer
+        self.metrics = {'items': 0, 'batches': 0, 'max_batch': 0, 'max_queue_depth': 0,
+                        'consumer_lag': 0.0, 'total_consumer_lag': 0.0, 'max_consumer_lag': 0.0,
+                        'blocked_puts': 0, 'producer_blocked_time': 0.0, 'max_producer_blocked': 0.0, 'dropped': 0, 'max_in_flight': 0}
+        self.latency = LatencyRecorder()  # Per-stage latency histograms, see LATENCY_SEGMENTS
+        # Markets are sharded by name over `workers` single-worker executors ('thread' or 'process'), so each market is
+        # only ever updated by one worker, in queue order. With 0 workers everything runs inline on the event loop.
+        self.workers = workers
+        self.worker_mode = worker_mode
+        self.executors = []
+        if workers and worker_mode == 'process':
+            self.shards = []  # The shards live in the worker processes, market_objects is filled by sync_markets
+            self.executors = [ProcessPoolExecutor(max_workers=1, initializer=init_shard_process, initargs=(min_bookmakers, columnar, validate_mode))
+                              for _ in range(workers)]
+        else:
+            self.shards = [MarketShard(min_bookmakers, columnar, validate_mode, self.market_objects, self.event_ids) for _ in range(max(1, workers))]
+            if workers:
+                self.executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"market-shard-{i}") for i in range(workers)]
+        # With devig_offload 'item' or 'window', the inline consumer collects the sharp pairs of each queue item (or of every
+        # item that arrives within devig_window) and devigs them in one run_in_executor call on a process pool.
+        # The market workers already keep devig off the event loop, so offloading only applies without them.
+        self.devig_offload = devig_offload if devig_offload in ('item', 'window') and not workers else 'off'
+        self.devig_window = devig_window
+        self.devig_executor = ProcessPoolExecutor(max_workers=devig_workers) if self.devig_offload != 'off' else None
+        # put only notes each game and when it arrived; flush_history writes them to the history store off the event loop
+        self.history = OddsHistory(history_path) if history_path else None
+        self.history_pending = []
+        ingest_logger.debug("MarketManager object initialized with %s bookmakers required", self.min_bookmakers)
+
+    def get_market(self, name):
+        """
+        Retrieves the market object for a given name from the shard that owns it, creates it if it doesn't exist.
+        With process workers, the market lives in a worker process and the last copy fetched by sync_markets is returned.
+
+        Args:
+            name (str): The name of the market.
+
+        Returns:
+            Market: The Market object for the given name.
+        """
+        if not self.shards:
+            return self.market_objects.get(name)
+        return self.shards[shard_for(name, len(self.shards))].get_market(name)
+    
+    async def put(self, game_market_data, trace=None):
+        """
+        Put game market data (or the None sentinel) on the queue, stamped with its enqueue time for the consumer lag metric.
+
+        When the queue is bounded and full, the 'block' policy waits for room and counts the wait in the producer blocked
+        metrics; 'drop_oldest' discards the oldest queued items instead. The sentinel always waits.
+
+        Args:
+            game_market_data (GameUpdate or dict): The fetched game, or None to stop the consumer.
+            trace (dict, optional): Timestamps collected so far for this item, e.g. by fetch_data. The enqueue,
+                                    dequeue and processed times are added to it and recorded in self.latency.
+        """
+        trace = {} if trace is None else trace
+        if self.queue.full() and self.queue_policy == 'drop_oldest' and game_market_data is not None:
+            while self.queue.full():
+                dropped, _ = self.queue.get_nowait()
+                self.queue.task_done()
+                self.metrics['dropped'] += 1
+                ingest_logger.warning("Queue full, dropped the oldest item for game %s.", game_id_of(dropped))
+        if self.queue.full():
+            blocked_at = time.monotonic()
+            await self.queue.put((game_market_data, trace))
+            blocked = time.monotonic() - blocked_at
+            self.metrics['blocked_puts'] += 1
+            self.metrics['producer_blocked_time'] += blocked
+            self.metrics['max_producer_blocked'] = max(self.metrics['max_producer_blocked'], blocked)
+        else:
+            self.queue.put_nowait((game_market_data, trace))
+        trace['enqueued'] = time.monotonic()  # The consumer cannot dequeue the item before this runs
+        if self.history is not None and game_market_data is not None:
+            self.history_pending.append((time.time(), game_market_data))
+
+    def get_metrics(self):
+        """
+        Returns:
+            dict: Queue depth, consumer lag and producer blocking metrics. Lag is the time an item spent on the queue
+                  before it was dequeued; producer blocked time is how long puts waited for room in a full queue.
+                  max_in_flight is the most items the market workers were processing at once.
+        """
+        metrics = dict(self.metrics)
+        metrics['queue_depth'] = self.queue.qsize()
+        metrics['queue_capacity'] = self.queue.maxsize
+        metrics['avg_consumer_lag'] = metrics['total_consumer_lag'] / metrics['items'] if metrics['items'] else 0.0
+        return metrics
+
+    async def update_market_data(self):
+        """
+        Updates market data from the queue continuously.
+
+        Every ready item is drained with get_nowait, up to batch_size at a time, and processed together;
+        the consumer only awaits when the queue is empty. With workers, each item's updates are handed to the
+        shards that own its markets and the consumer moves on to the next item while they run. With devig offloading,
+        the loop is free to run the fetchers while each item's (or window's) devig batch runs on the process pool.
+        """
+        ingest_logger.debug("Starting to update market data from the queue.")
+        in_flight = set()  # Items being processed by the workers
+        # Each dispatched item holds a slot until its shards are done, so items only leave the queue as fast as the
+        # workers finish them and a full queue still makes producers block or drop.
+        dispatch_slots = asyncio.Semaphore(self.queue.maxsize or self.batch_size)
+        while True:
+            ingest_logger.debug("Retrieving game market data from the queue.")
+            if self.executors:
+                await dispatch_slots.acquire()
+            batch = [await self.queue.get()]
+            if self.devig_offload == 'window' and batch[0][0] is not None and self.devig_window > 0:
+                await asyncio.sleep(self.devig_window)  # Let more items arrive so they share one devig batch
+            while len(batch) < self.batch_size and not (self.executors and dispatch_slots.locked()):
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if self.executors:
+                    await dispatch_slots.acquire()  # Free: the semaphore is not locked
+                batch.append(item)
+
+            dequeued_at = time.monotonic()
+            self.metrics['batches'] += 1
+            self.metrics['max_batch'] = max(self.metrics['max_batch'], len(batch))
+            self.metrics['max_queue_depth'] = max(self.metrics['max_queue_depth'], len(batch) + self.queue.qsize())
+            ingest_logger.debug("Drained %s items from the queue, %s still waiting.", len(batch), self.queue.qsize())
+
+            sentinel = False
+            devig_jobs = [] if self.devig_executor is not None else None
+            deferred = []  # Traces of the items waiting on the window's devig batch
+            for game_market_data, trace in batch:
+                lag = dequeued_at - trace['enqueued']
+                self.metrics['items'] += 1
+                self.metrics['consumer_lag'] = lag
+                self.metrics['total_consumer_lag'] += lag
+                self.metrics['max_consumer_lag'] = max(self.metrics['max_consumer_lag'], lag)
+                if game_market_data is None:  # Break the loop if the sentinel value is retrieved
+                    ingest_logger.debug("Sentinel value retrieved from the queue. Breaking the loop.")
+                    sentinel = True
+                    self.queue.task_done()
+                    if self.executors:
+                        dispatch_slots.release()
+                    continue
+                trace['dequeued'] = dequeued_at
+                if self.executors:
+                    task = asyncio.create_task(self.dispatch_game_market_data(game_market_data, trace))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    task.add_done_callback(lambda _: dispatch_slots.release())
+                    self.metrics['max_in_flight'] = max(self.metrics['max_in_flight'], len(in_flight))
+                    continue
+                if self.devig_offload == 'window':
+                    try:
+                        self.process_game_market_data(game_market_data, devig_jobs)
+                        deferred.append(trace)
+                    except Exception as e:
+                        ingest_logger.error("Error processing game market data for game %s: %s", game_id_of(game_market_data), e)
+                        self.queue.task_done()
+                    continue
+                try:
+                    self.process_game_market_data(game_market_data, devig_jobs)
+                    if devig_jobs:
+                        await self.run_devig_jobs(devig_jobs)
+                    trace['processed'] = time.monotonic()
+                    self.latency.record(trace)
+                except Exception as e:
+                    ingest_logger.error("Error processing game market data for game %s: %s", game_id_of(game_market_data), e)
+                finally:
+                    devig_jobs = [] if devig_jobs is not None else None
+                    self.queue.task_done()  # Lets poll cycles wait on queue.join() for everything they queued
+            if deferred:
+                try:
+                    await self.run_devig_jobs(devig_jobs)
+                    for trace in deferred:
+                        trace['processed'] = time.monotonic()
+                        self.latency.record(trace)
+                except Exception as e:
+                    ingest_logger.error("Error devigging a window of %s items: %s", len(deferred), e)
+                finally:
+                    for _ in deferred:
+                        self.queue.task_done()
+            if sentinel:
+                if in_flight:
+                    await asyncio.gather(*in_flight)
+                if self.worker_mode == 'process' and self.executors:
+                    await self.sync_markets()
+                break
+
+            if self.done_event.is_set():  # Check if done_event is set
+                ingest_logger.info("Done event is set. Breaking the loop.")
+
+    async def dispatch_game_market_data(self, game_market_data, trace):
+        """
+        Process one queue item on the shard workers and wait until every shard involved is done.
+
+        Args:
+            game_market_data (GameUpdate or dict): The fetched data for one game.
+            trace (dict): The item's latency timestamps.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            game_update, routed, pending = self.route_game_market_data(game_market_data)
+            if self.worker_mode == 'process':
+                view = game_update.validation_view()  # The updates themselves go to each shard separately
+                futures = [loop.run_in_executor(self.executors[shard], process_in_shard, view, updates) for shard, updates in routed.items()]
+            else:
+                futures = [loop.run_in_executor(self.executors[shard], self.shards[shard].process, game_update, updates) for shard, updates in routed.items()]
+            for stage_traces in await asyncio.gather(*futures):
+                for stages in stage_traces:
+                    self.latency.record(stages)
+            if self.change_detector is not None:
+                self.change_detector.record(pending)
+            trace['processed'] = time.monotonic()
+            self.latency.record(trace)
+        except Exception as e:
+            ingest_logger.error("Error processing game market data for game %s on the market workers: %s", game_id_of(game_market_data), e)
+        finally:
+            self.queue.task_done()
+
+    async def run_devig_jobs(self, devig_jobs):
+        """
+        Devig the sharp pairs collected by Market.update_market_data in one process pool call, then store every
+        job's results in the order the jobs were collected. Pairs already in the devig memo are not sent.
+
+        Args:
+            devig_jobs (list): (market, bookmaker, sharp_pairs, trace) tuples.
+        """
+        solved = {}  # (price1, price2, tolerance): (power devig result, mult devig result)
+        misses = {}  # tolerance: [(price1, price2)], one worker call per tolerance
+        for market, _, sharp_pairs, _ in devig_jobs:
+            tol = market.devig_tolerance
+            for _, _, price1, price2 in sharp_pairs:
+                if (price1, price2, tol) in solved:
+                    continue
+                power = devig_cache.get('power_devig', price1, price2, tol)
+                mult = devig_cache.get('mult_devig', price1, price2)
+                solved[(price1, price2, tol)] = (power, mult)
+                if power is None or mult is None:
+                    misses.setdefault(tol, []).append((price1, price2))
+
+        loop = asyncio.get_running_loop()
+        for tol, tol_misses in misses.items():
+            prices1 = [price1 for price1, _ in tol_misses]
+            prices2 = [price2 for _, price2 in tol_misses]
+            try:
+                power_results, mult_results = await loop.run_in_executor(self.devig_executor, devig_batch_job, prices1, prices2, tol)
+            except Exception as e:
+                devig_logger.error("Devig worker failed on %s pairs, devigging them inline: %s", len(tol_misses), e)
+                power_results, mult_results = devig_batch_job(prices1, prices2, tol)
+            for (price1, price2), power, mult in zip(tol_misses, power_results, mult_results):
+                solved[(price1, price2, tol)] = (power, mult)
+                devig_cache.set('power_devig', price1, price2, power, tol)
+                devig_cache.set('mult_devig', price1, price2, mult)
+            devig_logger.debug("Devigged %s of %s distinct pairs from %s jobs on the process pool.", len(tol_misses), len(solved), len(devig_jobs))
+
+        for market, bookmaker, sharp_pairs, trace in devig_jobs:
+            pairs = [(price1, price2) for _, _, price1, price2 in sharp_pairs]
+            results = [solved[(price1, price2, market.devig_tolerance)] for price1, price2 in pairs]
+            market.store_devig_results(bookmaker, sharp_pairs, market.calculate_batch(pairs, ([power for power, _ in results], [mult for _, mult in results])))
+            if trace is not None:
+                self.latency.record({'decereal_done': trace['decereal_done'], 'devig_done': time.monotonic()})
+
+    async def sync_markets(self):
+        """
+        Copy the Market objects out of the process workers into market_objects. Does nothing without process workers.
+        """
+        if self.worker_mode != 'process' or not self.executors:
+            return
+        loop = asyncio.get_running_loop()
+        for markets in await asyncio.gather(*(loop.run_in_executor(executor, markets_in_shard) for executor in self.executors)):
+            self.market_objects.update(markets)
+        ingest_logger.debug("Synced %s market objects from %s worker processes.", len(self.market_objects), len(self.executors))
+
+    async def evict_events(self, eventids):
+        """
+        Drop every trace of eventids: their prices, pairs and results in every market, their received bookmakers,
+        change detector entries and event ids, and so their rows in the next snapshot. Call it between poll cycles,
+        once the queue has been processed.
+
+        Args:
+            eventids (iterable): The ids of the events to drop.
+
+        Returns:
+            int: The number of results dropped.
+        """
+        eventids = set(eventids)
+        if not eventids:
+            return 0
+        self.received_bookmakers = {key: bookmakers for key, bookmakers in self.received_bookmakers.items() if key[0] not in eventids}
+        if self.change_detector is not None:
+            self.change_detector.evict(eventids)
+        loop = asyncio.get_running_loop()
+        if self.worker_mode == 'process' and self.executors:
+            dropped = sum(await asyncio.gather(*(loop.run_in_executor(executor, evict_in_shard, eventids) for executor in self.executors)))
+            await self.sync_markets()  # Replace the copies still holding the evicted events
+        elif self.executors:
+            dropped = sum(await asyncio.gather(*(loop.run_in_executor(executor, shard.evict_events, eventids) for shard, executor in zip(self.shards, self.executors))))
+        else:
+            dropped = self.shards[0].evict_events(eventids)
+        self.event_ids -= eventids
+        ingest_logger.info("Evicted %s events and %s results.", len(eventids), dropped)
+        return dropped
+
+    async def flush_history(self):
+        """
+        Append the games put since the last flush to the history store, in a worker thread. Does nothing without one.
+        """
+        if self.history is None or not self.history_pending:
+            return
+        pending, self.history_pending = self.history_pending, []
+        written = await asyncio.get_running_loop().run_in_executor(None, self.history.append, history_rows(pending))
+        ingest_logger.debug("Appended %s price changes from %s games to the odds history.", written, len(pending))
+
+    def close(self):
+        """
+        Shut down the shard workers and the devig pool, and write any games still waiting for the history store.
+        """
+        if self.history is not None and self.history_pending:
+            pending, self.history_pending = self.history_pending, []
+            self.history.append(history_rows(pending))
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+        self.executors = []
+        if self.devig_executor is not None:
+            self.devig_executor.shutdown(wait=True)
+            self.devig_executor = None
+
+    def save_snapshot(self, path):
+        """
+        Write the markets, received bookmakers and change detector state to a compact binary snapshot.
+
+        Every string is stored once in a string table and every row as columns of typed arrays, behind a small JSON
+        header giving each column's length. The file is written next to path and renamed over it, so a crash never
+        leaves a half-written snapshot. With process workers, call sync_markets first so market_objects is current.
+
+        Args:
+            path (str): The snapshot file.
+        """
+        started = time.monotonic()
+        strings = InternTable()
+        columns = {table: {column: array(typecode) for column, typecode in spec} for table, spec in SNAPSHOT_COLUMNS.items()}
+        prices, results, result_books = columns['prices'], columns['results'], columns['result_books']
+        for market_index, (market_name, market) in enumerate(self.market_objects.items()):
+            columns['markets']['name'].append(strings.intern(market_name))
+            for bookmaker, book_outcomes in market.bookmakers.items():
+                bookmaker_id = strings.intern(bookmaker)
+                for (eventid, name, description, point), outcome_prices in book_outcomes.items():
+                    for column, value in (('market', market_index), ('bookmaker', bookmaker_id), ('event', strings.intern(eventid)), ('name', strings.intern(name)),
+                                          ('description', strings.intern(description)), ('point', snapshot_float(point)), ('price', snapshot_float(outcome_prices[bookmaker]))):
+                        prices[column].append(value)
+            for (eventid, name, description, point), calculations in market.results.items():
+                for calculation, result in calculations.items():
+                    result_index = len(results['market'])
+                    for column, value in (('market', market_index), ('event', strings.intern(eventid)), ('name', strings.intern(name)),
+                                          ('description', strings.intern(description)), ('point', snapshot_float(point)), ('calculation', strings.intern(calculation)),
+                                          ('newover', result['newover']), ('newunder', result['newunder']), ('count', result['count'])):
+                        results[column].append(value)
+                    for bookmaker, price in result['bookmakers'].items():
+                        result_books['result'].append(result_index)
+                        result_books['bookmaker'].append(strings.intern(bookmaker))
+                        result_books['price'].append(snapshot_float(price))
+        for (game_id, market_key), received_bookmakers in self.received_bookmakers.items():
+            for bookmaker in received_bookmakers:
+                columns['received']['event'].append(strings.intern(game_id))
+                columns['received']['market'].append(strings.intern(market_key))
+                columns['received']['bookmaker'].append(strings.intern(bookmaker))
+        if self.change_detector is not None:
+            seen = columns['seen']
+            for (eventid, market_key, bookmaker), (last_update, content_hash) in self.change_detector.seen.items():
+                seen['event'].append(strings.intern(eventid))
+                seen['market'].append(strings.intern(market_key))
+                seen['bookmaker'].append(strings.intern(bookmaker))
+                seen['last_update'].append(-1 if last_update is None else strings.intern(last_update))
+                seen['hash'].append(content_hash)
+        for eventid in self.event_ids:
+            columns['events']['event'].append(strings.intern(eventid))
+
+        string_blob = '\0'.join(strings.values).encode()
+        header = json.dumps({'byteorder': sys.byteorder, 'strings': [len(strings), len(string_blob)],
+                             'columns': {table: {column: len(values) for column, values in table_columns.items()} for table, table_columns in columns.items()}}).encode()
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_MAGIC + len(header).to_bytes(4, 'little') + header + string_blob)
+            for table_columns in columns.values():
+                for values in table_columns.values():
+                    values.tofile(snapshot_file)
+        os.replace(temporary_path, path)
+        ingest_logger.info("Saved snapshot of %s markets and %s prices to %s in %.1f ms.", len(self.market_objects), len(prices['price']), path, (time.monotonic() - started) * 1000)
+
+    def load_snapshot(self, path):
+        """
+        Restore markets, received bookmakers and change detector state from a snapshot written by save_snapshot.
+        Restored markets are ready to compare against, and payloads that have not changed since the snapshot are skipped.
+        Call it before the consumer starts.
+
+        Args:
+            path (str): The snapshot file.
+
+        Returns:
+            bool: True if the snapshot was loaded, False if it is missing or unreadable.
+        """
+        started = time.monotonic()
+        try:
+            with open(path, 'rb') as snapshot_file:
+                data = snapshot_file.read()
+            if not data.startswith(SNAPSHOT_MAGIC):
+                raise ValueError("not a snapshot file")
+            offset = len(SNAPSHOT_MAGIC) + 4
+            header_end = offset + int.from_bytes(data[len(SNAPSHOT_MAGIC):offset], 'little')
+            header = json.loads(data[offset:header_end])
+            string_count, blob_length = header['strings']
+            offset = header_end + blob_length
+            strings = data[header_end:offset].decode().split('\0') if string_count else []
+            columns = {}
+            for table, spec in SNAPSHOT_COLUMNS.items():
+                columns[table] = {}
+                for column, typecode in spec:
+                    values = array(typecode)
+                    end = offset + header['columns'][table][column] * values.itemsize
+                    values.frombytes(data[offset:end])
+                    if header['byteorder'] != sys.byteorder:
+                        values.byteswap()
+                    columns[table][column] = values
+                    offset = end
+        except (OSError, ValueError, KeyError) as e:
+            ingest_logger.warning("Could not load snapshot %s: %s", path, e)
+            return False
+
+        markets = [Market(strings[name], strings[name], self.min_bookmakers, columnar=self.columnar) for name in columns['markets']['name']]
+        prices = columns['prices']
+        for market_index, bookmaker, eventid, name, description, point, price in zip(*prices.values()):
+            markets[market_index].restore_price(strings[bookmaker], (strings[eventid], strings[name], strings[description], snapshot_value(point)), snapshot_value(price))
+        results = columns['results']
+        stored_results = []
+        for market_index, eventid, name, description, point, calculation, newover, newunder, count in zip(*results.values()):
+            stored = {'newover': newover, 'newunder': newunder, 'count': count, 'bookmakers': {}}
+            outcome_key = (strings[eventid], strings[name], strings[description], snapshot_value(point))
+            markets[market_index].results.setdefault(outcome_key, {})[strings[calculation]] = stored
+            stored_results.append(stored)
+        for result_index, bookmaker, price in zip(*columns['result_books'].values()):
+            stored_results[result_index]['bookmakers'][strings[bookmaker]] = snapshot_value(price)
+        for eventid, market_key, bookmaker in zip(*columns['received'].values()):
+            self.received_bookmakers.setdefault((strings[eventid], strings[market_key]), set()).add(strings[bookmaker])
+        if self.change_detector is not None:
+            for eventid, market_key, bookmaker, last_update, content_hash in zip(*columns['seen'].values()):
+                self.change_detector.seen[(strings[eventid], strings[market_key], strings[bookmaker])] = (None if last_update < 0 else strings[last_update], content_hash)
+        self.event_ids.update(strings[eventid] for eventid in columns['events']['event'])
+
+        restored = {market.name: market for market in markets}
+        for shard, executor in enumerate(self.executors if not self.shards else []):  # Thread and inline shards share market_objects
+            executor.submit(load_into_shard, {name: market for name, market in restored.items() if shard_for(name, len(self.executors)) == shard}).result()
+        self.market_objects.update(restored)
+        ingest_logger.info("Loaded snapshot of %s markets and %s prices from %s in %.1f ms.", len(markets), len(prices['price']), path, (time.monotonic() - started) * 1000)
+        return True
+
+    def report_missing_bookmakers(self, bookmakers):
+        """
+        Log, for every game and market received, which of the requested bookmakers were not received.
+
+        Args:
+            bookmakers (list): The bookmakers that were requested.
+        """
+        for (game_id, market_key), received_bookmakers in self.received_bookmakers.items():
+            missing_bookmakers = set(bookmakers) - received_bookmakers
+            if missing_bookmakers:
+                ingest_logger.warning("For game %s, market %s, the following requested bookmakers were not received: %s", game_id, market_key, ', '.join(missing_bookmakers))
+            else:
+                ingest_logger.info("All requested bookmakers received for game %s, market %s.", game_id, market_key)
+
+    def route_game_market_data(self, game_market_data):
+        """
+        Split one queue item into per-shard market updates, skipping unchanged market data.
+
+        Args:
+            game_market_data (GameUpdate or dict): The queued game. Raw payloads, e.g. from replay.py, are converted with build_game_update.
+
+        Returns:
+            tuple: The GameUpdate (None if the payload was invalid), a dict of shard index: list of MarketUpdate, in the
+                   order they appear in the item, and the payloads to pass to ChangeDetector.record once the item has
+                   been processed.
+        """
+        routed = {}
+        pending = {}
+        game_update = game_market_data if isinstance(game_market_data, GameUpdate) else build_game_update(game_market_data)
+        if game_update is None:
+            return None, routed, pending
+        game_id = game_update.game_id
+        self.event_ids.add(game_id)
+        shards = max(1, self.workers)
+
+        for update in game_update.updates:
+            received_bookmakers = self.received_bookmakers.get((game_id, update.market_key))
+            if received_bookmakers is None:
+                received_bookmakers = self.received_bookmakers[(game_id, update.market_key)] = set()
+            received_bookmakers.add(update.bookmaker)
+
+            if self.change_detector is not None and not self.change_detector.has_changed(game_id, update.market_key, update.bookmaker, update, pending):
+                ingest_logger.debug("Market %s from %s for game %s is unchanged. Skipping update.", update.market_key, update.bookmaker, game_id)
+                continue
+
+            routed.setdefault(shard_for(update.market_key, shards), []).append(update)
+        return game_update, routed, pending
+
+    def process_game_market_data(self, game_market_data, devig_jobs=None):
+        """
+        Update every market in one queue item on the calling thread.
+
+        Args:
+            game_market_data (GameUpdate or dict): The fetched data for one game.
+            devig_jobs (list, optional): Collects the sharp pairs to devig for run_devig_jobs instead of devigging them inline.
+        """
+        game_update, routed, pending = self.route_game_market_data(game_market_data)
+        for shard, updates in routed.items():
+            for stages in self.shards[shard].process(game_update, updates, devig_jobs):
+                self.latency.record(stages)
+        if self.change_detector is not None:
+            self.change_detector.record(pending)
+
+api_call_count = 0  # Global variable to count API calls
+import json
+import re
+try:
+    import orjson  # Faster JSON backend, used when installed
+    json_loads = orjson.loads
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    json_loads = json.loads
+    JSON_BACKEND = 'json'
+try:
+    import ijson  # Incremental parser for the streaming decode path
+except ImportError:
+    ijson = None
+STREAM_JSON = ijson is not None and os.environ.get('ODDS_STREAM_JSON', '0') == '1'  # Build event odds into GameUpdates as the body arrives
+
+API_BASE_URL = os.environ.get('ODDS_API_BASE_URL', 'https://api.the-odds-api.com/v4')  # Point at stub_server.py for local runs
+API_KEY_PATTERN = re.compile(r'apiKey=[^&]*')
+API_KEY_RATE = 10  # Requests per second allowed on each API key
+API_KEY_BURST = 10  # Requests each API key may send back to back
+API_KEY_COOLDOWN = 1.0  # Seconds a key rests after a 429 rate limit response
+API_KEY_QUOTA_RECHECK = 300  # Seconds before a key that ran out of quota is tried again, in case its quota was reset
+RATE_LIMIT_RETRIES = 3  # Extra attempts a request gets for 429s on top of one per API key
+BOOKMAKERS_PER_REGION = 10  # The API bills every 10 bookmakers of an event odds request as one region
+MAX_URL_LENGTH = int(os.environ.get('ODDS_MAX_URL_LENGTH', 2048))  # Longest event odds URL RequestPlanner builds
+
+SESSION_CONFIG = {
+    'limit': 20,  # Total pooled connections
+    'limit_per_host': 10,  # Connections kept open to api.the-odds-api.com
+    'ttl_dns_cache': 300,  # Seconds a resolved host is cached
+    'keepalive_timeout': 60,  # Seconds an idle connection stays in the pool for reuse
+    'total_timeout': 30,
+    'connect_timeout': 5,
+    'sock_read_timeout': 15,
+    'compress': True,  # Ask for gzip/deflate encoded responses
+}
+
+class SessionStats:
+    """
+    Connection pool statistics collected through aiohttp request tracing.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+
+    def trace_config(self):
+        """
+        Returns:
+            aiohttp.TraceConfig: A trace config that feeds this object, to pass to aiohttp.ClientSession.
+        """
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(self._on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(self._on_dns_cache_miss)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        self.requests += 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.new_connections += 1
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self.reused_connections += 1
+
+    async def _on_dns_cache_hit(self, session, context, params):
+        self.dns_cache_hits += 1
+
+    async def _on_dns_cache_miss(self, session, context, params):
+        self.dns_cache_misses += 1
+
+    def reuse_rate(self):
+        """
+        Returns:
+            float: The fraction of connections handed out that were reused from the pool.
+        """
+        connections = self.new_connections + self.reused_connections
+        return self.reused_connections / connections if connections else 0.0
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'reuse_rate': self.reuse_rate(),
+            'dns_cache_hits': self.dns_cache_hits,
+            'dns_cache_misses': self.dns_cache_misses
+        }
+
+class TokenBucket:
+    """
+    A token bucket refilled at rate tokens per second up to capacity.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self, now):
+        """
+        Returns:
+            bool: True if a token was available and has been taken.
+        """
+        if self.refill(now) >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        """
+        Returns:
+            float: Seconds until the next token is available.
+        """
+        return max(0.0, (1 - self.refill(now)) / self.rate)
+
+class ApiKeyScheduler:
+    """
+    Chooses the API key for every request before it is sent.
+
+    Each key is paced by its own token bucket and tracked from the x-requests-remaining and x-requests-used
+    response headers. acquire() hands out the key with the most quota headroom that has a token, so requests are
+    spread before a key runs dry instead of reacting to 429s with backoff sleeps. Each request reserves its quota
+    units (markets x regions) on its key until release, so concurrent multi-market requests cannot overrun a key.
+
+    A 429 only rests its key for cooldown seconds. A key is marked exhausted by a quota message or when its headers
+    show no requests remaining; it is tried again every quota_recheck seconds and recovers as soon as a response shows
+    quota again.
+    """
+    def __init__(self, api_keys, rate=API_KEY_RATE, burst=API_KEY_BURST, cooldown=API_KEY_COOLDOWN, quota_recheck=API_KEY_QUOTA_RECHECK):
+        """
+        Args:
+            api_keys (list): The API keys to schedule.
+            rate (float, optional): Requests per second per key. Defaults to API_KEY_RATE.
+            burst (int, optional): Token bucket capacity per key. Defaults to API_KEY_BURST.
+            cooldown (float, optional): Seconds a key rests after a 429. Defaults to API_KEY_COOLDOWN.
+            quota_recheck (float, optional): Seconds between retries of an exhausted key. Defaults to API_KEY_QUOTA_RECHECK.
+        """
+        self.cooldown = cooldown
+        self.quota_recheck = quota_recheck
+        self.keys = {
+            key: {'bucket': TokenBucket(rate, burst), 'remaining': None, 'used': None, 'in_flight': 0, 'reserved': 0, 'requests': 0,
+                  'exhausted': False, 'exhausted_at': None, 'cooldown_until': 0.0, 'rate_limited': 0}
+            for key in dict.fromkeys(api_keys)
+        }
+        self.throttled_time = 0.0  # Seconds spent waiting for a token, a cool-down or reserved quota to be released
+        self.released = asyncio.Event()  # Set by release, woken on by requests waiting for reserved quota
+
+    def headroom(self, key):
+        """
+        Returns:
+            float: The quota units left on key according to its last response, less those reserved by requests in
+                   flight. Unknown keys have infinite headroom.
+        """
+        state = self.keys[key]
+        if state['remaining'] is None:
+            return float('inf')
+        return state['remaining'] - state['reserved']
+
+    def usable(self, key, now, cost=1):
+        """
+        Returns:
+            bool: True if key may be handed out for a request of cost quota units once it has a token and its
+                  cool-down is over.
+        """
+        state = self.keys[key]
+        if state['exhausted']:  # One probe request at a time, every quota_recheck seconds
+            return state['in_flight'] == 0 and now - state['exhausted_at'] >= self.quota_recheck
+        return self.headroom(key) >= cost
+
+    async def acquire(self, cost=1):
+        """
+        Wait for a token and return the key with the most headroom, reserving cost quota units on it.
+
+        Args:
+            cost (int, optional): The quota units the request is billed, markets x regions. Defaults to 1.
+
+        Returns:
+            str: The API key to send the next request with, or None if no key has cost quota units left.
+        """
+        while True:
+            now = time.monotonic()
+            candidates = [key for key in self.keys if self.usable(key, now, cost)]
+            if not candidates:
+                # Wait if a key would have the units once the requests in flight on it are released
+                if not any(not state['exhausted'] and state['reserved'] and state['remaining'] >= cost for state in self.keys.values()):
+                    return None
+                self.released.clear()
+                await self.released.wait()
+                self.throttled_time += time.monotonic() - now
+                continue
+            for key in sorted(candidates, key=lambda key: (self.headroom(key), -self.keys[key]['in_flight']), reverse=True):
+                state = self.keys[key]
+                if state['cooldown_until'] <= now and state['bucket'].take(now):
+                    state['in_flight'] += 1
+                    state['reserved'] += cost
+                    state['requests'] += 1
+                    return key
+            wait = min(max(self.keys[key]['cooldown_until'] - now, self.keys[key]['bucket'].wait_time(now)) for key in candidates)
+            self.throttled_time += wait
+            await asyncio.sleep(wait)
+
+    def release(self, key, headers=None, exhausted=False, rate_limited=False, cost=1):
+        """
+        Record the outcome of a request sent with key and free the quota units it reserved.
+
+        Args:
+            key (str): The key returned by acquire.
+            headers (Mapping, optional): The response headers, read for x-requests-remaining and x-requests-used.
+            exhausted (bool, optional): True if the response was a quota message. Defaults to False.
+            rate_limited (bool, optional): True if the response was a 429. Defaults to False.
+            cost (int, optional): The cost passed to acquire. Defaults to 1.
+        """
+        state = self.keys[key]
+        state['in_flight'] -= 1
+        state['reserved'] -= cost
+        self.released.set()
+        now = time.monotonic()
+        if headers is not None:
+            remaining = headers.get('x-requests-remaining')
+            used = headers.get('x-requests-used')
+            if remaining is not None:
+                state['remaining'] = float(remaining)
+                if state['remaining'] <= 0:
+                    exhausted = True
+                elif state['exhausted'] and not exhausted:
+                    state['exhausted'] = False
+                    fetch_logger.info("API key ending %s has quota again.", key[-4:])
+            if used is not None:
+                state['used'] = float(used)
+        if rate_limited:
+            state['rate_limited'] += 1
+            state['cooldown_until'] = now + self.cooldown
+            state['bucket'].tokens = 0  # Start the key's burst over once the cool-down ends
+            fetch_logger.warning("API key ending %s was rate limited, resting it for %s seconds.", key[-4:], self.cooldown)
+        if exhausted:
+            if not state['exhausted']:
+                fetch_logger.warning("API key ending %s is out of quota.", key[-4:])
+            state['exhausted'] = True
+            state['exhausted_at'] = now
+
+    def stats(self):
+        return {
+            'keys': {key[-4:]: {name: value for name, value in state.items() if name != 'bucket'} for key, state in self.keys.items()},
+            'throttled_time': self.throttled_time
+        }
+
+async def read_json(response):
+    """
+    Decode a JSON response body.
+
+    The body is read as bytes and decoded with the fastest installed backend (JSON_BACKEND), skipping the
+    intermediate str.
+
+    Args:
+        response (aiohttp.ClientResponse): The response to read.
+
+    Returns:
+        The decoded JSON value.
+    """
+    return json_loads(await response.read())
+
+async def read_game_update(response):
+    """
+    Parse an event odds body incrementally into a GameUpdate as it arrives.
+
+    Only one bookmaker of the payload is held as a dict at a time: as soon as a 'bookmakers' item is complete it is
+    turned into MarketUpdates by build_market_updates and dropped, so the whole response is never built. Bookmakers
+    without markets are left out, as fetch_and_update_market_data does for decoded payloads.
+
+    Args:
+        response (aiohttp.ClientResponse): The event odds response to read.
+
+    Returns:
+        GameUpdate or dict: The game's GameUpdate, or the body's {'message': ...} if the API answered with an error.
+    """
+    game_id = message = builder = None
+    updates = []
+    bookmaker_markets = {}
+    async for prefix, event, value in ijson.parse_async(response.content, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'bookmakers.item' and event == 'end_map':
+                bookmaker_data = builder.value
+                builder = None
+                if not bookmaker_data.get('markets'):
+                    continue
+                built = build_market_updates(bookmaker_data)
+                if built is not None:
+                    bookmaker, market_keys, bookmaker_updates = built
+                    bookmaker_markets[bookmaker] = market_keys
+                    updates.extend(bookmaker_updates)
+        elif prefix == 'bookmakers.item' and event == 'start_map':
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == 'id':
+            game_id = sys.intern(value)
+        elif prefix == 'message':
+            message = value
+    if game_id is None:
+        return {'message': message or ''}
+    return GameUpdate(game_id, tuple(updates), bookmaker_markets)
+
+def create_session(config=None, stats=None):
+    """
+    Create an aiohttp session with a pooled, keep-alive connector tuned for the-odds-api fan-out.
+
+    Args:
+        config (dict, optional): Overrides for SESSION_CONFIG.
+        stats (SessionStats, optional): Collects connection reuse statistics for the session's lifetime.
+
+    Returns:
+        aiohttp.ClientSession: The configured session. The caller owns it and must close it.
+    """
+    config = {**SESSION_CONFIG, **(config or {})}
+    connector = aiohttp.TCPConnector(
+        limit=config['limit'],
+        limit_per_host=config['limit_per_host'],
+        ttl_dns_cache=config['ttl_dns_cache'],
+        use_dns_cache=config['ttl_dns_cache'] is not None,
+        keepalive_timeout=config['keepalive_timeout']
+    )
+    timeout = aiohttp.ClientTimeout(total=config['total_timeout'], connect=config['connect_timeout'], sock_read=config['sock_read_timeout'])
+    headers = {'Accept-Encoding': 'gzip, deflate' if config['compress'] else 'identity'}
+    trace_configs = [stats.trace_config()] if stats is not None else None
+    fetch_logger.debug("Creating session with config: %s", config)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, trace_configs=trace_configs)
+
+async def fetch_data(session, url, api_keys, current_key_index=0, retry_count=0, scheduler=None, trace=None, cost=1, stream=False):
+
+    """
+    Fetch data from a given URL. If the response status is 429 or the message in the data dictionary contains 'quota', 
+    retry the request with exponential backoff and swapping API keys.
+    With a scheduler, the key is chosen before every request and the request is retried on the next best key without
+    backoff: a key out of quota is set aside and a rate limited key rests until its cool-down ends.
+
+    Args:
+        session (aiohttp.ClientSession): The aiohttp session to use for the request.
+        url (str): The URL to fetch data from.
+        api_keys (list): The list of API keys to use for the request.
+        current_key_index (int, optional): The index of the current API key in the list. Defaults to 0.
+        retry_count (int, optional): The number of times the request has been retried. Defaults to 0.
+        scheduler (ApiKeyScheduler, optional): Picks and paces the API key for each request. Defaults to None.
+        trace (dict, optional): Gets the time.monotonic() timestamps 'request_start', taken before the first attempt,
+                                and 'response_received', taken once the body of the last attempt is decoded, and
+                                counts the requests sent, retries included, in 'attempts'.
+        cost (int, optional): The quota units the request is billed, reserved on the scheduler's key. Defaults to 1.
+        stream (bool, optional): The URL is an event odds request; parse its body incrementally with read_game_update
+                                 instead of decoding it whole. Defaults to False.
+
+    Returns:
+        dict: The fetched data. It's a dictionary with keys depending on the fetched data, or a GameUpdate with stream.
+    """
+
+    global total_delay_time
+    if trace is not None:
+        trace.setdefault('request_start', time.monotonic())
+    key = None
+    if scheduler is not None:
+        key = await scheduler.acquire(cost)
+        if key is None:
+            fetch_logger.error("No API key has quota left for %s.", url)
+            return None
+        url = API_KEY_PATTERN.sub(f"apiKey={key}", url)
+    # Fetch data from a given URL
+    try:
+
+        async with session.get(url) as response:
+            global api_call_count
+            api_call_count += 1
+            fetch_logger.debug("API call #%s to %s", api_call_count, url)
+            if trace is not None:
+                trace['attempts'] = trace.get('attempts', 0) + 1
+            data_dict = await (read_game_update(response) if stream else read_json(response))  # Decode the response body
+            if trace is not None:
+                trace['response_received'] = time.monotonic()
+            rate_limited = response.status == 429
+            quota_hit = isinstance(data_dict, dict) and 'quota' in data_dict.get('message', '')
+            if scheduler is not None:
+                scheduler.release(key, response.headers, quota_hit, rate_limited, cost)
+                key = None
+            if quota_hit or rate_limited:
+                if retry_count >= len(api_keys) + (RATE_LIMIT_RETRIES if rate_limited else 0):  # Retry limit
+                    fetch_logger.error("Too many requests to %s. Giving up after %s retries.", url, retry_count)
+                    return None
+                if scheduler is not None:
+                    # The scheduler has already marked or rested the key, so go straight to the one with the most headroom
+                    return await fetch_data(session, url, api_keys, current_key_index, retry_count + 1, scheduler, trace, cost, stream)
+                delay = 2 ** retry_count if retry_count > 0 else 0
+                await asyncio.sleep(delay)  # exponential backoff
+                async with get_total_delay_time_lock():
+                    global total_delay_time
+                    total_delay_time += delay
+                fetch_logger.debug("Exponential backoff delay: %s seconds. Total delay time: %s seconds.", delay, total_delay_time)
+                # Swap API keys
                 current_key_index = (current_key_index + 1) % len(api_keys)
                 url = url.replace(api_keys[current_key_index-1], api_keys[current_key_index])  # Update the url with the new API key
-                logging.debug(f"Swapping API keys. New key index: {current_key_index}. New URL: {url}")
+                fetch_logger.debug("Swapping API keys. New key index: %s. New URL: %s", current_key_index, url)
                 retry_count += 1
-                return await fetch_data(session, url, api_keys, current_key_index, retry_count)
+                return await fetch_data(session, url, api_keys, current_key_index, retry_count, trace=trace, stream=stream)
             else:
                 # Extract the response headers
                 remaining_requests = response.headers.get('x-requests-remaining')
                 used_requests = response.headers.get('x-requests-used')
-                logging.debug(f"Remaining requests: {remaining_requests}, Used requests: {used_requests}")
+                fetch_logger.debug("Remaining requests: %s, Used requests: %s", remaining_requests, used_requests)
                 return data_dict
     except Exception as e:
-        logging.error(f"Error fetching data: {e}")
+        fetch_logger.error("Error fetching data: %s", e)
         return None
+    finally:
+        if key is not None:  # The request failed before a response was read
+            scheduler.release(key, cost=cost)
+
+POLL_INTERVALS = {}  # (sport, market): seconds between polls, overriding DEFAULT_POLL_INTERVAL
+DEFAULT_POLL_INTERVAL = 60
+
+ADAPTIVE_MIN_INTERVAL = 30  # Seconds between polls of a game at or near tip-off
+ADAPTIVE_MAX_INTERVAL = 1800  # Seconds between polls of a game far from tip-off with quiet lines
+ADAPTIVE_NEAR_HOURS = 1  # Games starting within this many hours poll at ADAPTIVE_MIN_INTERVAL
+ADAPTIVE_FAR_HOURS = 48  # Games this many hours away or more poll at ADAPTIVE_MAX_INTERVAL
+ADAPTIVE_VOLATILITY_SCALE = 0.01  # Mean implied probability move that halves the interval
+ADAPTIVE_EARLY_FRACTION = 0.25  # Markets this close to due, as a fraction of their interval, ride along with a due one
 
-async def fetch_and_update_market_data(session, game, market_manager, bookmakers, markets, api_keys, current_key_index=0):
+def parse_commence_time(commence_time):
+    """
+    Returns:
+        float: The unix timestamp of an ISO commence_time such as '2023-12-02T00:00:00Z', or None if it cannot be parsed.
+    """
+    try:
+        return datetime.fromisoformat(commence_time.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+class AdaptivePollScheduler:
+    """
+    Decides per (event, market) whether a poll is due.
+
+    The interval shrinks from ADAPTIVE_MAX_INTERVAL for games ADAPTIVE_FAR_HOURS away to ADAPTIVE_MIN_INTERVAL
+    within ADAPTIVE_NEAR_HOURS of commence_time, and shrinks further for markets whose prices moved recently.
+    Alongside, a fixed-interval poller at base_interval is simulated, so the requests saved can be reported. Both
+    sides count the games list requests and the event requests actually planned for the games left after coverage
+    pruning, along with their quota units.
+    """
+    def __init__(self, base_interval=DEFAULT_POLL_INTERVAL, min_interval=ADAPTIVE_MIN_INTERVAL, max_interval=ADAPTIVE_MAX_INTERVAL,
+                 near_hours=ADAPTIVE_NEAR_HOURS, far_hours=ADAPTIVE_FAR_HOURS, volatility_scale=ADAPTIVE_VOLATILITY_SCALE, smoothing=0.5,
+                 early_fraction=ADAPTIVE_EARLY_FRACTION):
+        """
+        Args:
+            base_interval (float, optional): The fixed polling interval savings are measured against. Defaults to DEFAULT_POLL_INTERVAL.
+            min_interval (float, optional): The shortest interval. Defaults to ADAPTIVE_MIN_INTERVAL.
+            max_interval (float, optional): The longest interval. Defaults to ADAPTIVE_MAX_INTERVAL.
+            near_hours (float, optional): Hours before tip-off at which min_interval applies. Defaults to ADAPTIVE_NEAR_HOURS.
+            far_hours (float, optional): Hours before tip-off from which max_interval applies. Defaults to ADAPTIVE_FAR_HOURS.
+            volatility_scale (float, optional): The mean implied probability move that halves the interval. Defaults to ADAPTIVE_VOLATILITY_SCALE.
+            smoothing (float, optional): Weight of the newest observation in the volatility moving average. Defaults to 0.5.
+            early_fraction (float, optional): Markets within this fraction of their interval of being due are polled
+                                              with the ones that are, so games share a games list request instead of
+                                              drifting apart. Defaults to ADAPTIVE_EARLY_FRACTION.
+        """
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.near_hours = near_hours
+        self.far_hours = far_hours
+        self.volatility_scale = volatility_scale
+        self.smoothing = smoothing
+        self.early_fraction = early_fraction
+        self.last_polled = {}  # (eventid, market): time of the last adaptive poll
+        self.last_baseline = {}  # sport or eventid: time of the last simulated fixed-interval games list or event poll
+        self.volatility = {}  # (eventid, market): moving average of the mean absolute implied probability move
+        self.last_prices = {}  # (eventid, market): {(bookmaker, name, description, point): price}
+        self.adaptive_polls = 0  # (event, market) polls
+        self.games_list_requests = 0
+        self.requests = 0  # Games list and event requests planned
+        self.cost = 0  # Quota units of those requests
+        self.baseline_requests = 0
+        self.baseline_cost = 0
+
+    def interval(self, game, market, now=None):
+        """
+        Returns:
+            float: The seconds to wait between polls of market for game.
+        """
+        now = time.time() if now is None else now
+        commence = parse_commence_time(game.get('commence_time'))
+        if commence is None:
+            interval = self.base_interval
+        else:
+            hours = (commence - now) / 3600
+            fraction = min(1.0, max(0.0, (hours - self.near_hours) / (self.far_hours - self.near_hours)))
+            interval = self.min_interval + fraction * (self.max_interval - self.min_interval)
+        interval /= 1 + self.volatility.get((game['id'], market), 0.0) / self.volatility_scale
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def due_markets(self, game, markets, now=None):
+        """
+        Pick the markets of game that are due, and record them as polled.
+
+        Args:
+            game (dict): The game from the games list, with keys 'id' and 'commence_time'.
+            markets (list): The candidate markets.
+            now (float, optional): The current unix time. Defaults to time.time().
+
+        Returns:
+            list: The markets that should be fetched now.
+        """
+        now = time.time() if now is None else now
+        due = []
+        for market in markets:
+            key = (game['id'], market)
+            last_polled = self.last_polled.get(key)
+            if last_polled is None or now - last_polled >= self.interval(game, market, now) * (1 - self.early_fraction):
+                self.last_polled[key] = now
+                self.adaptive_polls += 1
+                due.append(market)
+        return due
+
+    def baseline_ticks(self, key, now):
+        """
+        Returns:
+            int: The polls of key a fixed base_interval poller would have made since it was last counted.
+        """
+        last_baseline = self.last_baseline.get(key)
+        if last_baseline is None:
+            self.last_baseline[key] = now
+            return 1
+        ticks = int((now - last_baseline) // self.base_interval)
+        self.last_baseline[key] = last_baseline + ticks * self.base_interval
+        return ticks
+
+    def games_list(self, sport, now=None):
+        """
+        Count one games list request for sport, and the ones a fixed-interval poller would have sent meanwhile.
+        """
+        now = time.time() if now is None else now
+        ticks = self.baseline_ticks(sport, now)
+        self.games_list_requests += 1
+        self.requests += 1
+        self.cost += 1  # The games list is billed as one market in one region
+        self.baseline_requests += ticks
+        self.baseline_cost += ticks
+
+    def plan(self, game, bookmakers, markets, api_key, request_planner, now=None):
+        """
+        Plan the requests for the due markets of game, counting them against what a fixed-interval poller would send.
+
+        Args:
+            game (dict): The game from the games list, with keys 'id', 'sport_key', 'commence_time' and 'bookmakers'.
+            bookmakers (list): The bookmakers to fetch.
+            markets (list): The markets left after coverage pruning.
+            api_key (str): The API key to put in the URLs.
+            request_planner (RequestPlanner): Plans the requests.
+            now (float, optional): The current unix time. Defaults to time.time().
+
+        Returns:
+            list: (url, quota units) tuples to fetch, empty if no market is due.
+        """
+        now = time.time() if now is None else now
+        ticks = self.baseline_ticks(game['id'], now)
+        if ticks:
+            listed = {bookmaker['key'] for bookmaker in game.get('bookmakers', [])}
+            fixed = request_planner.requests(game, [bookmaker for bookmaker in bookmakers if bookmaker in listed], markets, api_key)
+            self.baseline_requests += ticks * len(fixed)
+            self.baseline_cost += ticks * sum(cost for _, cost in fixed)
+        due = self.due_markets(game, markets, now)
+        if not due:
+            return []
+        requests = request_planner.plan(game, bookmakers, due, api_key)
+        self.requests += len(requests)
+        self.cost += sum(cost for _, cost in requests)
+        return requests
+
+    def next_due(self, game_data_list, markets, now=None):
+        """
+        Returns:
+            float: The unix time the first of markets is due for a game of game_data_list that has been polled, or
+                   max_interval from now if there is none, so new games are still picked up from the games list.
+        """
+        now = time.time() if now is None else now
+        due = [self.last_polled[(game['id'], market)] + self.interval(game, market, now)
+               for game in game_data_list if isinstance(game, dict) for market in markets if (game['id'], market) in self.last_polled]
+        return min(due, default=now + self.max_interval)
+
+    def observe(self, game_update):
+        """
+        Update the volatility of every market in a fetched game from its price moves since the last fetch.
+
+        Args:
+            game_update (GameUpdate): The fetched event odds.
+        """
+        moves = {}
+        for update in game_update.updates:
+            key = (game_update.game_id, update.market_key)
+            last_prices = self.last_prices.setdefault(key, {})
+            market_moves = moves.setdefault(key, [])
+            for name, description, price, point in update.outcomes:
+                outcome_key = (update.bookmaker, name, description, point)
+                previous = last_prices.get(outcome_key)
+                if previous and price:
+                    market_moves.append(abs(1 / price - 1 / previous))
+                last_prices[outcome_key] = price
+        for key, market_moves in moves.items():
+            if market_moves:
+                move = sum(market_moves) / len(market_moves)
+                self.volatility[key] = self.smoothing * move + (1 - self.smoothing) * self.volatility.get(key, move)
+
+    def evict(self, eventids):
+        """
+        Forget the poll times, prices and volatility of eventids.
+        """
+        for state in (self.last_polled, self.volatility, self.last_prices):
+            for key in [key for key in state if key[0] in eventids]:
+                del state[key]
+        for eventid in eventids:
+            self.last_baseline.pop(eventid, None)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Market polls made, the requests and quota units they and the games lists used, what a fixed
+                  base_interval poller would have used, and the difference.
+        """
+        return {
+            'adaptive_polls': self.adaptive_polls,
+            'games_list_requests': self.games_list_requests,
+            'requests': self.requests,
+            'fixed_interval_requests': self.baseline_requests,
+            'requests_saved': self.baseline_requests - self.requests,
+            'cost': self.cost,
+            'fixed_interval_cost': self.baseline_cost,
+            'cost_saved': self.baseline_cost - self.cost
+        }
+
+class RequestPlanner:
+    """
+    Builds the fewest event odds URLs that cover a game's markets and bookmakers.
+
+    Bookmakers the games list shows are not listing the game are left out. The rest are split into as few groups of
+    BOOKMAKERS_PER_REGION as possible, since each group is billed as one region, and each group's markets are packed
+    into as few URLs as max_url_length allows. Alongside, the fixed 10 x 10 chunking this replaces is counted, so the
+    calls and quota units saved can be reported.
+    """
+    def __init__(self, bookmakers_per_region=BOOKMAKERS_PER_REGION, max_url_length=MAX_URL_LENGTH):
+        """
+        Args:
+            bookmakers_per_region (int, optional): Bookmakers billed as one region. Defaults to BOOKMAKERS_PER_REGION.
+            max_url_length (int, optional): The longest URL to build. Defaults to MAX_URL_LENGTH.
+        """
+        self.bookmakers_per_region = bookmakers_per_region
+        self.max_url_length = max_url_length
+        self.games = 0
+        self.planned_calls = 0
+        self.planned_cost = 0  # Quota units: markets x regions of every planned URL
+        self.fixed_calls = 0  # What 10 bookmakers x 10 markets chunks of every requested bookmaker would have sent
+        self.fixed_cost = 0
+        self.skipped_bookmakers = 0  # Requested bookmakers left out because the game's listing did not include them
+        self.actual_calls = 0  # Requests sent for planned URLs, retries included
+
+    def plan(self, game, bookmakers, markets, api_key):
+        """
+        Plan the event odds requests for one game.
+
+        Args:
+            game (dict): The game from the games list, with keys 'id', 'sport_key' and 'bookmakers'.
+            bookmakers (list): The bookmakers to fetch.
+            markets (list): The markets to fetch.
+            api_key (str): The API key to put in the URLs.
+
+        Returns:
+            list: (url, quota units) tuples to fetch, empty if no requested bookmaker lists the game.
+        """
+        listed = {bookmaker['key'] for bookmaker in game.get('bookmakers', [])}
+        wanted = [bookmaker for bookmaker in bookmakers if bookmaker in listed]
+        per_region = self.bookmakers_per_region
+        self.games += 1
+        self.skipped_bookmakers += len(bookmakers) - len(wanted)
+        self.fixed_calls += (len(bookmakers) + per_region - 1) // per_region * ((len(markets) + 9) // 10)
+        self.fixed_cost += len(markets) * ((len(bookmakers) + per_region - 1) // per_region)
+        requests = self.requests(game, wanted, markets, api_key)
+        self.planned_calls += len(requests)
+        self.planned_cost += sum(cost for _, cost in requests)
+        return requests
+
+    def requests(self, game, bookmakers, markets, api_key):
+        """
+        Build the fewest URLs covering markets from bookmakers for game, without counting them in the stats.
+
+        Returns:
+            list: (url, quota units) tuples.
+        """
+        if not bookmakers or not markets:
+            return []
+        per_region = self.bookmakers_per_region
+        groups = (len(bookmakers) + per_region - 1) // per_region
+        group_size = (len(bookmakers) + groups - 1) // groups  # Even groups, so no URL carries a nearly empty region
+        requests = []
+        for i in range(0, len(bookmakers), group_size):
+            bookmaker_group = bookmakers[i:i + group_size]
+            base_url = (f"{API_BASE_URL}/sports/{game['sport_key']}/events/{game['id']}/odds?apiKey={api_key}&regions=uk"
+                        f"&dateFormat=iso&oddsFormat=decimal&bookmakers={','.join(bookmaker_group)}&markets=")
+            market_batches = [[]]
+            for market in markets:
+                if market_batches[-1] and len(base_url) + len(','.join(market_batches[-1])) + 1 + len(market) > self.max_url_length:
+                    market_batches.append([])
+                market_batches[-1].append(market)
+            requests.extend((base_url + ','.join(market_batch), len(market_batch)) for market_batch in market_batches)
+        return requests
+
+    def observe(self, traces):
+        """
+        Count the requests sent for a game's planned URLs from their fetch_data traces.
+        """
+        self.actual_calls += sum(trace.get('attempts', 0) for trace in traces)
+
+    def stats(self):
+        """
+        Returns:
+            dict: Planned calls and quota units, the calls actually sent, and what fixed chunking would have used.
+        """
+        return {
+            'games': self.games,
+            'planned_calls': self.planned_calls,
+            'actual_calls': self.actual_calls,
+            'planned_cost': self.planned_cost,
+            'fixed_calls': self.fixed_calls,
+            'fixed_cost': self.fixed_cost,
+            'calls_saved': self.fixed_calls - self.planned_calls,
+            'cost_saved': self.fixed_cost - self.planned_cost,
+            'skipped_bookmakers': self.skipped_bookmakers
+        }
+
+class CoverageMatrix:
+    """
+    Which markets of each game can be compared, worked out once from the games list before any event request.
+
+    A market can only be compared when the game is listed by at least one of its sharp bookmakers and one other
+    bookmaker. The sharp and soft sets of every market are split once per poll, every game's listing is checked
+    against them, and games are pruned to the markets they cover. Games that cover none are never requested.
+    """
+    def __init__(self, bookmakers, markets):
+        """
+        Args:
+            bookmakers (list): The bookmakers to fetch.
+            markets (list): The markets to fetch.
+        """
+        self.markets = markets
+        self.sharp = {market: frozenset(bookmakers).intersection(sharpbookkeys.get(market, [])) for market in markets}
+        self.soft = {market: frozenset(bookmakers).difference(sharpbookkeys.get(market, [])) for market in markets}
+        self.coverage = {}  # game id: {market: (sharp bookmakers listing the game, other bookmakers listing it)}
+        self.games_pruned = 0
+        self.markets_pruned = 0  # Markets left out of games that still have others to compare
+        self.requests_saved = 0  # Event requests the planner would have built for the pruned games and markets
+        self.cost_saved = 0
+
+    def build(self, game_data_list):
+        """
+        Fill the matrix from the games list.
+
+        Args:
+            game_data_list (list): The games list, each game with keys 'id' and 'bookmakers'.
+        """
+        for game in game_data_list:
+            if not isinstance(game, dict):
+                continue
+            listed = frozenset(bookmaker['key'] for bookmaker in game.get('bookmakers', []))
+            self.coverage[game['id']] = {market: (len(self.sharp[market] & listed), len(self.soft[market] & listed)) for market in self.markets}
+
+    def comparable_markets(self, game_id):
+        """
+        Returns:
+            list: The markets of game_id listed by a sharp bookmaker and another bookmaker, in the order they were requested.
+        """
+        return [market for market, (sharp, soft) in self.coverage.get(game_id, {}).items() if sharp and soft]
+
+    def prune(self, game_data_list, bookmakers, api_key, request_planner):
+        """
+        Build the matrix and drop the games and markets that can never produce a comparison.
+
+        Args:
+            game_data_list (list): The games list.
+            bookmakers (list): The bookmakers to fetch.
+            api_key (str): The API key, only used to size the URLs the pruned games would have needed.
+            request_planner (RequestPlanner): Counts the event requests the pruning saved.
+
+        Returns:
+            list: (game, markets to fetch) tuples for the games with at least one comparable market.
+        """
+        self.build(game_data_list)
+        kept = []
+        for game in game_data_list:
+            if not isinstance(game, dict):
+                fetch_logger.error("Unexpected data type for game: %s. Skipping this game.", type(game))
+                continue
+            markets = self.comparable_markets(game['id'])
+            if len(markets) == len(self.markets):
+                kept.append((game, markets))
+                continue
+            listed = {bookmaker['key'] for bookmaker in game.get('bookmakers', [])}
+            listing = [bookmaker for bookmaker in bookmakers if bookmaker in listed]
+            full = request_planner.requests(game, listing, self.markets, api_key)
+            pruned = request_planner.requests(game, listing, markets, api_key)
+            self.requests_saved += len(full) - len(pruned)
+            self.cost_saved += sum(cost for _, cost in full) - sum(cost for _, cost in pruned)
+            if markets:
+                self.markets_pruned += len(self.markets) - len(markets)
+                fetch_logger.info("Game %s has no sharp and other bookmaker for markets %s. Fetching only %s.", game['id'], sorted(set(self.markets) - set(markets)), markets)
+                kept.append((game, markets))
+            else:
+                self.games_pruned += 1
+                fetch_logger.info("Game %s has no sharp and other bookmaker for any market. Skipping this game.", game['id'])
+        return kept
+
+    def stats(self):
+        """
+        Returns:
+            dict: Games in the matrix, games and markets pruned, and the event requests and quota units that saved.
+        """
+        return {
+            'games': len(self.coverage),
+            'games_pruned': self.games_pruned,
+            'markets_pruned': self.markets_pruned,
+            'requests_saved': self.requests_saved,
+            'cost_saved': self.cost_saved
+        }
+
+async def fetch_and_update_market_data(session, game, market_manager, bookmakers, markets, api_keys, current_key_index=0, scheduler=None, poll_scheduler=None, request_planner=None, fetch_timeout=None):
 
     """
     Fetch and update market data for a given game.
@@ -529,114 +2839,327 @@ async def fetch_and_update_market_data(session, game, market_manager, bookmakers
         game (dict): The game to fetch and update market data for. It's a dictionary with keys depending on the game data.
         market_manager (MarketManager): The MarketManager object to use for updating market data.
         bookmakers (list): The list of bookmakers to fetch data for.
-        markets (list): The list of markets to fetch data for.
+        markets (list): The list of markets to fetch data for, already pruned to the game's comparable markets by CoverageMatrix.
         api_keys (list): The list of API keys to use for the request.
         current_key_index (int, optional): The index of the current API key in the list. Defaults to 0.
+        scheduler (ApiKeyScheduler, optional): Picks and paces the API key for each request. Defaults to None.
+        poll_scheduler (AdaptivePollScheduler, optional): Only fetch the markets that are due for this game. Defaults to None.
+        request_planner (RequestPlanner, optional): Plans the game's requests and keeps their counts. Defaults to a new RequestPlanner.
+        fetch_timeout (float, optional): Seconds allowed for the game's fetches. Only the fetches are timed out, never the
+                                         market_manager.put that follows, so a producer blocked on a full queue keeps its data.
+                                         Defaults to None, no limit.
     """
 
     try:
         # Check if game is a dictionary
         if not isinstance(game, dict):
-            logging.error(f"Unexpected data type for game: {type(game)}. Skipping this game.")
+            fetch_logger.error("Unexpected data type for game: %s. Skipping this game.", type(game))
             return
 
-        logging.info(f"Bookmakers for game {game['id']}: {bookmakers}")
-        game_bookmaker_keys = [bookmaker['key'] for bookmaker in game.get('bookmakers', [])]
-        logging.info(f"Bookmaker keys for game {game['id']}: {game_bookmaker_keys}")
-
-        # Check if there is at least one sharpbookmaker and one other bookmaker for each market
-        for market in markets:
-            sharpbookmaker_keys = set(bookmakers).intersection(set(sharpbookkeys.get(market, [])))
-            other_bookmaker_keys = set(bookmakers).difference(set(sharpbookkeys.get(market, [])))
-            if not (sharpbookmaker_keys.intersection(game_bookmaker_keys) and other_bookmaker_keys.intersection(game_bookmaker_keys)):
-                logging.warning(f"Game: {game['id']} does not have at least one sharpbookmaker and one other bookmaker for market {market}. Skipping this game.")
-                return
+        fetch_logger.info("Bookmakers for game %s: %s", game['id'], bookmakers)
 
         if 'bookmakers' not in game or not game['bookmakers']:
-            logging.warning(f"No bookmakers for game: {game['id']}. Skipping this game.")
+            fetch_logger.warning("No bookmakers for game: %s. Skipping this game.", game['id'])
             return
         
-        fetch_tasks = []
-        total_api_calls = (len(bookmakers) + 9) // 10 * ((len(markets) + 9) // 10)
-        logging.debug(f"Total expected API calls for game {game['id']}: {total_api_calls}. This is due to {len(bookmakers)} bookmakers and {len(markets)} markets.")
-
-        for i in range(0, len(bookmakers), 10):
-            bookmaker_batch = bookmakers[i:i+10]
-            for j in range(0, len(markets), 10):
-                market_batch = markets[j:j+10]
-                market_data_url = f"https://api.the-odds-api.com/v4/sports/{game['sport_key']}/events/{game['id']}/odds?apiKey={api_keys[current_key_index]}&regions=uk&markets={','.join(market_batch)}&dateFormat=iso&oddsFormat=decimal&bookmakers={','.join(bookmaker_batch)}"
-                fetch_tasks.append(fetch_data(session, market_data_url, api_keys, current_key_index))
-        fetched_results = await asyncio.gather(*fetch_tasks, return_exceptions=True)
+        if request_planner is None:
+            request_planner = RequestPlanner()
+        if poll_scheduler is not None:  # Only the markets that are due, counted once they are actually planned
+            market_data_requests = poll_scheduler.plan(game, bookmakers, markets, api_keys[current_key_index], request_planner)
+            if not market_data_requests:
+                fetch_logger.debug("No markets due for game %s.", game['id'])
+                return
+        else:
+            market_data_requests = request_planner.plan(game, bookmakers, markets, api_keys[current_key_index])
+        fetch_logger.debug("Planned %s API calls for game %s, covering %s markets.", len(market_data_requests), game['id'], len(markets))
+
+        traces = [{} for _ in market_data_requests]  # One timestamp dict per request, handed to market_manager.put with its data
+        fetch_tasks = [fetch_data(session, market_data_url, api_keys, current_key_index, scheduler=scheduler, trace=trace, cost=cost, stream=STREAM_JSON)
+                       for (market_data_url, cost), trace in zip(market_data_requests, traces)]
+        try:
+            fetched_results = await asyncio.wait_for(asyncio.gather(*fetch_tasks, return_exceptions=True), timeout=fetch_timeout)
+        except asyncio.TimeoutError:
+            fetch_logger.error("Fetches timed out for game: %s", game['id'])
+            return
+        request_planner.observe(traces)
 
         if fetched_results:  # Check if results is not empty
-            logging.debug(f"Fetched results for game {game['id']}: {fetched_results}")
+            log_payload(fetch_logger, "Fetched results for game %s: %s", game['id'], fetched_results)
             data_added_flag = False
-            for fetched_game_data in fetched_results:
+            for fetched_game_data, trace in zip(fetched_results, traces):
                 #logging.info(data)
                 if fetched_game_data is None:
-                    logging.info(f"No data for game: {game['id']}. Skipping this game.")
-                    continue
-                # Filter out bookmakers that don't have data WE ASK FOR ALL REQUIRED BOOKMAKERS AT ONCE, SO THEORITICALLY IT SHOULD EITHER BE GOOD OR NOT MAYBE CAN RETURN HERE IF NOT
-                fetched_game_data['bookmakers'] = [bookmaker for bookmaker in fetched_game_data.get('bookmakers', []) if bookmaker.get('markets', [])]
-                if not fetched_game_data['bookmakers']:
-                    logging.info(f"No bookmakers with data for game: {game['id']}. Skipping this game.")
+                    fetch_logger.info("No data for game: %s. Skipping this game.", game['id'])
                     continue
-                logging.debug(f"Data to add to queue for game {game['id']}: {fetched_game_data}")  # Debug print 
-                await market_manager.queue.put(fetched_game_data)
+                if isinstance(fetched_game_data, GameUpdate):  # Streamed straight into MarketUpdates by read_game_update
+                    game_update = fetched_game_data
+                    if not game_update.bookmaker_markets:
+                        fetch_logger.info("No bookmakers with data for game: %s. Skipping this game.", game['id'])
+                        continue
+                else:
+                    # Filter out bookmakers that don't have data WE ASK FOR ALL REQUIRED BOOKMAKERS AT ONCE, SO THEORITICALLY IT SHOULD EITHER BE GOOD OR NOT MAYBE CAN RETURN HERE IF NOT
+                    fetched_game_data['bookmakers'] = [bookmaker for bookmaker in fetched_game_data.get('bookmakers', []) if bookmaker.get('markets', [])]
+                    if not fetched_game_data['bookmakers']:
+                        fetch_logger.info("No bookmakers with data for game: %s. Skipping this game.", game['id'])
+                        continue
+                    log_payload(fetch_logger, "Data to add to queue for game %s: %s", game['id'], fetched_game_data)
+                    game_update = build_game_update(fetched_game_data)  # Queue the compact message, not the whole response
+                    if game_update is None:
+                        continue
+                if poll_scheduler is not None:
+                    poll_scheduler.observe(game_update)
+                await market_manager.put(game_update, trace)
                 data_added_flag = True
             if not data_added_flag:
-                logging.info(f"No data added for game: {game['id']}")
+                fetch_logger.info("No data added for game: %s", game['id'])
         else:
-            logging.info(f"No results data for game: {game['id']}")
+            fetch_logger.info("No results data for game: %s", game['id'])
 
-        logging.info(f"Task completed for game: {game['id']}")  # New print statement
+        fetch_logger.info("Task completed for game: %s", game['id'])  # New print statement
     except Exception as e:
-        logging.error(f"Error in fetch_and_update_market_data for game: {game['id']}, error: {e}")
+        fetch_logger.error("Error in fetch_and_update_market_data for game: %s, error: %s", game['id'], e)
 
-async def main(sport, bookmakers, markets, api_key):
+async def poll_once(session, market_manager, sport, bookmakers, markets, api_keys, api_key=None, scheduler=None, task_timeout=10, poll_scheduler=None, request_planner=None):
+    """
+    Fetch the games of a sport, queue every game's odds on market_manager and wait until its consumer has processed them.
+
+    Args:
+        session (aiohttp.ClientSession): The aiohttp session to use for the requests.
+        market_manager (MarketManager): The MarketManager whose update_market_data consumer is running.
+        sport (str): The sport key, e.g. "basketball_nba".
+        bookmakers (list): The bookmakers to fetch.
+        markets (list): The markets to fetch.
+        api_keys (list): The list of API keys to use for the requests.
+        api_key (str, optional): The API key used for the games list. Defaults to the first of api_keys.
+        scheduler (ApiKeyScheduler, optional): Picks and paces the API key for each request. Defaults to None.
+        task_timeout (float, optional): Seconds allowed for each game's fetches, not counting the wait for queue room. Defaults to 10.
+        poll_scheduler (AdaptivePollScheduler, optional): Only fetch each game's markets when they are due. Defaults to None.
+        request_planner (RequestPlanner, optional): Plans every game's requests and keeps their counts. Defaults to a new RequestPlanner.
+
+    Returns:
+        list: The games list, or None if it could not be fetched.
+    """
+    games_url = f'{API_BASE_URL}/sports/{sport}/odds?apiKey={api_key or api_keys[0]}&regions=us&oddsFormat=american&bookmakers={",".join(bookmakers)}'
+    logger.debug("Constructed games_url: %s", games_url)
+    game_data_list = await fetch_data(session, games_url, api_keys, scheduler=scheduler)
+    if poll_scheduler is not None:
+        poll_scheduler.games_list(sport)
+    if game_data_list is None:
+        return None
+
+    logger.info("Total number of games: %s", len(game_data_list))
+    if request_planner is None:
+        request_planner = RequestPlanner()
+    coverage = CoverageMatrix(bookmakers, markets)
+    game_markets = coverage.prune(game_data_list, bookmakers, api_key or api_keys[0], request_planner)
+    logger.info("Coverage pruning for %s: %s", sport, coverage.stats())
+    fetch_tasks = [asyncio.create_task(fetch_and_update_market_data(session, game, market_manager, bookmakers, game_market_list, api_keys, scheduler=scheduler, poll_scheduler=poll_scheduler, request_planner=request_planner, fetch_timeout=task_timeout))
+                   for game, game_market_list in game_markets]
+    logger.debug("Created %s fetch_tasks.", len(fetch_tasks))
+    await asyncio.gather(*fetch_tasks)
+    await market_manager.queue.join()
+    await market_manager.flush_history()
+    logger.info("Request plan for %s: %s", sport, request_planner.stats())
+    return game_data_list
+
+async def main(sport, bookmakers, markets, api_key, session_config=None):
     """
     Main function to fetch and update market data for all games of a sport.
+
+    Args:
+        sport (str): The sport key, e.g. "basketball_nba".
+        bookmakers (list): The bookmakers to fetch.
+        markets (list): The markets to fetch.
+        api_key (str): The API key used for the games list.
+        session_config (dict, optional): Overrides for SESSION_CONFIG.
     """
-    logging.info("Starting main function...")
+    logger.info("Starting main function...")
 
     # Main function to fetch and update market data for all games of a sport
     api_keys = ['e69e8575a4544a37e671d7761ed886df',api_key,'ea2f6d92d31a0649d1153d647ccb27a3','3ac0494f1936188c6f83b5834cb4659a']
-    games_not_processed = []  # List to store games that were not processed
-    logging.debug("Initialized api_keys and games_not_processed list.")
-
-    async with aiohttp.ClientSession() as session:
+    logger.debug("Initialized api_keys.")
+
+    session_stats = SessionStats()
+    scheduler = ApiKeyScheduler(api_keys)
+    request_planner = RequestPlanner()
+    market_manager = MarketManager(len(bookmakers))
+    if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH):
+        market_manager.load_snapshot(SNAPSHOT_PATH)
+    async with create_session(session_config, session_stats) as session:
         try:
-            games_url = f'https://api.the-odds-api.com/v4/sports/{sport}/odds?apiKey={api_key}&regions=us&oddsFormat=american&bookmakers={",".join(bookmakers)}'
-            logging.debug(f"Constructed games_url: {games_url}")
-            game_data_list = await fetch_data(session, games_url,api_keys)
-            if game_data_list is not None:
-                logging.info(f"Total number of games: {len(game_data_list)}")
-                market_manager = MarketManager(len(bookmakers))
-                logging.debug("Initialized MarketManager.")
-                update_task = asyncio.create_task(market_manager.update_market_data())
-                logging.debug("Created update_task.")
-                fetch_tasks = [asyncio.create_task(asyncio.wait_for(fetch_and_update_market_data(session, game, market_manager, bookmakers, markets, api_keys), timeout=10)) for game in game_data_list]
-                logging.debug(f"Created {len(fetch_tasks)} fetch_tasks.")
-                for task in asyncio.as_completed(fetch_tasks):
-                    try:
-                        await task
-                    except asyncio.TimeoutError:
-                        logging.error(f"Task timed out for game: {task.get_name()}")  # Assuming you set the name of the task to the game id
-                await market_manager.queue.put(None)
-                logging.debug("Put None in market_manager queue.")
-                await update_task  # Wait for the update task to complete
-                logging.debug("Completed update_task.")
+            update_task = asyncio.create_task(market_manager.update_market_data())
+            logger.debug("Created update_task.")
+            await poll_once(session, market_manager, sport, bookmakers, markets, api_keys, api_key=api_key, scheduler=scheduler, request_planner=request_planner)
+            await market_manager.put(None)
+            logger.debug("Put None in market_manager queue.")
+            await update_task  # Wait for the update task to complete
+            market_manager.close()
+            logger.debug("Completed update_task.")
+            market_manager.report_missing_bookmakers(bookmakers)
+            logger.info("Queue metrics: %s", market_manager.get_metrics())
+            if market_manager.change_detector is not None:
+                logger.info("Change detection: %s", market_manager.change_detector.stats())
+            logger.info("Stage latency (count, p50, p99): %s", market_manager.latency.summary())
+            if LATENCY_EXPORT_PATH:
+                market_manager.latency.write(LATENCY_EXPORT_PATH)
+            if SNAPSHOT_PATH:
+                market_manager.save_snapshot(SNAPSHOT_PATH)
 
         except Exception as e:
-            logging.error(f"Error in main: {e}")
+            logger.error("Error in main: %s", e)
 
-        logging.info("Finished main function.")
+        logger.info("Session stats: %s", session_stats.stats())
+        logger.info("API key scheduler stats: %s", scheduler.stats())
+        logger.info("Request planner stats: %s", request_planner.stats())
+        logger.info("Finished main function.")
         return market_manager
 
-import time
+class PollingDaemon:
+    """
+    Resident polling service built on one MarketManager.
+
+    Markets stay warm between cycles, and one session, API key scheduler and devig cache are reused for the daemon's
+    whole life. Each (sport, market) is polled on its own cadence, and SIGTERM/SIGINT stop the daemon after the
+    current cycle has been processed. After every cycle, events that have started or dropped out of their sport's
+    games list are evicted, so state only grows with the games on the board.
+    """
+    def __init__(self, sport_markets, bookmakers, api_keys, intervals=None, session_config=None, manager_options=None, poll_scheduler=None):
+        """
+        Args:
+            sport_markets (dict): sport key: list of markets to poll.
+            bookmakers (list): The bookmakers to fetch.
+            api_keys (list): The API keys to schedule requests on.
+            intervals (dict, optional): (sport, market): seconds between polls. Defaults to POLL_INTERVALS.
+            session_config (dict, optional): Overrides for SESSION_CONFIG.
+            manager_options (dict, optional): Keyword arguments for the MarketManager.
+            poll_scheduler (AdaptivePollScheduler, optional): Decides per game and market what is fetched. Each sport's
+                                                              games list is then fetched again when its first polled game
+                                                              is next due. Defaults to None.
+        """
+        self.sport_markets = sport_markets
+        self.bookmakers = bookmakers
+        self.api_keys = api_keys
+        self.intervals = {**POLL_INTERVALS, **(intervals or {})}
+        self.poll_scheduler = poll_scheduler
+        self.session_config = session_config
+        self.market_manager = MarketManager(len(bookmakers), **(manager_options or {}))
+        if SNAPSHOT_PATH and os.path.exists(SNAPSHOT_PATH):
+            self.market_manager.load_snapshot(SNAPSHOT_PATH)
+        self.scheduler = ApiKeyScheduler(api_keys)
+        self.request_planner = RequestPlanner()
+        self.session_stats = SessionStats()
+        self.next_poll = {(sport, market): 0.0 for sport, markets in sport_markets.items() for market in markets}
+        self.live_events = {}  # sport: ids of the games in its last games list that had not started
+        self.stopping = asyncio.Event()
+        self.cycles = 0
+
+    def interval(self, sport, market):
+        return self.intervals.get((sport, market), DEFAULT_POLL_INTERVAL)
+
+    def stop(self):
+        logger.info("Stopping polling daemon after the current cycle.")
+        self.stopping.set()
+
+    def due_markets(self, now):
+        """
+        Returns:
+            dict: sport key: list of markets whose next poll is due at now.
+        """
+        due = {}
+        for (sport, market), next_poll in self.next_poll.items():
+            if next_poll <= now:
+                due.setdefault(sport, []).append(market)
+        return due
+
+    async def poll_cycle(self, session):
+        """
+        Poll every due (sport, market) once, concurrently per sport, and schedule their next polls: after their
+        fixed interval, or with a poll_scheduler, when the first game polled for the sport is due again.
+        """
+        now = time.monotonic()
+        due = self.due_markets(now)
+        game_data_lists = await asyncio.gather(*(poll_once(session, self.market_manager, sport, self.bookmakers, markets, self.api_keys, scheduler=self.scheduler, poll_scheduler=self.poll_scheduler, request_planner=self.request_planner)
+                                                 for sport, markets in due.items()))
+        for (sport, markets), game_data_list in zip(due.items(), game_data_lists):
+            if self.poll_scheduler is None:
+                next_polls = [now + self.interval(sport, market) for market in markets]
+            elif game_data_list is None:  # The games list failed, so try again soon
+                next_polls = [time.monotonic() + self.poll_scheduler.min_interval] * len(markets)
+            else:  # The sport's markets share one games list, so they wake together when its first game is due
+                next_polls = [time.monotonic() + max(0.0, self.poll_scheduler.next_due(game_data_list, markets) - time.time())] * len(markets)
+            for market, next_poll in zip(markets, next_polls):
+                self.next_poll[(sport, market)] = next_poll
+            if game_data_list is not None:
+                wall_now = time.time()
+                self.live_events[sport] = {game['id'] for game in game_data_list if isinstance(game, dict)
+                                           and (parse_commence_time(game.get('commence_time')) or float('inf')) > wall_now}
+        await self.evict_finished_events()
+        self.cycles += 1
+        logger.info("Poll cycle %s done for %s. Queue metrics: %s", self.cycles, due, self.market_manager.get_metrics())
+        logger.info("Stage latency (count, p50, p99): %s", self.market_manager.latency.summary())
+        if self.poll_scheduler is not None:
+            logger.info("Adaptive polling: %s", self.poll_scheduler.stats())
+        if SNAPSHOT_PATH:
+            await self.market_manager.sync_markets()
+            self.market_manager.save_snapshot(SNAPSHOT_PATH)
+
+    async def evict_finished_events(self):
+        """
+        Evict the events that are not live in any sport's last games list. Waits until every sport's list has been
+        fetched once, so events restored from a snapshot are not dropped because their sport's first fetch failed.
+        """
+        if len(self.live_events) < len(self.sport_markets):
+            return
+        live = set().union(*self.live_events.values())
+        finished = self.market_manager.event_ids - live
+        if finished:
+            await self.market_manager.evict_events(finished)
+        if self.poll_scheduler is not None:  # It also tracks games that were polled but never returned odds
+            self.poll_scheduler.evict({key[0] for key in self.poll_scheduler.last_polled} - live)
+
+    async def run(self):
+        """
+        Poll until stop() is called or the process receives SIGTERM or SIGINT.
+
+        Returns:
+            MarketManager: The daemon's MarketManager.
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):  # Not available on this platform or outside the main thread
+                pass
+
+        async with create_session(self.session_config, self.session_stats) as session:
+            update_task = asyncio.create_task(self.market_manager.update_market_data())
+            try:
+                while not self.stopping.is_set():
+                    try:
+                        await self.poll_cycle(session)
+                    except Exception as e:
+                        logger.error("Error in poll cycle %s: %s", self.cycles + 1, e)
+                    wait = max(0.0, min(self.next_poll.values()) - time.monotonic())
+                    try:
+                        await asyncio.wait_for(self.stopping.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                await self.market_manager.put(None)
+                await update_task
+                self.market_manager.close()
+                logger.info("Polling daemon stopped after %s cycles. Session stats: %s. API key scheduler stats: %s. Request planner stats: %s. Devig cache: %s",
+                            self.cycles, self.session_stats.stats(), self.scheduler.stats(), self.request_planner.stats(), devig_cache.stats())
+                if LATENCY_EXPORT_PATH:
+                    self.market_manager.latency.write(LATENCY_EXPORT_PATH)
+                if SNAPSHOT_PATH:
+                    self.market_manager.save_snapshot(SNAPSHOT_PATH)
+        return self.market_manager
+
 if __name__ == "__main__":
-    logging.info("Starting main execution...")
     start_time = time.monotonic()
+    init_logging()
+    logger.info("Starting main execution...")
 
     sport = "basketball_nba"
     markets = ["player_threes"]
@@ -649,8 +3172,13 @@ if __name__ == "__main__":
             bookmakers.extend(sharpbookkeys[market])
     bookmakers = list(set(bookmakers))  # Remove duplicates
 
-    logging.info(f"Parameters set - Sport: {sport}, Bookmakers: {', '.join(bookmakers)}, Markets: {', '.join(markets)}, API Key: {api_key}")
-    market_manager=asyncio.run(main(sport, bookmakers, markets, api_key))
+    logger.info("Parameters set - Sport: %s, Bookmakers: %s, Markets: %s, API Key: %s", sport, ', '.join(bookmakers), ', '.join(markets), api_key)
+    if '--daemon' in sys.argv[1:]:
+        api_keys = ['e69e8575a4544a37e671d7761ed886df',api_key,'ea2f6d92d31a0649d1153d647ccb27a3','3ac0494f1936188c6f83b5834cb4659a']
+        poll_scheduler = AdaptivePollScheduler() if '--adaptive' in sys.argv[1:] else None
+        market_manager = asyncio.run(PollingDaemon({sport: markets}, bookmakers, api_keys, poll_scheduler=poll_scheduler).run())
+    else:
+        market_manager=asyncio.run(main(sport, bookmakers, markets, api_key))
     
     end_time = time.monotonic()
     total_runtime = end_time - start_time - total_delay_time
@@ -0,0 +1,200 @@
+"""
+Replay captured odds payloads through MarketManager without touching the live API.
+
+Payloads are read from capture files such as EDGECASE.txt ("Data from queue: {...}") and app.log
+("Data to add to queue for game <id>: {...}"). New captures need every payload dump written, so run the poller with
+ODDS_LOG_PAYLOAD_SAMPLE=1 when recording. Lines that start with a log timestamp can be replayed at the recorded speed
+(or a multiple of it); without timestamps, or with --speed 0, payloads are queued as fast as the consumer takes them.
+The replay logs to k456.LOG_FILE, or to REPLAY_LOG_FILE when app.log is itself being replayed, so it is never truncated.
+
+Usage:
+    python replay.py EDGECASE.txt app.log --repeat 10
+    python replay.py captures/ --speed 1
+"""
+import argparse
+import ast
+import asyncio
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+import k456
+
+CAPTURE_MARKERS = re.compile(r"Data from queue: |Data to add to queue for game \w+: ")
+LOG_TIMESTAMP = re.compile(r"(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3})")
+CAPTURE_EXTENSIONS = ('.log', '.txt')
+REPLAY_LOG_FILE = 'replay.log'  # Written instead of k456.LOG_FILE when that file is one of the captures being replayed
+replay_logger = logging.getLogger('odds.replay')
+
+def extract_literal(text, start):
+    """
+    Find the Python literal that starts at or after start, tolerating newlines inside it.
+
+    Args:
+        text (str): The capture file contents.
+        start (int): The offset to search from.
+
+    Returns:
+        tuple: The literal source and the offset just past it, or (None, start) if no balanced literal follows.
+    """
+    match = re.compile(r"[\[{]").search(text, start)
+    if match is None:
+        return None, start
+    depth = 0
+    quote = None
+    index = match.start()
+    while index < len(text):
+        char = text[index]
+        if quote:
+            if char == '\\':
+                index += 1
+            elif char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif char in '[{':
+            depth += 1
+        elif char in ']}':
+            depth -= 1
+            if depth == 0:
+                return text[match.start():index + 1], index + 1
+        index += 1
+    return None, start
+
+def parse_capture(text):
+    """
+    Yield every payload captured in a log or dump.
+
+    Args:
+        text (str): The capture file contents.
+
+    Yields:
+        tuple: (timestamp, payload). timestamp is the unix time from the log line, or None if the line has none.
+    """
+    for marker in CAPTURE_MARKERS.finditer(text):
+        literal, _ = extract_literal(text, marker.end())
+        if literal is None:
+            replay_logger.warning("Unterminated payload after offset %s.", marker.start())
+            continue
+        try:
+            payload = ast.literal_eval(literal.replace('\n', ''))
+        except (ValueError, SyntaxError) as e:
+            replay_logger.warning("Could not parse payload after offset %s: %s", marker.start(), e)
+            continue
+        line_start = text.rfind('\n', 0, marker.start()) + 1
+        stamp = LOG_TIMESTAMP.match(text, line_start)
+        timestamp = datetime.strptime(stamp.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp() if stamp else None
+        yield timestamp, payload
+
+def capture_files(paths):
+    """
+    Args:
+        paths (list): Capture files, or directories searched recursively for *.log and *.txt files.
+
+    Returns:
+        list: The capture files, in the order they are replayed.
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(CAPTURE_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+def replay_log_file(files):
+    """
+    Pick the log file for a replay of files, so logging never truncates a capture before or while it is read.
+
+    Returns:
+        tuple: The log file and the mode to open it with: k456.LOG_FILE, or REPLAY_LOG_FILE when k456.LOG_FILE is one
+               of the captures, opened for appending if it is a capture too.
+    """
+    captured = {os.path.abspath(file) for file in files}
+    log_file = REPLAY_LOG_FILE if os.path.abspath(k456.LOG_FILE) in captured else k456.LOG_FILE
+    return log_file, 'a' if os.path.abspath(log_file) in captured else 'w'
+
+def load_captured_payloads(paths):
+    """
+    Load the captured payloads from files and directories, in file order.
+
+    Args:
+        paths (list): Capture files, or directories searched recursively for *.log and *.txt files.
+
+    Returns:
+        list: (timestamp, payload) tuples.
+    """
+    payloads = []
+    for file in capture_files(paths):
+        with open(file, encoding='utf-8', errors='replace') as capture:
+            found = list(parse_capture(capture.read()))
+        replay_logger.info("Loaded %s payloads from %s.", len(found), file)
+        payloads.extend(found)
+    return payloads
+
+async def replay(market_manager, payloads, speed=None):
+    """
+    Put captured payloads on market_manager's queue.
+
+    Args:
+        market_manager (k456.MarketManager): The manager whose consumer is running.
+        payloads (list): (timestamp, payload) tuples as returned by load_captured_payloads.
+        speed (float, optional): Multiple of the recorded speed, e.g. 1 for real time. None or 0 queues as fast as possible.
+    """
+    previous = None
+    for timestamp, payload in payloads:
+        if speed and timestamp is not None and previous is not None and timestamp > previous:
+            await asyncio.sleep((timestamp - previous) / speed)
+        if timestamp is not None:
+            previous = timestamp
+        await market_manager.put(payload)
+
+async def run_replay(payloads, speed=None, repeat=1, manager_options=None):
+    """
+    Replay payloads through a fresh MarketManager and time it.
+
+    Args:
+        payloads (list): (timestamp, payload) tuples as returned by load_captured_payloads.
+        speed (float, optional): Multiple of the recorded speed. None or 0 queues as fast as possible.
+        repeat (int, optional): How many times to replay the payloads. Defaults to 1.
+        manager_options (dict, optional): Keyword arguments for the MarketManager.
+
+    Returns:
+        tuple: The MarketManager and a dict with the items replayed, seconds taken and items per second.
+    """
+    market_manager = k456.MarketManager(0, **(manager_options or {}))
+    start = time.perf_counter()
+    update_task = asyncio.create_task(market_manager.update_market_data())
+    for _ in range(repeat):
+        await replay(market_manager, payloads, speed)
+    await market_manager.put(None)
+    await update_task
+    market_manager.close()
+    elapsed = time.perf_counter() - start
+    items = len(payloads) * repeat
+    return market_manager, {'items': items, 'seconds': elapsed, 'items_per_second': items / elapsed if elapsed else 0.0}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured odds payloads through MarketManager offline.")
+    parser.add_argument('paths', nargs='+', help="Capture files or directories")
+    parser.add_argument('--speed', type=float, default=0, help="Multiple of the recorded speed; 0 replays as fast as possible")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-change-detection', action='store_true', help="Process repeated payloads instead of skipping them")
+    parser.add_argument('--workers', type=int, default=k456.MARKET_WORKERS, help="Shard markets over this many workers")
+    parser.add_argument('--worker-mode', choices=['thread', 'process'], default=k456.MARKET_WORKER_MODE)
+    args = parser.parse_args()
+
+    files = capture_files(args.paths)
+    log_file, log_mode = replay_log_file(files)
+    k456.init_logging(log_file, log_mode)
+    payloads = load_captured_payloads(files)
+    manager_options = {'change_detection': not args.no_change_detection, 'workers': args.workers, 'worker_mode': args.worker_mode}
+    market_manager, stats = asyncio.run(run_replay(payloads, args.speed, args.repeat, manager_options))
+    print(f"Replayed {stats['items']} payloads in {stats['seconds']:.3f} seconds ({stats['items_per_second']:.1f} payloads/s)")
+    for market_name, market_object in market_manager.market_objects.items():
+        print(f"Market {market_name}: {len(market_object.bookmakers)} bookmakers, {len(market_object.results)} results")
+    print(f"Queue metrics: {market_manager.get_metrics()}")
+    print(f"Devig cache: {k456.devig_cache.stats()}")
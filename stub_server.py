@@ -0,0 +1,202 @@
+"""
+Local stand-in for the-odds-api v4 endpoints used by k456.py.
+
+It serves synthetic games and player-prop odds and tracks a quota per API key, returning the same
+x-requests-remaining / x-requests-used / x-requests-last headers as the real API, a 401 quota message when a key
+runs out and a 429 when a key goes over its per-second rate limit.
+
+Run it and point k456.py at it with:
+    python stub_server.py --port 8080
+    ODDS_API_BASE_URL=http://127.0.0.1:8080/v4 python k456.py
+"""
+import argparse
+import hashlib
+import logging
+import random
+import time
+from aiohttp import web
+
+BOOKMAKERS = ["fanduel", "draftkings", "espnbet", "fliff", "betmgm", "williamhill_us", "betrivers", "pointsbetus"]
+TEAMS = ["Orlando Magic", "Washington Wizards", "Boston Celtics", "New York Knicks", "Chicago Bulls", "Miami Heat",
+         "Denver Nuggets", "Phoenix Suns", "Golden State Warriors", "Los Angeles Lakers", "Dallas Mavericks", "Utah Jazz"]
+
+def seeded_random(*parts):
+    """
+    Returns:
+        random.Random: A generator seeded from parts, so the same event/bookmaker/market always gets the same prices.
+    """
+    return random.Random(hashlib.md5("|".join(map(str, parts)).encode()).hexdigest())
+
+def two_way_prices(rng, vig=1.05):
+    """
+    Returns:
+        tuple: Decimal prices for both sides of a two-way market with the given overround.
+    """
+    probability = rng.uniform(0.3, 0.7)
+    return round(1 / (probability * vig), 2), round(1 / ((1 - probability) * vig), 2)
+
+class StubOddsApi:
+    """
+    Synthetic games, odds and per-key quota accounting.
+    """
+    def __init__(self, events=8, players=10, quota=500, rate_limit=None, coverage=1.0, seed=0, bookmakers=None):
+        """
+        Args:
+            events (int, optional): The number of games per sport. Defaults to 8.
+            players (int, optional): The number of players with props per game. Defaults to 10.
+            quota (int, optional): Requests each API key may use. Defaults to 500.
+            rate_limit (int, optional): Requests per second allowed on each key, None for no limit. Defaults to None.
+            coverage (float, optional): The chance a bookmaker lists a given game. Defaults to 1.0.
+            seed (int, optional): Seed for the generated games. Defaults to 0.
+            bookmakers (list, optional): The bookmakers that exist. Defaults to BOOKMAKERS.
+        """
+        self.events = events
+        self.players = players
+        self.quota = quota
+        self.rate_limit = rate_limit
+        self.coverage = coverage
+        self.seed = seed
+        self.bookmakers = bookmakers or BOOKMAKERS
+        self.used = {}  # API key: quota used
+        self.recent = {}  # API key: timestamps of requests in the last second
+        self.requests = 0
+
+    def games(self, sport):
+        """
+        Returns:
+            list: The games of sport, each with its id, teams, commence_time and the bookmakers that list it.
+        """
+        games = []
+        start = int(time.time()) // 3600 * 3600
+        for index in range(self.events):
+            rng = seeded_random(self.seed, sport, index)
+            home, away = rng.sample(TEAMS, 2)
+            eventid = hashlib.md5(f"{self.seed}{sport}{index}".encode()).hexdigest()
+            listed = [bookmaker for bookmaker in self.bookmakers if seeded_random(self.seed, eventid, bookmaker).random() < self.coverage]
+            games.append({
+                'id': eventid,
+                'sport_key': sport,
+                'sport_title': sport.split('_')[-1].upper(),
+                'commence_time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start + 3600 * (index + 1))),
+                'home_team': home,
+                'away_team': away,
+                'bookmakers': listed
+            })
+        return games
+
+    def check_quota(self, api_key, cost):
+        """
+        Charge cost to api_key.
+
+        Returns:
+            tuple: The error status and message, or (None, None) if the request may proceed.
+        """
+        now = time.monotonic()
+        if self.rate_limit is not None:
+            recent = [stamp for stamp in self.recent.get(api_key, []) if now - stamp < 1]
+            if len(recent) >= self.rate_limit:
+                self.recent[api_key] = recent
+                return 429, "Your app is making requests too quickly. Please slow down."
+            recent.append(now)
+            self.recent[api_key] = recent
+        if self.used.get(api_key, 0) + cost > self.quota:
+            return 401, "Usage quota has been reached. Please upgrade your plan."
+        self.used[api_key] = self.used.get(api_key, 0) + cost
+        return None, None
+
+    def headers(self, api_key, cost):
+        used = self.used.get(api_key, 0)
+        return {'x-requests-remaining': str(self.quota - used), 'x-requests-used': str(used), 'x-requests-last': str(cost)}
+
+    def respond(self, request, cost, build):
+        self.requests += 1
+        api_key = request.query.get('apiKey', '')
+        status, message = self.check_quota(api_key, cost)
+        if status is not None:
+            return web.json_response({'message': message}, status=status, headers=self.headers(api_key, 0))
+        return web.json_response(build(), headers=self.headers(api_key, cost))
+
+    async def handle_games(self, request):
+        sport = request.match_info['sport']
+        requested = request.query.get('bookmakers', '').split(',') if request.query.get('bookmakers') else self.bookmakers
+
+        def build():
+            games = []
+            for game in self.games(sport):
+                listed = [bookmaker for bookmaker in game['bookmakers'] if bookmaker in requested]
+                home_price, away_price = two_way_prices(seeded_random(self.seed, game['id'], 'h2h'))
+                games.append({**game, 'bookmakers': [
+                    {'key': bookmaker, 'title': bookmaker.title(), 'last_update': game['commence_time'], 'markets': [
+                        {'key': 'h2h', 'last_update': game['commence_time'], 'outcomes': [
+                            {'name': game['home_team'], 'price': home_price},
+                            {'name': game['away_team'], 'price': away_price}]}]}
+                    for bookmaker in listed]})
+            return games
+
+        return self.respond(request, 1, build)
+
+    async def handle_event_odds(self, request):
+        sport = request.match_info['sport']
+        eventid = request.match_info['event']
+        markets = [market for market in request.query.get('markets', 'h2h').split(',') if market]
+        requested = [bookmaker for bookmaker in request.query.get('bookmakers', '').split(',') if bookmaker]
+        game = next((game for game in self.games(sport) if game['id'] == eventid), None)
+        if game is None:
+            return web.json_response({'message': 'Event not found.'}, status=404)
+        # Like the real API, every 10 bookmakers count as one region
+        cost = len(markets) * max(1, (len(requested) + 9) // 10)
+
+        def build():
+            bookmakers = []
+            for bookmaker in requested:
+                if bookmaker not in game['bookmakers']:
+                    continue
+                market_list = []
+                for market in markets:
+                    outcomes = []
+                    for player in range(self.players):
+                        rng = seeded_random(self.seed, eventid, market, player, bookmaker)
+                        point = seeded_random(self.seed, eventid, market, player).choice([0.5, 1.5, 2.5, 3.5, 4.5])
+                        over, under = two_way_prices(rng)
+                        description = f"Player {player} {game['home_team'].split()[-1]}"
+                        outcomes.append({'name': 'Over', 'description': description, 'price': over, 'point': point})
+                        outcomes.append({'name': 'Under', 'description': description, 'price': under, 'point': point})
+                    market_list.append({'key': market, 'last_update': game['commence_time'], 'outcomes': outcomes})
+                bookmakers.append({'key': bookmaker, 'title': bookmaker.title(), 'markets': market_list})
+            return {key: game[key] for key in ('id', 'sport_key', 'sport_title', 'commence_time', 'home_team', 'away_team')} | {'bookmakers': bookmakers}
+
+        return self.respond(request, cost, build)
+
+    async def handle_usage(self, request):
+        return web.json_response({'requests': self.requests, 'used': self.used})
+
+def make_app(stub=None):
+    """
+    Args:
+        stub (StubOddsApi, optional): The stub to serve. Defaults to a StubOddsApi with default settings.
+
+    Returns:
+        aiohttp.web.Application: The stub server application, also reachable as app['stub'].
+    """
+    stub = stub or StubOddsApi()
+    app = web.Application()
+    app['stub'] = stub
+    app.router.add_get('/v4/sports/{sport}/odds', stub.handle_games)
+    app.router.add_get('/v4/sports/{sport}/events/{event}/odds', stub.handle_event_odds)
+    app.router.add_get('/usage', stub.handle_usage)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local stub of the-odds-api with quota headers.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--events', type=int, default=8)
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--quota', type=int, default=500)
+    parser.add_argument('--rate-limit', type=int, default=None)
+    parser.add_argument('--coverage', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    stub = StubOddsApi(events=args.events, players=args.players, quota=args.quota, rate_limit=args.rate_limit, coverage=args.coverage, seed=args.seed)
+    web.run_app(make_app(stub), host=args.host, port=args.port)